@@ -1 +1 @@
-__all__ = ["names", "dataframe", "data", "utils", "screener"]
+__all__ = ["names", "dataframe", "data", "utils", "screener", "panel", "kernels"]
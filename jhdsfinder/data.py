@@ -1,5 +1,7 @@
 import os
-from typing import List, Tuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Tuple
 
 from tqdm import tqdm
 import numpy as np
@@ -7,16 +9,24 @@ import pandas as pd
 from sklearn.linear_model import LinearRegression
 
 from jhdsfinder.names import *
-from jhdsfinder import utils
+from jhdsfinder import utils, kernels, panel
 from jhdsfinder.dataframe import *
 from jhdsfinder.jpx import load_market_dataframe
-from jhdsfinder.irbank import load_fy_all_dataframe, get_fy_all_csv_filepath
+from jhdsfinder.irbank import (
+    load_fy_all_dataframe,
+    get_fy_all_csv_filepath,
+    load_dirty_company_codes,
+    clear_dirty_company_codes,
+)
 from jhdsfinder.mujinzou import load_stock_price_dataframe, get_stock_price_csv_filepath
 
 
-def get_gradient(x: np.ndarray, y: np.ndarray) -> float:
+def get_gradient(x: np.ndarray, y: np.ndarray, batch_kernel: bool = False) -> float:
     if len(x) == 0 or len(y) == 0:
         return np.nan
+    if batch_kernel:
+        mask = np.ones((1, len(x)), dtype=bool)
+        return kernels.get_gradients(x[None].astype(float), y[None], mask).item()
     reg = LinearRegression().fit(x.reshape(-1, 1), y)
     gradient = reg.coef_.item()
     assert isinstance(gradient, float), gradient
@@ -32,7 +42,9 @@ def get_average(x: np.ndarray, calc_years: int) -> float:
         return np.average(x[-calc_years:])
 
 
-def remove_outliers_mad(years: np.ndarray, x: np.ndarray, thresh=3.5):
+def remove_outliers_mad(
+    years: np.ndarray, x: np.ndarray, thresh=kernels.MAD_THRESH, batch_kernel=False
+):
     """
     https://www.ibm.com/docs/ja/cognos-analytics/11.1.0?topic=terms-modified-z-score
     """
@@ -41,14 +53,18 @@ def remove_outliers_mad(years: np.ndarray, x: np.ndarray, thresh=3.5):
     x = x[~nan_bool]
     if len(x) < 3:
         return years, x
+    if batch_kernel:
+        mask = np.ones((1, len(x)), dtype=bool)
+        bool_array = kernels.remove_outliers_mad(x[None], mask, thresh)[0]
+        return years[bool_array], x[bool_array]
     median = np.median(x)
     absolute_deviation = np.abs(x - median)
     median_ad = np.median(absolute_deviation)
     if median_ad == 0.0:
         mean_ad = np.mean(absolute_deviation)
-        modified_z_score = (x - median) / (1.253314 * mean_ad + 1e-8)
+        modified_z_score = (x - median) / (kernels.MEAN_AD_SCALE * mean_ad + 1e-8)
     else:
-        modified_z_score = (x - median) / (1.486 * median_ad)
+        modified_z_score = (x - median) / (kernels.MEDIAN_AD_SCALE * median_ad)
 
     bool_array = np.abs(modified_z_score) < thresh
     years = years[bool_array]
@@ -57,6 +73,9 @@ def remove_outliers_mad(years: np.ndarray, x: np.ndarray, thresh=3.5):
 
 
 class CompanyData:
+    # Trueの場合は外れ値除去と傾きの計算に一括計算用のカーネルを使う
+    batch_kernel = False
+
     def __init__(
         self,
         company_code: str,
@@ -70,6 +89,7 @@ class CompanyData:
         scale_category: str,
         stock_price: float,
         df: DataFrame,
+        finance_panel: panel.FinancePanel = None,
     ) -> None:
         self.company_code = company_code
         self.company_name = company_name
@@ -83,8 +103,18 @@ class CompanyData:
         self.company_code = company_code
         self.stock_price = stock_price
         self.df = df
-        self.columns = self.df.columns.values.tolist()
-        self.year = self.df[FISCAL_YEAR].values[-1]
+        self.finance_panel = finance_panel
+        # カラムごとの計算結果のキャッシュ
+        self.values_cache = {}
+        self.performance_cache = {}
+        if self.df is None:
+            # FinancePanelだけから作る場合
+            assert self.finance_panel is not None
+            self.columns = [COMPANY_CODE, FISCAL_YEAR] + self.finance_panel.columns
+            self.year = self.finance_panel.get_latest_year(company_code)
+        else:
+            self.columns = self.df.columns.values.tolist()
+            self.year = self.df[FISCAL_YEAR].values[-1]
 
     def __str__(self):
         dy = "{:.3g}".format(self.get_dividend_yield())
@@ -122,12 +152,47 @@ class CompanyData:
             per = self.stock_price / eps[-1]
             return per
 
+    def get_raw_values(self, columns: list) -> Tuple[np.ndarray, np.ndarray]:
+        """欠損値のある年度を除いた年度と値の配列 (外れ値は除去しない)"""
+        if self.finance_panel is None:
+            _df = self.df.loc[:, [FISCAL_YEAR] + columns].astype(float).dropna()
+            years = _df[FISCAL_YEAR].values.astype(int)
+            values = _df[columns].values.astype(float)
+        else:
+            # FinancePanelのビューから読み込む
+            company_values = self.finance_panel.get_company_values(self.company_code)
+            column_idx = [self.finance_panel.column_index[c] for c in columns]
+            values = company_values[:, column_idx].astype(float)
+            bool_array = ~np.isnan(values).any(axis=1)
+            years = self.finance_panel.fiscal_years[bool_array]
+            values = values[bool_array]
+        return years, values
+
+    def get_cached_values(
+        self, key: str, make_values: Callable[[], Tuple[np.ndarray, np.ndarray]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        外れ値除去後の (年度, 値) をメモ化する
+        返す配列は共有されるので書き込み不可にしておく
+        """
+        cache_key = (key, self.batch_kernel)
+        if cache_key not in self.values_cache:
+            years, values = make_values()
+            years.setflags(write=False)
+            values.setflags(write=False)
+            self.values_cache[cache_key] = (years, values)
+        return self.values_cache[cache_key]
+
     def get_values(self, column: list) -> Tuple[np.ndarray, np.ndarray]:
         assert column in self.columns, column
-        _df = self.df.loc[:, [FISCAL_YEAR, column]].astype(float).dropna()
-        years = _df[FISCAL_YEAR].values.astype(int)
-        values = _df[column].values.astype(float)
-        years, values = remove_outliers_mad(years, values)
+        return self.get_cached_values(column, lambda: self.make_values(column))
+
+    def make_values(self, column: list) -> Tuple[np.ndarray, np.ndarray]:
+        years, values = self.get_raw_values([column])
+        values = values[:, 0]
+        years, values = remove_outliers_mad(
+            years, values, batch_kernel=self.batch_kernel
+        )
         assert_text = f"len(years)={len(years)}, len(values)={len(values)}"
         assert len(years) == len(values), assert_text
         return years, values
@@ -229,21 +294,24 @@ class CompanyData:
 
     def get_continuous_dividend_years(self):
         """配当継続年数"""
+        return self.get_cached_values(
+            "continuous_dividend_years", self.make_continuous_dividend_years
+        )
+
+    def make_continuous_dividend_years(self):
         columns = [
-            FISCAL_YEAR,
             NET_ASSETS,  # 純資産
             RETAINED_EARNINGS,  # 利益剰余金
             NET_ASSETS_PAYOUT_RATIO,  # 純資産配当率
         ]
-        _df = self.df.loc[:, columns].astype(float).dropna()
-        years = _df[FISCAL_YEAR].values.astype(int)
-        net_accets = _df[NET_ASSETS].values
-        retained_earnings = _df[RETAINED_EARNINGS].values
-        net_accets_payout_ratio = _df[NET_ASSETS_PAYOUT_RATIO].values
+        years, values = self.get_raw_values(columns)
+        net_accets = values[:, 0]
+        retained_earnings = values[:, 1]
+        net_accets_payout_ratio = values[:, 2]
         total_dividends = net_accets * net_accets_payout_ratio / 100
         continuous_dividen_years = retained_earnings / (total_dividends + 1e-8)
         years, continuous_dividen_years = remove_outliers_mad(
-            years, continuous_dividen_years
+            years, continuous_dividen_years, batch_kernel=self.batch_kernel
         )
         return years, continuous_dividen_years
 
@@ -251,32 +319,40 @@ class CompanyData:
         """
         流動比率の概算 (現金等/短期借入金*100)
         """
+        return self.get_cached_values("current_ratio", self.make_current_ratio)
+
+    def make_current_ratio(self):
         columns = [
-            FISCAL_YEAR,
             SHORT_TERM_DEBT,  # 短期借入金
             CASH_EQUIVALENTS,  # 現金同等物
         ]
-        _df = self.df.loc[:, columns].astype(float).dropna()
-        years = _df[FISCAL_YEAR].values.astype(int)
-        shor_term_debt = _df[SHORT_TERM_DEBT].values
-        cash_equivalents = _df[CASH_EQUIVALENTS].values
+        years, values = self.get_raw_values(columns)
+        shor_term_debt = values[:, 0]
+        cash_equivalents = values[:, 1]
         current_ratio = cash_equivalents / (shor_term_debt + 1e-8) * 100
-        years, current_ratio = remove_outliers_mad(years, current_ratio)
+        years, current_ratio = remove_outliers_mad(
+            years, current_ratio, batch_kernel=self.batch_kernel
+        )
         return years, current_ratio
 
     def get_total_assets_cash_ratio(self):
         """総資産現金率"""
+        return self.get_cached_values(
+            "total_assets_cash_ratio", self.make_total_assets_cash_ratio
+        )
+
+    def make_total_assets_cash_ratio(self):
         columns = [
-            FISCAL_YEAR,
             TOTAL_ASSETS,  # 総資産
             CASH_EQUIVALENTS,  # 現金同等物
         ]
-        _df = self.df.loc[:, columns].astype(float).dropna()
-        years = _df[FISCAL_YEAR].values.astype(int)
-        total_assets = _df[TOTAL_ASSETS].values
-        cash_equivalents = _df[CASH_EQUIVALENTS].values
+        years, values = self.get_raw_values(columns)
+        total_assets = values[:, 0]
+        cash_equivalents = values[:, 1]
         cash_ratio = cash_equivalents / (total_assets + 1e-8) * 100
-        years, cash_ratio = remove_outliers_mad(years, cash_ratio)
+        years, cash_ratio = remove_outliers_mad(
+            years, cash_ratio, batch_kernel=self.batch_kernel
+        )
         return years, cash_ratio
 
     def is_dividend_increase_continuous(self) -> bool:
@@ -287,6 +363,13 @@ class CompanyData:
             return all(divs[i] <= divs[i + 1] for i in range(len(divs) - 1))
 
     def get_long_term_performance(self, calc_years: int = 3) -> pd.Series:
+        cache_key = (calc_years, self.batch_kernel)
+        if cache_key not in self.performance_cache:
+            series = self.make_long_term_performance(calc_years)
+            self.performance_cache[cache_key] = series
+        return self.performance_cache[cache_key]
+
+    def make_long_term_performance(self, calc_years: int = 3) -> pd.Series:
         # 配当利回り
         dividend_yield = self.get_dividend_yield()
         # 連続増配
@@ -294,22 +377,26 @@ class CompanyData:
         # 上昇傾向のトレンド
         ## 売上
         years, revenues = self.get_revenues()
-        revenue_grad = get_gradient(years, revenues)
+        revenue_grad = get_gradient(years, revenues, self.batch_kernel)
         ## EPS
         years, eps = self.get_EPS()
-        eps_grad = get_gradient(years, eps)
+        eps_grad = get_gradient(years, eps, self.batch_kernel)
         ## BPS
         years, bps = self.get_BPS()
-        bps_grad = get_gradient(years, bps)
+        bps_grad = get_gradient(years, bps, self.batch_kernel)
         ## 1株配当
         years, dividend_per_share = self.get_dividend_per_share()
-        dividend_per_share_grad = get_gradient(years, dividend_per_share)
+        dividend_per_share_grad = get_gradient(
+            years, dividend_per_share, self.batch_kernel
+        )
         ## 営業CF
         years, operating_cash_flows = self.get_operating_cash_flow()
-        operating_cash_flows_grad = get_gradient(years, operating_cash_flows)
+        operating_cash_flows_grad = get_gradient(
+            years, operating_cash_flows, self.batch_kernel
+        )
         ## 現金
         years, cash_equivalents = self.get_cash_equivalents()
-        cash_equivalents_grad = get_gradient(years, cash_equivalents)
+        cash_equivalents_grad = get_gradient(years, cash_equivalents, self.batch_kernel)
 
         # 中長期の平均業績
         ## 営業CF
@@ -380,7 +467,66 @@ class CompanyData:
         return self.year
 
 
+def make_company_performance_shard(
+    panel_spec: dict,
+    company_codes: List[str],
+    company_records: np.ndarray,
+    stock_prices: np.ndarray,
+    calc_years: int = 3,
+) -> CompanyPerformanceDataFrame:
+    """
+    共有メモリのFinancePanelを参照して, 一部の銘柄の業績を計算する
+    (ProcessPoolExecutorのワーカーで実行する)
+    """
+    finance_panel, shm = panel.FinancePanel.from_shared_memory(panel_spec)
+    try:
+        data = []
+        for company_code, record, stock_price in zip(
+            company_codes, company_records, stock_prices
+        ):
+            company_data = CompanyData(
+                company_code, *record, float(stock_price), None, finance_panel
+            )
+            company_performance = company_data.get_long_term_performance(calc_years)
+            data.append(company_performance.values[None])
+            del company_data
+        data = np.concatenate(data, axis=0)
+        columns = company_performance.index.tolist()
+    finally:
+        # 共有メモリを閉じる前に配列への参照を外す
+        del finance_panel
+        try:
+            shm.close()
+        except BufferError:
+            # 計算中の例外で配列が参照されたままの場合はプロセス終了時に解放される
+            pass
+    df = pd.DataFrame(data, columns=columns)
+    return CompanyPerformanceDataFrame(df)
+
+
+# 並列計算で1プロセスあたりに割り当てる銘柄の分割数
+PERFORMANCE_SHARDS_PER_WORKER = 4
+
+# CompanyDataに渡す市場データのカラム
+COMPANY_RECORD_COLUMNS = [
+    COMPANY_NAME,
+    MARKET_CATEGORY,
+    INDUSTRY_CODE_33,
+    INDUSTRY_CATEGORY_33,
+    INDUSTRY_CODE_17,
+    INDUSTRY_CATEGORY_17,
+    SCALE_CODE,
+    SCALE_CATEGORY,
+]
+
+
 class FinanceData:
+    # 保持するCompanyDataの最大数
+    company_data_cache_size = 256
+    # 事前に計算しておく平均値の期間 (-1は全期間)
+    calc_years_list = CALC_YEARS_LIST
+    # 既定の平均値の期間
+    calc_years = 3
 
     def __init__(self):
         # データフレームの読み込み
@@ -396,27 +542,87 @@ class FinanceData:
             stock_price_df[COMPANY_CODE].values.astype(str),
         ).tolist()
         self.market_df = market_df[market_df[COMPANY_CODE].isin(self.company_codes)]
-        self.fy_all_df = fy_all_df[fy_all_df[COMPANY_CODE].isin(self.company_codes)]
+        # 銘柄ごとの行が連続するように銘柄コードで並び替える (銘柄内の行順は保つ)
+        self.fy_all_df = fy_all_df[
+            fy_all_df[COMPANY_CODE].isin(self.company_codes)
+        ].sort_values(by=COMPANY_CODE, kind="stable")
         self.stock_price_df = stock_price_df[
             stock_price_df[COMPANY_CODE].isin(self.company_codes)
         ]
-        self.performance_df = self.load_company_performance_dataframe()
+        self.make_company_index()
+        self.clear_company_data_cache()
+        # (銘柄, 年度, カラム) の配列
+        self.finance_panel = panel.FinancePanel(self.fy_all_df, self.company_codes)
+        # 平均値を計算する期間ごとの業績
+        self.performance_dfs = self.load_company_performance_dataframes(
+            self.calc_years_list
+        )
+        self.performance_df = self.performance_dfs[self.calc_years]
+
+    def make_company_index(self):
+        """銘柄コードから各データの位置を引くための索引を作る"""
+        self.company_index = {code: i for i, code in enumerate(self.company_codes)}
+        # 市場データ (company_codesの順番に揃える)
+        market_df = self.market_df.drop_duplicates(subset=COMPANY_CODE)
+        self.company_records = (
+            market_df.set_index(COMPANY_CODE)
+            .loc[self.company_codes, COMPANY_RECORD_COLUMNS]
+            .values
+        )
+        # 株価
+        stock_price_df = self.stock_price_df.drop_duplicates(subset=COMPANY_CODE)
+        self.stock_prices = (
+            stock_price_df.set_index(COMPANY_CODE)
+            .loc[self.company_codes, CLOSE_PRICE]
+            .values.astype(float)
+        )
+        # fy-data-allの銘柄ごとの行の範囲
+        codes = self.fy_all_df[COMPANY_CODE].values.astype(str)
+        self.fy_starts = np.searchsorted(codes, self.company_codes, side="left")
+        self.fy_stops = np.searchsorted(codes, self.company_codes, side="right")
+
+    def clear_company_data_cache(self):
+        self.company_data_cache = OrderedDict()
+        self.company_data_cache_hits = 0
+        self.company_data_cache_misses = 0
+
+    def get_company_data_cache_info(self) -> dict:
+        return {
+            "hits": self.company_data_cache_hits,
+            "misses": self.company_data_cache_misses,
+            "size": len(self.company_data_cache),
+            "max_size": self.company_data_cache_size,
+        }
 
     def get_company_data(self, company_code: str, debug=False) -> CompanyData:
-        assert company_code in self.company_codes, company_code
-        idx = self.market_df[self.market_df[COMPANY_CODE] == company_code].index.item()
-        company_name = self.market_df.loc[idx, COMPANY_NAME]
-        market_category = self.market_df.loc[idx, MARKET_CATEGORY]
-        industry_code_33 = self.market_df.loc[idx, INDUSTRY_CODE_33]
-        industry_category_33 = self.market_df.loc[idx, INDUSTRY_CATEGORY_33]
-        industry_code_17 = self.market_df.loc[idx, INDUSTRY_CODE_17]
-        industry_category_17 = self.market_df.loc[idx, INDUSTRY_CATEGORY_17]
-        scale_code = self.market_df.loc[idx, SCALE_CODE]
-        scale_category = self.market_df.loc[idx, SCALE_CATEGORY]
-        stock_price = self.stock_price_df[
-            self.stock_price_df[COMPANY_CODE] == company_code
-        ][CLOSE_PRICE].item()
-        df = self.fy_all_df[self.fy_all_df[COMPANY_CODE] == company_code]
+        # 最近使ったCompanyDataはキャッシュから返す
+        if company_code in self.company_data_cache:
+            self.company_data_cache_hits += 1
+            self.company_data_cache.move_to_end(company_code)
+            return self.company_data_cache[company_code]
+        self.company_data_cache_misses += 1
+        company_data = self.make_company_data(company_code, debug)
+        if company_data is not None:
+            self.company_data_cache[company_code] = company_data
+            if len(self.company_data_cache) > self.company_data_cache_size:
+                self.company_data_cache.popitem(last=False)
+        return company_data
+
+    def make_company_data(self, company_code: str, debug=False) -> CompanyData:
+        i = self.company_index.get(company_code)
+        assert i is not None, company_code
+        (
+            company_name,
+            market_category,
+            industry_code_33,
+            industry_category_33,
+            industry_code_17,
+            industry_category_17,
+            scale_code,
+            scale_category,
+        ) = self.company_records[i]
+        stock_price = float(self.stock_prices[i])
+        df = self.fy_all_df.iloc[self.fy_starts[i] : self.fy_stops[i]]
         try:
             company_data = CompanyData(
                 company_code,
@@ -430,6 +636,7 @@ class FinanceData:
                 scale_category,
                 stock_price,
                 df,
+                self.finance_panel,
             )
             return company_data
         except Exception as e:
@@ -444,37 +651,271 @@ class FinanceData:
         return self.market_df[COMPANY_NAME].values.tolist()
 
     def make_company_pefomance_dataframe(
-        self, calc_years: int = 3
+        self,
+        calc_years: int = 3,
+        vectorized: bool = True,
+        n_workers: int = 1,
+        callback: Callable[[int, int], None] = None,
     ) -> CompanyPerformanceDataFrame:
+        """
+        vectorized=Falseの場合は銘柄ごとにCompanyDataで計算する
+        n_workers>1の場合は銘柄をプロセスに分けて並列に計算する
+        callbackには (計算済みの銘柄数, 全銘柄数) が渡される
+        """
+        n_total = len(self.company_codes)
+        if vectorized:
+            # 全銘柄を配列で一括計算する (進捗は開始時と完了時だけ通知する)
+            if callback:
+                callback(0, n_total)
+            df = panel.make_company_performance_dataframe(
+                self.finance_panel,
+                self.market_df,
+                self.stock_price_df,
+                calc_years,
+            )
+            if callback:
+                callback(n_total, n_total)
+            return df
+        if n_workers is None or n_workers > 1:
+            return self.make_company_pefomance_dataframe_parallel(
+                calc_years, n_workers, callback
+            )
         data = []
         print("Making ComapanyPerformancesDataFrame ...")
-        for company_code in tqdm(self.company_codes):
-            company_data = self.get_company_data(company_code)
+        company_codes = self.company_codes if callback else tqdm(self.company_codes)
+        for i, company_code in enumerate(company_codes):
+            company_data = self.make_company_data(company_code)
             company_performance = company_data.get_long_term_performance(calc_years)
             data.append(company_performance.values[None])
+            if callback:
+                callback(i + 1, n_total)
         data = np.concatenate(data, axis=0)
         columns = company_performance.index.tolist()
         df = pd.DataFrame(data, columns=columns)
         return CompanyPerformanceDataFrame(df)
 
-    def load_company_performance_dataframe(self, calc_years=3, force_update=False):
-        self.performance_csv_path = os.path.join(DATA_DIRNAME, PERFORMANCE_CSV_FILENAME)
-        update_flag = utils.get_update_flag(
-            self.performance_csv_path, update_frequency_days=1
-        )
-        if update_flag or force_update:
-            performance_df = self.make_company_pefomance_dataframe(calc_years)
-            performance_df.to_csv(self.performance_csv_path)
-        else:
-            performance_df = CompanyPerformanceDataFrame.from_csv(
-                self.performance_csv_path
+    def make_company_pefomance_dataframe_parallel(
+        self,
+        calc_years: int = 3,
+        n_workers: int = None,
+        callback: Callable[[int, int], None] = None,
+    ) -> CompanyPerformanceDataFrame:
+        """
+        銘柄コードを分割してProcessPoolExecutorで計算する
+        FinancePanelの値は共有メモリで一度だけ渡し, 各プロセスにはコピーしない
+        """
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        n_total = len(self.company_codes)
+        n_shards = min(n_total, n_workers * PERFORMANCE_SHARDS_PER_WORKER)
+        shards = np.array_split(np.arange(n_total), max(n_shards, 1))
+        print("Making ComapanyPerformancesDataFrame ...")
+        progress_bar = None if callback else tqdm(total=n_total)
+        shm, panel_spec = self.finance_panel.to_shared_memory()
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [
+                    executor.submit(
+                        make_company_performance_shard,
+                        panel_spec,
+                        [self.company_codes[i] for i in shard],
+                        self.company_records[shard],
+                        self.stock_prices[shard],
+                        calc_years,
+                    )
+                    for shard in shards
+                ]
+                # 進捗は終わった順に, 結果は銘柄コードの順に並べる
+                n_done = 0
+                future_sizes = {
+                    future: len(shard) for future, shard in zip(futures, shards)
+                }
+                for future in as_completed(futures):
+                    n_done += future_sizes[future]
+                    if callback:
+                        callback(n_done, n_total)
+                    else:
+                        progress_bar.update(future_sizes[future])
+                dfs = [future.result() for future in futures]
+        finally:
+            if progress_bar is not None:
+                progress_bar.close()
+            shm.close()
+            shm.unlink()
+        df = pd.concat(dfs, axis=0, ignore_index=True)
+        return CompanyPerformanceDataFrame(df)
+
+    def get_fundamentals_csv_path(self, calc_years=3) -> str:
+        basename = FUNDAMENTALS_CSV_FILENAME.split(".")[0]
+        return os.path.join(DATA_DIRNAME, f"{basename}_{calc_years}.csv")
+
+    def load_company_fundamentals_dataframes(
+        self, calc_years_list=[3], force_update=False
+    ) -> Dict[int, CompanyFundamentalsDataFrame]:
+        """
+        株価を使わない指標はfy-data-allが更新されたときだけ作り直す
+        行が変わった銘柄が記録されている場合はその銘柄だけを計算し直す
+        作り直す期間の指標はまとめて一度に計算する
+        """
+        fundamentals_dfs = {}
+        fresh_dfs = {}
+        stale_calc_years_list = []
+        for calc_years in calc_years_list:
+            fundamentals_csv_path = self.get_fundamentals_csv_path(calc_years)
+            update_flag = utils.is_older_file(
+                fundamentals_csv_path, get_fy_all_csv_filepath()
+            )
+            if update_flag or force_update:
+                stale_calc_years_list.append(calc_years)
+            else:
+                fresh_dfs[calc_years] = CompanyFundamentalsDataFrame.from_csv(
+                    fundamentals_csv_path
+                )
+        if len(fresh_dfs) > 0:
+            # 株価の銘柄は毎日変わるので今の銘柄に揃え, 足りない銘柄だけを計算する
+            fundamentals_dfs.update(
+                self.update_company_fundamentals_dataframes(fresh_dfs, [])
+            )
+        if len(stale_calc_years_list) == 0:
+            return fundamentals_dfs
+        dirty_company_codes = load_dirty_company_codes()
+        cached_dfs = {}
+        if not force_update and dirty_company_codes is not None:
+            for calc_years in stale_calc_years_list:
+                fundamentals_csv_path = self.get_fundamentals_csv_path(calc_years)
+                if os.path.exists(fundamentals_csv_path):
+                    cached_dfs[calc_years] = CompanyFundamentalsDataFrame.from_csv(
+                        fundamentals_csv_path
+                    )
+        if len(cached_dfs) > 0:
+            fundamentals_dfs.update(
+                self.update_company_fundamentals_dataframes(
+                    cached_dfs, dirty_company_codes
+                )
+            )
+        rebuild_calc_years_list = [
+            calc_years
+            for calc_years in stale_calc_years_list
+            if calc_years not in cached_dfs
+        ]
+        if len(rebuild_calc_years_list) > 0:
+            fundamentals_dfs.update(
+                panel.make_company_fundamentals_dataframes(
+                    self.finance_panel, self.market_df, rebuild_calc_years_list
+                )
+            )
+        for calc_years in stale_calc_years_list:
+            fundamentals_csv_path = self.get_fundamentals_csv_path(calc_years)
+            fundamentals_dfs[calc_years].to_csv(fundamentals_csv_path)
+        # 事前に計算する全ての期間の指標に反映したら記録を消す
+        csv_paths = [
+            self.get_fundamentals_csv_path(calc_years) for calc_years in CALC_YEARS_LIST
+        ]
+        if not any(
+            utils.is_older_file(path, get_fy_all_csv_filepath()) for path in csv_paths
+        ):
+            clear_dirty_company_codes()
+        return fundamentals_dfs
+
+    def update_company_fundamentals_dataframes(
+        self, fundamentals_dfs: Dict[int, DataFrame], company_codes: list
+    ) -> Dict[int, CompanyFundamentalsDataFrame]:
+        """
+        指定した銘柄と新しく追加された銘柄だけを計算し直して差し替える
+        """
+        fundamentals_dfs = {
+            calc_years: fundamentals_df.drop_duplicates(subset=COMPANY_CODE).set_index(
+                COMPANY_CODE
+            )
+            for calc_years, fundamentals_df in fundamentals_dfs.items()
+        }
+        dirty_company_codes = np.intersect1d(company_codes, self.company_codes)
+        for fundamentals_df in fundamentals_dfs.values():
+            new_company_codes = np.setdiff1d(
+                self.company_codes, fundamentals_df.index.values.astype(str)
+            )
+            dirty_company_codes = np.union1d(dirty_company_codes, new_company_codes)
+        dirty_company_codes = dirty_company_codes.tolist()
+        if len(dirty_company_codes) > 0:
+            print(f"Updating {len(dirty_company_codes)} companies ...")
+        dirty_dfs = {}
+        if len(dirty_company_codes) > 0:
+            dirty_dfs = panel.make_company_fundamentals_dataframes(
+                self.finance_panel.take(dirty_company_codes),
+                self.market_df[self.market_df[COMPANY_CODE].isin(dirty_company_codes)],
+                list(fundamentals_dfs.keys()),
             )
-        return performance_df
+        for calc_years, fundamentals_df in fundamentals_dfs.items():
+            if calc_years in dirty_dfs:
+                fundamentals_df = pd.concat(
+                    [
+                        fundamentals_df.drop(
+                            index=dirty_company_codes, errors="ignore"
+                        ),
+                        dirty_dfs[calc_years].set_index(COMPANY_CODE),
+                    ],
+                    axis=0,
+                )
+            fundamentals_df = fundamentals_df.reindex(self.company_codes)
+            fundamentals_df.index.name = COMPANY_CODE
+            fundamentals_df.reset_index(inplace=True)
+            fundamentals_dfs[calc_years] = CompanyFundamentalsDataFrame(fundamentals_df)
+        return fundamentals_dfs
+
+    def load_company_performance_dataframes(
+        self, calc_years_list=[3], force_update=False
+    ) -> Dict[int, CompanyPerformanceDataFrame]:
+        """
+        株価を使う指標 (配当利回り, PER, PBR) は毎回株価と結合して計算する
+        """
+        self.fundamentals_dfs = self.load_company_fundamentals_dataframes(
+            calc_years_list, force_update
+        )
+        performance_dfs = {
+            calc_years: self.join_stock_price(fundamentals_df)
+            for calc_years, fundamentals_df in self.fundamentals_dfs.items()
+        }
+        return performance_dfs
+
+    def join_stock_price(
+        self, fundamentals_df: CompanyFundamentalsDataFrame
+    ) -> CompanyPerformanceDataFrame:
+        """株価を使う指標を計算し, 業種内のパーセンタイルを追加する"""
+        performance_df = panel.join_stock_price(fundamentals_df, self.stock_price_df)
+        return panel.add_industry_percentile_columns(performance_df)
+
+    def refresh_stock_price(self, force_update=False) -> CompanyPerformanceDataFrame:
+        """
+        株価だけを読み直して株価を使う指標を再計算する (財務データは計算し直さない)
+        """
+        update_frequency_days = 0 if force_update else 1
+        stock_price_df = load_stock_price_dataframe(update_frequency_days)
+        self.stock_price_df = stock_price_df[
+            stock_price_df[COMPANY_CODE].isin(self.company_codes)
+        ]
+        stock_price_df = self.stock_price_df.drop_duplicates(subset=COMPANY_CODE)
+        self.stock_prices = (
+            stock_price_df.set_index(COMPANY_CODE)[CLOSE_PRICE]
+            .reindex(self.company_codes)
+            .values.astype(float)
+        )
+        # CompanyDataは株価を保持しているので作り直す
+        self.clear_company_data_cache()
+        self.performance_dfs = {
+            calc_years: self.join_stock_price(fundamentals_df)
+            for calc_years, fundamentals_df in self.fundamentals_dfs.items()
+        }
+        self.performance_df = self.performance_dfs[self.calc_years]
+        return self.performance_df
 
     def make_screened_company_dataframe(self):
         df = self.market_df.loc[:, [COMPANY_CODE, COMPANY_NAME]]
+        # 業績は銘柄コードで対応させる
+        performance_df = self.performance_df.drop_duplicates(
+            subset=COMPANY_CODE
+        ).set_index(COMPANY_CODE)
         for col in [DIVIDEND_YIELD, PER, PBR]:
-            df[col] = self.performance_df[col].values
+            df[col] = performance_df[col].reindex(df[COMPANY_CODE]).values
             df[col] = df[col].astype(float).round(2)
         df = df.loc[:, [COMPANY_CODE, COMPANY_NAME, DIVIDEND_YIELD, PER, PBR]]
         return df
@@ -485,14 +926,35 @@ class FinanceData:
     def get_finance_all_dataframe(self):
         return self.fy_all_df
 
+    def get_finance_panel(self) -> panel.FinancePanel:
+        return self.finance_panel
+
     def get_stock_price_dataframe(self):
         return self.stock_price_df
 
-    def get_company_performance_dataframe(self):
-        return self.performance_df
+    def get_company_performance_dataframe(
+        self, calc_years: int = None
+    ) -> CompanyPerformanceDataFrame:
+        if calc_years is None:
+            return self.performance_df
+        return self.performance_dfs[calc_years]
+
+    def get_company_performance(
+        self, company_code: str, calc_years: int = None
+    ) -> pd.Series:
+        """
+        事前に計算した業績を返す (get_long_term_performanceと同じ形式)
+        業績の行はcompany_codesの順に並んでいるので索引で引く
+        """
+        performance_df = self.get_company_performance_dataframe(calc_years)
+        i = self.company_index.get(company_code)
+        if i is None:
+            raise KeyError(company_code)
+        return performance_df.iloc[i]
 
 
 if __name__ == "__main__":
+    utils.init_http_cache()
     code = "2914"  # JT
     fy_data = FinanceData()
     company_data = fy_data.get_company_data(code, True)
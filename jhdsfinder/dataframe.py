@@ -125,6 +125,34 @@ class CompanyPerformanceDataFrame(DataFrame):
         self.sort_values(by=COMPANY_CODE, inplace=False)
 
 
+class CompanyFundamentalsDataFrame(DataFrame):
+    """
+    企業業績のうち株価を使わない指標 (fy-data-allが更新されたときだけ作り直す)
+    """
+
+    DTYPES = {
+        COMPANY_CODE: str,
+        REVENUE_GRAD: float,
+        EPS_GRAD: float,
+        BPS_GRAD: float,
+        DIVIDEND_PER_SHARE_GRAD: float,
+        OPERATING_CASH_FLOW_GRAD: float,
+        CASH_EQUIVALENTS_GRAD: float,
+        OPERATING_PROFIT_MARGIN_AVG: float,
+        EQUITY_RATIO_AVG: float,
+        DIVIDEND_PAYOUT_RATIO_AVG: float,
+        ROE_AVG: float,
+        ROA_AVG: float,
+        LATEST_DIVIDEND_PER_SHARE: float,
+        LATEST_EPS: float,
+        LATEST_BPS: float,
+    }
+
+    def __init__(self, data, *args, **kwargs) -> None:
+        super().__init__(data, *args, **kwargs)
+        self[COMPANY_CODE] = self[COMPANY_CODE].astype(str)
+
+
 class MarketDataFrame(DataFrame):
     DTYPES = {
         DATE: str,  # "日付"
@@ -335,7 +335,7 @@ class CompanyInformation(Component):
         company_name = company_data.company_name
         industry_category = company_data.industry_category_33
         scale_category = company_data.scale_category
-        series = company_data.get_long_term_performance(calc_years=1)
+        series = self.finance_data.get_company_performance(company_code, calc_years=1)
         stock_price = value_to_label(company_data.stock_price, "円", "{:.1f}")
         years, dividend_per_shares = company_data.get_dividend_per_share()
         dividend_per_share = value_to_label(dividend_per_shares[-1], "円", "{:.1f}")
@@ -39,6 +39,17 @@ class ComponentQPushButton(Component, QPushButton):
         self.send_event(self._event)
 
 
+class ComponentQComboBox(Component, QComboBox):
+    def __init__(self, parent: QWidget, mediator: Mediator, event=None):
+        super().__init__(mediator)
+        QComboBox.__init__(self, parent)
+        self._event = event
+        self.currentIndexChanged.connect(self.comboBoxIndexChanged)
+
+    def comboBoxIndexChanged(self, index):
+        self.send_event(self._event)
+
+
 class ComponentQLineEdit(Component, QLineEdit):
     def __init__(self, parent: QWidget, mediator: Mediator, event=None):
         super().__init__(mediator)
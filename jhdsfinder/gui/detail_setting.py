@@ -5,6 +5,7 @@ from PyQt6.QtCore import *
 
 from jhdsfinder.gui.abstract import *
 from jhdsfinder.screener import *
+from jhdsfinder import query
 from jhdsfinder.gui.components import *
 from jhdsfinder.gui.events import Event
 
@@ -49,14 +50,47 @@ class DetailSettingPushButton(ComponentQPushButton):
 
 
 class DetailSettingLineEdit(ComponentQLineEdit):
+    _placeholder_text = (
+        f"例: {DIVIDEND_YIELD} >= 4 and {PER} < 12"
+        f" and {INDUSTRY_CATEGORY_33} in [{BANKING}, {INSURANCE}]"
+    )
+    _error_style_sheet = "color: red"
+
     def __init__(
         self,
         parent: QWidget,
         mediator: Mediator,
     ):
-        super().__init__(parent, mediator)
+        super().__init__(parent, mediator, Event.DETAIL_SETTING_CONDITION_CHANGED)
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.setPlaceholderText(self._placeholder_text)
         self.setEnabled(False)
+        self.conditions = Conditions([])
+        self.textEdited.connect(self.lineEditTextEdited)
+
+    def lineEditTextEdited(self, text: str):
+        # 解析できる式になったときだけ条件を更新する
+        try:
+            conditions = make_query_conditions(text)
+        except query.QuerySyntaxError as e:
+            self.setStyleSheet(self._error_style_sheet)
+            self.setToolTip(str(e))
+            return
+        self.setStyleSheet("")
+        self.setToolTip("")
+        self.conditions = conditions
+        self.send_event(self._event)
+
+    def get_conditions(self) -> Conditions:
+        return self.conditions
+
+    def receive_event(self, event):
+        if event == Event.DETAIL_SETTING_CHECKED:
+            self.setEnabled(True)
+        elif event == Event.DETAIL_SETTING_UNCHECKED:
+            self.setEnabled(False)
+        else:
+            pass
 
 
 class DetailSetting(Component):
@@ -90,8 +124,19 @@ class DetailSetting(Component):
         self.settingVBoxLayout.addWidget(self.lineEdit)
 
         # 開発途中
-        self.checkBox.setEnabled(False)
         self.pushButton.setEnabled(False)
 
     def get_conditions(self):
+        return self.lineEdit.get_conditions()
+
+    def receive_event(self, event):
+        if event in Event.GETTING_DETAIL_CONDITION_EVENTS:
+            conditions = self.get_conditions()
+            self.mediator.set_screened_company_codes(conditions)
+
+
+def make_query_conditions(text: str) -> Conditions:
+    # 空の式はスクリーニングしない
+    if text.strip() == "":
         return Conditions([])
+    return Conditions([QueryCondition(text)])
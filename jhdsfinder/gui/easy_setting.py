@@ -9,7 +9,6 @@ from jhdsfinder.gui.components import *
 from jhdsfinder.gui.events import Event
 from jhdsfinder.gui import utils
 
-
 UPWARD_TREND = "右肩上がり"
 UNDER_RANGE = "XX%以下"
 UPPER_RANGE = "XX%以上"
@@ -66,6 +65,7 @@ class RangeConditionItem(Component):
         self.lineEdit.returnPressed.connect(
             self.lineEditTextChanged
         )  # TODO: 例外に対処する必要あり
+        self.lineEdit.textEdited.connect(self.lineEditTextEdited)
 
     def get_check_box_text(self):
         thres = self.get_threshold()
@@ -96,6 +96,21 @@ class RangeConditionItem(Component):
             self.lineEdit.setText(str(self.default_value))
             utils.show_warning_popup(self.parent, msg)
 
+    def set_threshold(self, thres: float):
+        self.lineEdit.setText(str(thres))
+        self.lineEditTextChanged()
+
+    def lineEditTextEdited(self, text):
+        # 入力中の閾値での該当企業数を表示する
+        if utils.is_float(text):
+            thres = float(text)
+            if self.condition.vmin is not None:
+                vmin, vmax = thres, self.condition.vmax
+            else:
+                vmin, vmax = self.condition.vmin, thres
+            self.mediator.set_edited_condition(self.condition, vmin, vmax)
+            self.send_event(Event.EASY_SETTING_THRESHOLD_EDITED)
+
     def checkBoxStateChanged(self, state):
         checked = self.checkBox.isChecked()
         # print("CheckBox state changed!", checked)
@@ -114,6 +129,54 @@ class RangeConditionItem(Component):
             pass
 
 
+class TargetCountSolver(Component):
+    default_number_of_companies = 30
+
+    def __init__(
+        self,
+        parent: QWidget,
+        mediator: Mediator,
+        rangeConditionItem: RangeConditionItem,
+        get_conditions,
+        font: QFont,
+    ):
+        super().__init__(mediator)
+        self.parent = parent
+        self.rangeConditionItem = rangeConditionItem
+        self.get_conditions = get_conditions
+        # SpinBox
+        self.spinBox = QSpinBox(parent)
+        self.spinBox.setFont(font)
+        self.spinBox.setRange(0, 9999)
+        self.spinBox.setValue(self.default_number_of_companies)
+        self.spinBox.setPrefix("目標 ")
+        self.spinBox.setSuffix(" 社")
+        # PushButton
+        self.pushButton = QPushButton(parent)
+        self.pushButton.setFont(font)
+        self.pushButton.setText("閾値を逆算")
+        # signal
+        self.pushButton.clicked.connect(self.buttonClicked)
+
+    def buttonClicked(self):
+        conditions = self.get_conditions()
+        condition = self.rangeConditionItem.condition
+        n_companies = self.spinBox.value()
+        thres, _ = self.mediator.solve_threshold(conditions, condition, n_companies)
+        if thres is not None:
+            self.rangeConditionItem.set_threshold(thres)
+
+    def receive_event(self, event):
+        if event == Event.EASY_SETTING_UNCHECKED:
+            self.spinBox.setEnabled(False)
+            self.pushButton.setEnabled(False)
+        elif event == Event.EASY_SETTING_CHECKED:
+            self.spinBox.setEnabled(True)
+            self.pushButton.setEnabled(True)
+        else:
+            pass
+
+
 class EasySettingCheckBox(ComponentQCheckBox):
     _text = "簡易設定"
 
@@ -154,6 +217,37 @@ class EasySettingItemCheckBox(ComponentQCheckBox):
         return super().send_event(event)
 
 
+class AverageYearsComboBox(ComponentQComboBox):
+    items = {
+        "※直近1年の平均値": 1,
+        "※直近3年の平均値": 3,
+        "※直近5年の平均値": 5,
+        "※全期間の平均値": -1,
+    }
+
+    def __init__(self, parent: QWidget, mediator: Mediator):
+        super().__init__(parent, mediator, Event.EASY_SETTING_CONDITION_CHANGED)
+        calc_years = self.mediator.get_calc_years()
+        self.blockSignals(True)
+        for text, _calc_years in self.items.items():
+            self.addItem(text, _calc_years)
+        self.setCurrentIndex(self.findData(calc_years))
+        self.blockSignals(False)
+
+    def comboBoxIndexChanged(self, index):
+        # 事前に計算した期間の業績に切り替える (再計算はしない)
+        self.mediator.set_calc_years(self.currentData())
+        super().comboBoxIndexChanged(index)
+
+    def receive_event(self, event):
+        if event == Event.EASY_SETTING_CHECKED:
+            self.setEnabled(True)
+        elif event == Event.EASY_SETTING_UNCHECKED:
+            self.setEnabled(False)
+        else:
+            pass
+
+
 class EasySettingConditionItems(Component):
     item_dict = {
         REVENUE: [
@@ -295,6 +389,28 @@ class EasySettingConditionItems(Component):
                     )
                     self.widget_list.extend([checkBox, lineEdit])
                     self.range_condition_item_list.append(rangeConditionItem)
+                    if condition.column == DIVIDEND_YIELD:
+                        # 目標の企業数から閾値を逆算する
+                        n_row += 1
+                        self.targetCountSolver = TargetCountSolver(
+                            self.parent,
+                            self.mediator,
+                            rangeConditionItem,
+                            self.get_conditions,
+                            self.h3Font,
+                        )
+                        self.gridLayout.addWidget(
+                            self.targetCountSolver.spinBox,
+                            n_row,
+                            0,
+                            Qt.AlignmentFlag.AlignRight,
+                        )
+                        self.gridLayout.addWidget(
+                            self.targetCountSolver.pushButton,
+                            n_row,
+                            1,
+                            Qt.AlignmentFlag.AlignCenter,
+                        )
                 else:
                     checkBox = EasySettingItemCheckBox(self.parent, self.mediator)
                     checkBox.setText(check_box_text)
@@ -305,11 +421,11 @@ class EasySettingConditionItems(Component):
                     self.widget_list.append(checkBox)
                 self.check_box_list.append(checkBox)
         self.settingVBoxLayout.addLayout(self.gridLayout)
-        self.averageYearLabel = QLabel(self.parent)
-        self.averageYearLabel.setText("※直近3年の平均値")
-        self.averageYearLabel.setFont(self.h2Font)
-        self.averageYearLabel.setAlignment(Qt.AlignmentFlag.AlignRight)
-        self.settingVBoxLayout.addWidget(self.averageYearLabel)
+        self.averageYearsComboBox = AverageYearsComboBox(self.parent, self.mediator)
+        self.averageYearsComboBox.setFont(self.h2Font)
+        self.settingVBoxLayout.addWidget(
+            self.averageYearsComboBox, alignment=Qt.AlignmentFlag.AlignRight
+        )
 
     def get_conditions(self) -> Conditions:
         conditions = Conditions([])
@@ -352,10 +468,17 @@ class EasySetting(Component):
             self.parent, self.mediator, self.vBoxLayout, h2Font, h3Font
         )
 
-        # self.numberOfCompanyLabel = QLabel(self.parent)
-        # self.numberOfCompanyLabel.setText(self.text_number_of_companies)
-        # self.numberOfCompanyLabel.setAlignment(Qt.AlignmentFlag.AlignRight)
-        # self.vBoxLayout.addWidget(self.numberOfCompanyLabel)
+        self.numberOfCompanyLabel = QLabel(self.parent)
+        self.numberOfCompanyLabel.setText(self.text_number_of_companies)
+        self.numberOfCompanyLabel.setFont(self.h2Font)
+        self.numberOfCompanyLabel.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.vBoxLayout.addWidget(self.numberOfCompanyLabel)
+
+        # 条件ごとに残った企業数と, その条件のみで除外された企業数
+        self.funnelLabel = QLabel(self.parent)
+        self.funnelLabel.setFont(self.h3Font)
+        self.funnelLabel.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.vBoxLayout.addWidget(self.funnelLabel)
 
     def get_conditions(self):
         return self.easySettingConditionItems.get_conditions()
@@ -364,11 +487,31 @@ class EasySetting(Component):
         if event in Event.GETTING_EASY_CONDITION_EVENTS:
             conditions = self.get_conditions()
             self.mediator.set_screened_company_codes(conditions)
-            # company_codes = self.mediator.get_screened_company_codes()
-            # self.update_number_of_companies(company_codes)
-
-    # def update_number_of_companies(self, company_codes):
-    #     text = self.text_number_of_companies.replace(
-    #         self.keyword, str(len(company_codes))
-    #     )
-    #     self.numberOfCompanyLabel.setText(text)
+            company_codes = self.mediator.get_screened_company_codes()
+            self.update_number_of_companies(len(company_codes))
+            self.update_funnel(conditions)
+        elif event == Event.SCREENED_COMPANIES_UPDATED and self.checkBox.isChecked():
+            company_codes = self.mediator.get_screened_company_codes()
+            self.update_number_of_companies(len(company_codes))
+            self.update_funnel(self.get_conditions())
+        elif event == Event.EASY_SETTING_THRESHOLD_EDITED:
+            condition, vmin, vmax = self.mediator.get_edited_condition()
+            conditions = self.get_conditions()
+            number_of_companies = self.mediator.count_screened_companies(
+                conditions, condition, vmin, vmax
+            )
+            self.update_number_of_companies(number_of_companies)
+
+    def update_number_of_companies(self, number_of_companies: int):
+        text = self.text_number_of_companies.replace(
+            self.keyword, str(number_of_companies)
+        )
+        self.numberOfCompanyLabel.setText(text)
+
+    def update_funnel(self, conditions):
+        funnel_df = self.mediator.explain_screening(conditions)
+        lines = [
+            f"{condition}: 残り{n_survivors}社 (この条件のみで除外: {n_only_failed}社)"
+            for condition, n_survivors, n_only_failed in funnel_df.values
+        ]
+        self.funnelLabel.setText("\n".join(lines))
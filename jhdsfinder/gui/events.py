@@ -1,6 +1,7 @@
 class Event:
     INIT_UI = "Initialize UI!"
     EASY_SETTING_CONDITION_CHANGED = "Easy setting condition changed!"
+    EASY_SETTING_THRESHOLD_EDITED = "Easy setting threshold edited!"
     DETAIL_SETTING_CONDITION_CHANGED = "Detail setting condition changed!"
     EASY_SETTING_CHECKED = "Easy setting checked!"
     EASY_SETTING_UNCHECKED = "Easy setting unchecked!"
@@ -13,9 +14,12 @@ class Event:
         EASY_SETTING_CHECKED,
     ]
     GETTING_DETAIL_CONDITION_EVENTS = [
+        DETAIL_SETTING_CONDITION_CHANGED,
         DETAIL_SETTING_CHECKED,
     ]
     CONDITION_CHANGED = GETTING_EASY_CONDITION_EVENTS + GETTING_DETAIL_CONDITION_EVENTS
+    # 条件はそのままで, 値が変わった銘柄だけを判定し直した
+    SCREENED_COMPANIES_UPDATED = "Screened companies updated!"
 
     COMPANY_SELECTED_ON_TABLE = "Company selected on table!"
     COMPANY_CODE_ENTERED = "Company code entered!"
@@ -1,6 +1,7 @@
 import os
 import sys
 import numpy as np
+import pandas as pd
 from typing import Tuple, List
 from PyQt6.QtGui import *
 from PyQt6.QtWidgets import *
@@ -14,7 +15,13 @@ from jhdsfinder.gui.main_ui import MainWindowUI
 from jhdsfinder.names import *
 from jhdsfinder.dataframe import CompanyPerformanceDataFrame
 from jhdsfinder.data import FinanceData
-from jhdsfinder.screener import CompanyScreener, Conditions
+from jhdsfinder.utils import init_http_cache
+from jhdsfinder.screener import (
+    CompanyScreener,
+    Conditions,
+    NumericalCondition,
+    ScreeningDelta,
+)
 from jhdsfinder.gui.events import Event
 
 
@@ -25,18 +32,89 @@ class MainController(Mediator):
     def __init__(self) -> None:
         super().__init__()
         self.finance_data = FinanceData()
-        self.screened_df = self.finance_data.make_screened_company_dataframe()
-        self.screener = CompanyScreener(self.finance_data.performance_df)
+        # 平均値の期間ごとのスクリーナー (期間の切り替えで再計算しない)
+        self.screeners = {
+            calc_years: CompanyScreener(performance_df)
+            for calc_years, performance_df in self.finance_data.performance_dfs.items()
+        }
+        self.screener = self.screeners[self.calc_years]
+        self.update_screened_dataframe()
         self.screened_company_codes = []
+        self.is_screened = False
         self.ui = MainWindowUI(self)
         self.send_event(Event.INIT_UI, None)
 
     def set_screened_company_codes(self, conditions: Conditions = []):
         self.screened_company_codes = self.screener.run(conditions)
+        self.is_screened = True
+
+    def refresh_stock_price(self, force_update=False):
+        # 株価を読み直し, 値が変わった銘柄だけをスクリーニングし直す
+        if not self.is_screened:
+            # スクリーニングする前は条件がなく全銘柄が該当してしまうので更新しない
+            return
+        self.finance_data.refresh_stock_price(force_update)
+        for calc_years, screener in self.screeners.items():
+            performance_df = self.finance_data.performance_dfs[calc_years]
+            delta = screener.update_rows(performance_df)
+            if screener is self.screener:
+                self.screening_delta = delta
+        self.update_screened_dataframe()
+        self.screened_company_codes = self.screener.company_codes[
+            self.screener.combined_mask
+        ]
+        self.send_event(Event.SCREENED_COMPANIES_UPDATED, None)
+
+    def get_screening_delta(self) -> ScreeningDelta:
+        return self.screening_delta
+
+    def update_screened_dataframe(self):
+        # 表示する総合スコアは選択中の期間の業績から計算する
+        df = self.finance_data.make_screened_company_dataframe()
+        scores = pd.Series(self.screener.score(), index=self.screener.company_codes)
+        df[SCORE] = scores.reindex(df[COMPANY_CODE].values).values.round(2)
+        self.screened_df = df
+
+    def get_screened_dataframe(self) -> pd.DataFrame:
+        return self.screened_df
+
+    def set_calc_years(self, calc_years: int):
+        self.calc_years = calc_years
+        self.screener = self.screeners[calc_years]
+        self.update_screened_dataframe()
+
+    def get_calc_years(self) -> int:
+        return self.calc_years
 
     def get_screened_company_codes(self):
         return self.screened_company_codes
 
+    def set_edited_condition(
+        self, condition: NumericalCondition, vmin: float, vmax: float
+    ):
+        self.edited_condition = (condition, vmin, vmax)
+
+    def get_edited_condition(self) -> Tuple[NumericalCondition, float, float]:
+        return self.edited_condition
+
+    def count_screened_companies(
+        self,
+        conditions: Conditions,
+        condition: NumericalCondition,
+        vmin: float,
+        vmax: float,
+    ) -> int:
+        # スクリーニングせずに入力中の閾値での該当企業数を数える
+        return self.screener.count_with_range(conditions, condition, vmin, vmax)
+
+    def solve_threshold(
+        self, conditions: Conditions, condition: NumericalCondition, n_companies: int
+    ) -> Tuple[float, int]:
+        return self.screener.solve_threshold(conditions, condition, n_companies)
+
+    def explain_screening(self, conditions: Conditions) -> pd.DataFrame:
+        return self.screener.explain(conditions)
+
     def set_selected_company_data(self, company_code: str):
         self.selected_company_data = self.finance_data.get_company_data(company_code)
 
@@ -52,6 +130,8 @@ class MainController(Mediator):
 
 
 if __name__ == "__main__":
+    # JHDSFINDER_HTTP_CACHEが指定されていればHTTPキャッシュを使う
+    init_http_cache()
     app = QApplication(sys.argv)
     main = MainController()
     main.show()
@@ -17,8 +17,13 @@ class MainWindowUI(QMainWindow):
     TITLE_SEQRCH_CONDITION_VIEW = "検索条件設定"
     TITLE_SCREENED_RESULT_VIEW = "スクリーニング結果"
     TITLE_PERFORMANCE_VIEW = "企業業績"
+    TITLE_DATA_MENU = "データ"
+    TEXT_REFRESH_STOCK_PRICE = "株価を更新"
+    TEXT_REFRESH_STOCK_PRICE_FAILED = "株価を更新できませんでした"
 
     SPACE = 8
+    # 株価が更新されていないかを確認する間隔 [ミリ秒] (無尽蔵は1日1回更新する)
+    STOCK_PRICE_REFRESH_INTERVAL_MS = 60 * 60 * 1000
 
     def __init__(self, mediator: Mediator):
         super().__init__()
@@ -47,6 +52,8 @@ class MainWindowUI(QMainWindow):
 
     def init_ui(self):
         self.setWindowTitle(self.TITLE)
+        self.init_menu()
+        self.init_timer()
         self.set_window_size()
         self.set_geometory()
         self.searchCondition = SearchConditionSetting(
@@ -77,6 +84,37 @@ class MainWindowUI(QMainWindow):
             self.h3Font,
         )
 
+    def init_menu(self):
+        self.dataMenu = self.menuBar().addMenu(self.TITLE_DATA_MENU)
+        self.refreshStockPriceAction = QAction(self.TEXT_REFRESH_STOCK_PRICE, self)
+        self.refreshStockPriceAction.setShortcut(QKeySequence("F5"))
+        self.refreshStockPriceAction.triggered.connect(
+            self.refreshStockPriceActionTriggered
+        )
+        self.dataMenu.addAction(self.refreshStockPriceAction)
+
+    def init_timer(self):
+        # 起動したままでも新しい株価に切り替わるように定期的に確認する
+        self.stockPriceTimer = QTimer(self)
+        self.stockPriceTimer.setInterval(self.STOCK_PRICE_REFRESH_INTERVAL_MS)
+        self.stockPriceTimer.timeout.connect(self.stockPriceTimerTimeout)
+        self.stockPriceTimer.start()
+
+    def refreshStockPriceActionTriggered(self):
+        # メニューからは株価ファイルが新しくても取得し直す
+        self.refresh_stock_price(force_update=True, show_error=True)
+
+    def stockPriceTimerTimeout(self):
+        self.refresh_stock_price(force_update=False, show_error=False)
+
+    def refresh_stock_price(self, force_update: bool, show_error: bool):
+        try:
+            self.mediator.refresh_stock_price(force_update)
+        except Exception as e:
+            print(f"{self.TEXT_REFRESH_STOCK_PRICE_FAILED}: {e}")
+            if show_error:
+                utils.show_warning_popup(self, self.TEXT_REFRESH_STOCK_PRICE_FAILED)
+
     def set_window_size(self):
         # 画面のプライマリディスプレイのジオメトリを取得
         screen_geometory = QGuiApplication.primaryScreen().availableGeometry()
@@ -86,15 +124,20 @@ class MainWindowUI(QMainWindow):
         self.setGeometry(0, 0, self.width_size, self.height_size)
 
     def set_geometory(self):
+        # メニューバーの下に配置する (macOSのメニューバーはウィンドウの外にある)
+        menu_bar = self.menuBar()
+        top = self.SPACE
+        if not menu_bar.isNativeMenuBar():
+            top += menu_bar.sizeHint().height()
         #
         x1 = self.SPACE
-        y1 = self.SPACE
+        y1 = top
         w1 = int(self.width_size * 0.2)
-        h1 = self.height_size - self.SPACE * 2
+        h1 = self.height_size - top - self.SPACE
         self.geometory1 = (x1, y1, w1, h1)
         #
         x2 = w1 + x1 + self.SPACE
-        y2 = self.SPACE
+        y2 = top
         w2 = self.width_size - x2 - self.SPACE
         h2 = int(self.height_size * 0.25)
         self.geometory2 = (x2, y2, w2, h2)
@@ -58,6 +58,70 @@ class ScreenedResultTableView(ComponentQTableView):
 class ScreenedCompanyTableModel(PandasModel):
     def __init__(self, dataframe: pd.DataFrame, mediator: Mediator):
         super().__init__(dataframe, mediator)
+        # 追加する行を挿入する位置を決めるための並び順
+        self.sort_by = DIVIDEND_YIELD
+        self.ascending = False
+
+    def sort(self, column: int, order=Qt.SortOrder.AscendingOrder):
+        self.sort_by = self._dataframe.columns[column]
+        self.ascending = order == Qt.SortOrder.AscendingOrder
+        super().sort(column, order)
+
+    def apply_delta(self, df: pd.DataFrame, delta: ScreeningDelta):
+        """
+        モデルをリセットせずに差分だけを行の削除と挿入で反映する
+        (選択中の行とスクロール位置を保つ)
+        """
+        removed = self._dataframe[COMPANY_CODE].isin(delta.removed_company_codes)
+        for row in np.flatnonzero(removed.values)[::-1]:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            self._dataframe = self._dataframe.drop(index=self._dataframe.index[row])
+            self.endRemoveRows()
+        # 残った行は値を更新し, 値が変わって崩れた並び順を直す
+        self._dataframe = df.loc[self._dataframe.index]
+        self.sort_rows()
+        if self.rowCount() > 0:
+            self.dataChanged.emit(
+                self.index(0, 0),
+                self.index(self.rowCount() - 1, self.columnCount() - 1),
+                [Qt.ItemDataRole.DisplayRole],
+            )
+        added_df = df[df[COMPANY_CODE].isin(delta.added_company_codes)]
+        self.insert_rows(added_df)
+
+    def sort_rows(self):
+        """
+        行を並び順に並べ直す (レイアウトの変更として通知し, 選択中の行を保つ)
+        """
+        self.layoutAboutToBeChanged.emit()
+        old_index = self._dataframe.index
+        self._dataframe = self._dataframe.sort_values(
+            by=self.sort_by, ascending=self.ascending, kind="stable"
+        )
+        new_rows = self._dataframe.index.get_indexer(old_index)
+        old_indexes = self.persistentIndexList()
+        new_indexes = [
+            self.index(int(new_rows[index.row()]), index.column())
+            for index in old_indexes
+        ]
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
+    def insert_rows(self, df: pd.DataFrame):
+        # 既存の行は並び順に並んでいるので, 並び順で前に来る既存の行の数の位置に挿入する
+        n_rows = len(self._dataframe)
+        values = pd.concat([self._dataframe[self.sort_by], df[self.sort_by]])
+        ranks = values.rank(
+            method="first", ascending=self.ascending, na_option="bottom"
+        ).values
+        positions = np.searchsorted(np.sort(ranks[:n_rows]), ranks[n_rows:])
+        for i, j in enumerate(np.argsort(ranks[n_rows:], kind="stable")):
+            row = positions[j] + i
+            self.beginInsertRows(QModelIndex(), row, row)
+            self._dataframe = pd.concat(
+                [self._dataframe.iloc[:row], df.iloc[[j]], self._dataframe.iloc[row:]]
+            )
+            self.endInsertRows()
 
 
 class ScreenedResult(Component):
@@ -98,11 +162,18 @@ class ScreenedResult(Component):
 
     def receive_event(self, event):
         if event in Event.CONDITION_CHANGED:
+            self.df = self.mediator.get_screened_dataframe()
             company_codes = self.mediator.get_screened_company_codes()
             df = self.df[self.df[COMPANY_CODE].isin(company_codes)]
             df = df.sort_values(by=DIVIDEND_YIELD, ascending=False)
             self.tableView.update_dataframe(df)
             self.update_number_of_companies(company_codes)
+        elif event == Event.SCREENED_COMPANIES_UPDATED:
+            self.df = self.mediator.get_screened_dataframe()
+            delta = self.mediator.get_screening_delta()
+            self.tableView.model().apply_delta(self.df, delta)
+            company_codes = self.mediator.get_screened_company_codes()
+            self.update_number_of_companies(company_codes)
 
     def update_number_of_companies(self, company_codes):
         title = self._title.replace(self.keyword, str(len(company_codes)))
@@ -1,7 +1,13 @@
 import os
-import time
+import json
+import hashlib
+import threading
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+from typing import Dict
+from urllib.parse import urlparse
+import requests
 import pandas as pd
 import numpy as np
 
@@ -11,20 +17,48 @@ from jhdsfinder.names import *
 
 IRBANK_URL = "https://f.irbank.net/files"
 MIN_FISCAL_YEAR = 2010
+# IR Bankへのアクセスは1時間に50回まで (1年度分のファイルは続けて取得できる)
+IRBANK_ACCESS_RATE = 50 / 3600
+IRBANK_ACCESS_BURST = len(FY_CSV_FILENAMES)
+# 同時にダウンロードするファイル数
+N_DOWNLOAD_WORKERS = 4
+# merge_csv_by_yearの結果を変えた場合は上げてキャッシュを作り直す
+MERGE_CACHE_VERSION = 1
+# 既にあっても更新されていないかを確認する, 進行中の年度より前の年度の数
+# (IR Bankは決算発表のたびに更新する)
+N_REFRESH_FISCAL_YEARS = 1
+# 更新を確認する間隔 (進行中の年度は毎日, それより前の年度は週に1回)
+IRBANK_REFRESH_INTERVAL = datetime.timedelta(days=1)
+IRBANK_PAST_REFRESH_INTERVAL = datetime.timedelta(days=7)
 
+# download_fy_csv_fileの結果
+DOWNLOADED = "downloaded"
+UNCHANGED = "unchanged"
+NOT_FOUND = "not found"
 
-def get_download_link(fiscal_year: int, csv_filename: str) -> str:
+
+def set_irbank_rate_limit():
+    """IR Bankへのアクセス頻度の制限を最初のダウンロードで設定する"""
+    if utils.get_token_bucket(IRBANK_URL) is None:
+        utils.set_rate_limit(
+            urlparse(IRBANK_URL).netloc, IRBANK_ACCESS_RATE, IRBANK_ACCESS_BURST
+        )
+
+
+def get_download_link(
+    fiscal_year: int, csv_filename: str, base_url: str = IRBANK_URL
+) -> str:
     assert csv_filename in FY_CSV_FILENAMES
     assert fiscal_year >= MIN_FISCAL_YEAR
-    url = f"{IRBANK_URL}/00{str(fiscal_year)[-2:]}/{csv_filename}"
+    url = f"{base_url}/00{str(fiscal_year)[-2:]}/{csv_filename}"
     return url
 
 
-def get_fy_csv_filepath(fiscal_year: int, csv_filename: str):
+def get_fy_csv_filepath(fiscal_year: int, csv_filename: str, data_dir=DATA_DIRNAME):
     assert csv_filename in FY_CSV_FILENAMES
     assert fiscal_year >= MIN_FISCAL_YEAR
     dirname = csv_filename.split(".")[0]
-    save_dir = os.path.join(DATA_DIRNAME, dirname)
+    save_dir = os.path.join(data_dir, dirname)
     csv_filepath = os.path.join(save_dir, f"{str(fiscal_year)}.csv")
     return csv_filepath
 
@@ -34,27 +68,192 @@ def get_fy_all_csv_filepath(data_dir=DATA_DIRNAME):
     return csv_filepath
 
 
+class DownloadJournal:
+    """
+    ダウンロードが終わったファイルを記録する (中断しても続きからダウンロードできる)
+    ファイルは一時ファイルに書き込んでから置き換えるので, 記録したファイルは欠けていない
+    """
+
+    def __init__(self, data_dir=DATA_DIRNAME) -> None:
+        self.data_dir = data_dir
+        self.filepath = os.path.join(data_dir, IRBANK_JOURNAL_FILENAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.filepath):
+            with open(self.filepath, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def get_key(self, csv_filepath: str) -> str:
+        return os.path.relpath(csv_filepath, self.data_dir).replace(os.sep, "/")
+
+    def get(self, csv_filepath: str) -> dict:
+        return self.entries.get(self.get_key(csv_filepath))
+
+    def is_done(self, csv_filepath: str) -> bool:
+        if not os.path.exists(csv_filepath):
+            return False
+        entry = self.get(csv_filepath)
+        if entry is None or "size" not in entry:
+            # 記録を始める前にダウンロードしたファイル
+            with open(csv_filepath, "rb") as f:
+                self.record(csv_filepath, None, f.read())
+            return True
+        return os.path.getsize(csv_filepath) == entry["size"]
+
+    def record(self, csv_filepath: str, url: str, content: bytes, headers={}):
+        # 次回の条件付きリクエストに使うメタデータも記録する
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        entry = {
+            "url": url,
+            "size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "content_length": headers.get("Content-Length"),
+            "downloaded_at": now,
+            "checked_at": now,
+        }
+        with self.lock:
+            self.entries[self.get_key(csv_filepath)] = entry
+            self.save()
+
+    def record_check(self, csv_filepath: str):
+        """サーバーで更新を確認した日時を記録する (ファイルがない年度も記録する)"""
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            entry = self.entries.setdefault(self.get_key(csv_filepath), {})
+            entry["checked_at"] = now
+            self.save()
+
+    def get_checked_at(self, csv_filepath: str) -> datetime.datetime:
+        entry = self.get(csv_filepath) or {}
+        checked_at = entry.get("checked_at", entry.get("downloaded_at"))
+        if checked_at is None:
+            return None
+        return datetime.datetime.fromisoformat(checked_at)
+
+    def get_conditional_headers(self, csv_filepath: str) -> dict:
+        entry = self.get(csv_filepath)
+        headers = {}
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def save(self):
+        tmp_filepath = f"{self.filepath}.tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_filepath, self.filepath)
+
+
 def download_fy_csv_file(
-    fiscal_year: int, csv_filename: str, access_restricstion: bool = True
-):
-    # 保存先の設定
-    csv_filepath = get_fy_csv_filepath(fiscal_year, csv_filename)
-    if os.path.exists(csv_filepath):
-        print(f"Skip downloading since the file already exists. ({csv_filepath})")
-    else:
-        # csvファイルのダウンロード
-        url = get_download_link(fiscal_year, csv_filename)
-        response = utils.access_url(url)
-        print(f"Downloading {fiscal_year} year {csv_filename} ...")
-        with open(csv_filepath, "wb") as f:
-            f.write(response.content)
-        if access_restricstion:
-            time.sleep(3600 / 50)
+    fiscal_year: int,
+    csv_filename: str,
+    journal: DownloadJournal = None,
+    base_url: str = IRBANK_URL,
+    refresh: bool = False,
+) -> str:
+    """
+    csvファイルをダウンロードする (アクセス頻度はutils.access_urlで制限する)
+    refreshの場合は既にあるファイルも記録したメタデータで変更を確認し, 変更がなければ書き換えない
+    DOWNLOADED, UNCHANGED, NOT_FOUNDのいずれかを返す
+    """
+    journal = DownloadJournal() if journal is None else journal
+    csv_filepath = get_fy_csv_filepath(fiscal_year, csv_filename, journal.data_dir)
+    url = get_download_link(fiscal_year, csv_filename, base_url)
+    headers = {}
+    if journal.is_done(csv_filepath):
+        if not refresh:
+            print(f"Skip downloading since the file already exists. ({csv_filepath})")
+            return UNCHANGED
+        headers = journal.get_conditional_headers(csv_filepath)
+        if len(headers) == 0 and not is_changed_size(url, journal.get(csv_filepath)):
+            journal.record_check(csv_filepath)
+            return UNCHANGED
+    print(f"Downloading {fiscal_year} year {csv_filename} ...")
+    response = utils.access_url(url, headers)
+    if response.status_code == 304:
+        print(f"Not modified. ({csv_filepath})")
+        journal.record_check(csv_filepath)
+        return UNCHANGED
+    elif response.status_code != 200:
+        journal.record_check(csv_filepath)
+        return NOT_FOUND
+    entry = journal.get(csv_filepath)
+    sha256 = hashlib.sha256(response.content).hexdigest()
+    if (
+        os.path.exists(csv_filepath)
+        and entry is not None
+        and entry.get("sha256") == sha256
+    ):
+        # 内容が同じ場合はメタデータだけを更新する
+        journal.record(csv_filepath, url, response.content, response.headers)
+        return UNCHANGED
+    os.makedirs(os.path.dirname(csv_filepath), exist_ok=True)
+    tmp_filepath = f"{csv_filepath}.part"
+    with open(tmp_filepath, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp_filepath, csv_filepath)
+    journal.record(csv_filepath, url, response.content, response.headers)
+    return DOWNLOADED
 
 
-def download(fiscal_year: int):
-    for csv_filename in FY_CSV_FILENAMES:
-        download_fy_csv_file(fiscal_year, csv_filename)
+def is_changed_size(url: str, entry: dict) -> bool:
+    """ETagとLast-Modifiedがない場合はHEADのContent-Lengthで変更を確認する"""
+    response = utils.access_url(url, method="HEAD")
+    content_length = response.headers.get("Content-Length")
+    if response.status_code != 200 or content_length is None:
+        return True
+    return int(content_length) != entry["size"]
+
+
+def download(
+    fiscal_years: list,
+    data_dir=DATA_DIRNAME,
+    base_url: str = IRBANK_URL,
+    n_workers: int = N_DOWNLOAD_WORKERS,
+    refresh_fiscal_years: list = [],
+) -> Dict[int, DataFrame]:
+    """
+    年度ごとの4つのcsvファイルのうち, まだないファイルを並列にダウンロードする
+    1年度分が終わってから次の年度に進む (失敗した場合は次の年度にアクセスしない)
+    refresh_fiscal_yearsの年度は既にあるファイルも変更を確認する
+    ファイルが変わった年度だけを, 残りのダウンロードと並行してload_merged_csv_by_yearでまとめて返す
+    """
+    set_irbank_rate_limit()
+    journal = DownloadJournal(data_dir)
+    download_executor = ThreadPoolExecutor(n_workers)
+    parse_executor = ThreadPoolExecutor(1)
+    try:
+        parse_futures = {}
+        for fiscal_year in fiscal_years:
+            futures = [
+                download_executor.submit(
+                    download_fy_csv_file,
+                    fiscal_year,
+                    csv_filename,
+                    journal,
+                    base_url,
+                    fiscal_year in refresh_fiscal_years,
+                )
+                for csv_filename in FY_CSV_FILENAMES
+            ]
+            results = [future.result() for future in futures]
+            if NOT_FOUND not in results and DOWNLOADED in results:
+                parse_futures[fiscal_year] = parse_executor.submit(
+                    load_merged_csv_by_year, fiscal_year, data_dir
+                )
+        year_dfs = {
+            fiscal_year: future.result()
+            for fiscal_year, future in parse_futures.items()
+        }
+    finally:
+        # 失敗した場合は残りのダウンロードを取り消す (次回は続きからダウンロードする)
+        download_executor.shutdown(cancel_futures=True)
+        parse_executor.shutdown(cancel_futures=True)
+    return year_dfs
 
 
 def merge_csv_by_year(fiscal_year: int, data_dir=DATA_DIRNAME) -> DataFrame:
@@ -73,21 +272,65 @@ def merge_csv_by_year(fiscal_year: int, data_dir=DATA_DIRNAME) -> DataFrame:
     # 重複するカラム (年度) を削除する
     df = df.loc[:, ~df.columns.duplicated()]
     df.reset_index(inplace=True)
+    # '-'と''をNaNに置き換える
+    df = df.astype(object).replace("-", np.nan).replace("", np.nan)
+    return df
+
+
+def get_merge_cache_key(fiscal_year: int, data_dir=DATA_DIRNAME) -> str:
+    """4つのcsvファイルの内容から年度ごとのキャッシュのキーを作る"""
+    sha256 = hashlib.sha256(f"{MERGE_CACHE_VERSION}".encode())
+    for csv_filename in FY_CSV_FILENAMES:
+        csv_filepath = get_fy_csv_filepath(fiscal_year, csv_filename, data_dir)
+        with open(csv_filepath, "rb") as f:
+            sha256.update(hashlib.sha256(f.read()).digest())
+    return sha256.hexdigest()
+
+
+def get_merge_cache_filepath(fiscal_year: int, key: str, data_dir=DATA_DIRNAME):
+    cache_dir = os.path.join(data_dir, IRBANK_MERGE_CACHE_DIRNAME)
+    return os.path.join(cache_dir, f"{fiscal_year}-{key[:16]}.pkl")
+
+
+def load_merged_csv_by_year(fiscal_year: int, data_dir=DATA_DIRNAME) -> DataFrame:
+    """
+    merge_csv_by_yearの結果をcsvファイルの内容ごとにキャッシュする
+    csvファイルが変わっていない年度はpickleを読み込むだけにする
+    """
+    key = get_merge_cache_key(fiscal_year, data_dir)
+    cache_filepath = get_merge_cache_filepath(fiscal_year, key, data_dir)
+    if os.path.exists(cache_filepath):
+        return pd.read_pickle(cache_filepath)
+    df = merge_csv_by_year(fiscal_year, data_dir)
+    # 同じ年度の古いキャッシュを削除してから保存する
+    for old_filepath in glob(get_merge_cache_filepath(fiscal_year, "*", data_dir)):
+        os.remove(old_filepath)
+    os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+    tmp_filepath = f"{cache_filepath}.tmp"
+    df.to_pickle(tmp_filepath)
+    os.replace(tmp_filepath, cache_filepath)
     return df
 
 
-def merge_csv() -> FinanceAllDataFrame:
+def merge_csv(
+    data_dir=DATA_DIRNAME, year_dfs: Dict[int, DataFrame] = {}
+) -> FinanceAllDataFrame:
+    """
+    年度ごとにまとめたデータフレームを結合する
+    year_dfsにある年度は読み直さず, それ以外の年度は変わっていなければキャッシュを使う
+    """
     df_list = []
-    fiscal_years = get_csv_fiscal_years()
+    fiscal_years = get_csv_fiscal_years(data_dir)
     for fiscal_year in fiscal_years:
-        df = merge_csv_by_year(fiscal_year)
+        if fiscal_year in year_dfs:
+            df = year_dfs[fiscal_year]
+        else:
+            df = load_merged_csv_by_year(fiscal_year, data_dir)
         df_list.append(df)
     assert len(df_list) == len(fiscal_years), len(df_list)
     df = pd.concat(df_list, axis=0)
     df = df.sort_values(by=[COMPANY_CODE, FISCAL_YEAR])
     df.reset_index(inplace=True, drop=True)
-    # '-'と''をNaNに置き換える
-    df = df.astype(object).replace("-", np.nan).replace("", np.nan)
     # 1株配当を修正
     df[DIVIDEND_PER_SHARE] = df[DIVIDEND_PER_SHARE].astype(float).fillna(0)
     # 営業利益率を追加
@@ -99,24 +342,146 @@ def merge_csv() -> FinanceAllDataFrame:
     return FinanceAllDataFrame(df)
 
 
-def update(data_dir=DATA_DIRNAME):
+def update(data_dir=DATA_DIRNAME, refresh_fiscal_years: list = None):
+    """
+    進行中の年度までのcsvファイルをダウンロードしてfy-data-allを作り直す
+    refresh_fiscal_yearsを指定しない場合は更新を確認する時期になった年度を確認する
+    """
     current_year = datetime.datetime.now().year
-    years = np.arange(MIN_FISCAL_YEAR, current_year)
-    for year in years:
-        download(year)
-    df = merge_csv()
-    # 保存
+    years = list(range(MIN_FISCAL_YEAR, current_year + 1))
+    if refresh_fiscal_years is None:
+        refresh_fiscal_years = get_due_refresh_fiscal_years(data_dir)
+    year_dfs = download(years, data_dir, refresh_fiscal_years=refresh_fiscal_years)
     csv_filepath = get_fy_all_csv_filepath(data_dir)
-    df.to_csv(csv_filepath)
+    if len(year_dfs) == 0 and not is_older_than_fy_csv_files(csv_filepath, data_dir):
+        print("IR Bank data is not changed.")
+        return
+    df = merge_csv(data_dir, year_dfs)
+    # 保存
+    if os.path.exists(csv_filepath):
+        # 更新前後のfy-data-allを比べて行が変わった銘柄を記録する
+        old_df = read_fy_all_rows(csv_filepath)
+        df.to_csv(csv_filepath)
+        new_df = read_fy_all_rows(csv_filepath)
+        company_codes = get_changed_company_codes(old_df, new_df)
+        print(f"{len(company_codes)} companies are changed.")
+        save_dirty_company_codes(company_codes, data_dir)
+    else:
+        df.to_csv(csv_filepath)
+        clear_dirty_company_codes(data_dir)
+
+
+def get_due_refresh_fiscal_years(data_dir=DATA_DIRNAME, now=None) -> list:
+    """
+    進行中の年度と直近のN_REFRESH_FISCAL_YEARS年度のうち,
+    前回の確認 (ダウンロードログの日時) から確認の間隔が過ぎた年度を返す
+    """
+    now = datetime.datetime.now() if now is None else now
+    intervals = {
+        fiscal_year: IRBANK_PAST_REFRESH_INTERVAL
+        for fiscal_year in range(now.year - N_REFRESH_FISCAL_YEARS, now.year)
+    }
+    intervals[now.year] = IRBANK_REFRESH_INTERVAL
+    journal = DownloadJournal(data_dir)
+    fiscal_years = []
+    for fiscal_year, interval in intervals.items():
+        for csv_filename in FY_CSV_FILENAMES:
+            csv_filepath = get_fy_csv_filepath(fiscal_year, csv_filename, data_dir)
+            checked_at = journal.get_checked_at(csv_filepath)
+            if checked_at is None or now - checked_at >= interval:
+                fiscal_years.append(fiscal_year)
+                break
+    return fiscal_years
+
+
+def is_older_than_fy_csv_files(csv_filepath: str, data_dir=DATA_DIRNAME) -> bool:
+    for fiscal_year in get_csv_fiscal_years(data_dir):
+        for csv_filename in FY_CSV_FILENAMES:
+            fy_csv_filepath = get_fy_csv_filepath(fiscal_year, csv_filename, data_dir)
+            if utils.is_older_file(csv_filepath, fy_csv_filepath):
+                return True
+    return False
+
+
+def read_fy_all_rows(csv_filepath: str) -> pd.DataFrame:
+    """保存されたfy-data-allを文字列のまま読み込む (行の比較用)"""
+    df = pd.read_csv(
+        csv_filepath,
+        index_col=0,
+        dtype=str,
+        keep_default_na=False,
+        encoding=DataFrame.ENCODING,
+    )
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def get_changed_company_codes(old_df: pd.DataFrame, new_df: pd.DataFrame) -> list:
+    """
+    行単位で比較し, 追加・削除・変更された行がある銘柄コードを返す
+    """
+    old_codes = old_df[COMPANY_CODE].values.astype(str)
+    new_codes = new_df[COMPANY_CODE].values.astype(str)
+    if old_df.columns.tolist() != new_df.columns.tolist():
+        # カラムが変わった場合は全銘柄
+        return np.union1d(old_codes, new_codes).tolist()
+    old_rows = set(zip(old_codes, pd.util.hash_pandas_object(old_df, index=False)))
+    new_rows = set(zip(new_codes, pd.util.hash_pandas_object(new_df, index=False)))
+    company_codes = {code for code, _ in old_rows ^ new_rows}
+    return sorted(company_codes)
+
+
+def get_dirty_company_codes_csv_filepath(data_dir=DATA_DIRNAME):
+    csv_filepath = os.path.join(data_dir, DIRTY_COMPANY_CODES_CSV_FILENAME)
+    return csv_filepath
+
+
+def load_dirty_company_codes(data_dir=DATA_DIRNAME) -> list:
+    """
+    前回の更新から行が変わった銘柄コードを返す (記録がない場合はNone)
+    """
+    csv_filepath = get_dirty_company_codes_csv_filepath(data_dir)
+    if not os.path.exists(csv_filepath):
+        return None
+    df = pd.read_csv(
+        csv_filepath, dtype={COMPANY_CODE: str}, encoding=DataFrame.ENCODING
+    )
+    return df[COMPANY_CODE].tolist()
+
+
+def save_dirty_company_codes(company_codes: list, data_dir=DATA_DIRNAME):
+    """
+    まだ反映されていない銘柄コードに追加して保存する
+    """
+    dirty_company_codes = load_dirty_company_codes(data_dir) or []
+    company_codes = sorted(set(dirty_company_codes) | set(company_codes))
+    df = DataFrame({COMPANY_CODE: company_codes})
+    df.to_csv(get_dirty_company_codes_csv_filepath(data_dir), index=False)
+
+
+def clear_dirty_company_codes(data_dir=DATA_DIRNAME):
+    csv_filepath = get_dirty_company_codes_csv_filepath(data_dir)
+    if os.path.exists(csv_filepath):
+        os.remove(csv_filepath)
 
 
 def get_csv_fiscal_years(data_dir=DATA_DIRNAME) -> list:
+    """
+    4つのcsvファイルが揃っている年度を返す
+    (進行中の年度は一部のファイルしか公開されていないことがある)
+    """
     dirname = FY_BALANCE_SHEET_CSV_FILENAME.split(".")[0]
     csv_filenames = sorted(glob(os.path.join(data_dir, dirname, "20*.csv")))
-    if len(csv_filenames) == 0:
+    fiscal_years = []
+    for csv_filename in csv_filenames:
+        fiscal_year = int(os.path.basename(csv_filename).split(".")[0])
+        if all(
+            os.path.exists(get_fy_csv_filepath(fiscal_year, f, data_dir))
+            for f in FY_CSV_FILENAMES
+        ):
+            fiscal_years.append(fiscal_year)
+    if len(fiscal_years) == 0:
         fiscal_years = [MIN_FISCAL_YEAR]
-    else:
-        fiscal_years = [int(os.path.basename(f).split(".")[0]) for f in csv_filenames]
     return fiscal_years
 
 
@@ -129,9 +494,17 @@ def load_fy_all_dataframe(
         force_update = True
     csv_latest_year = get_csv_fiscal_years(data_dir)[-1]
     current_year = datetime.datetime.now().year
-    if current_year - csv_latest_year > 1 or force_update:
+    # 直近の年度は確認の間隔が過ぎたら条件付きリクエストで更新を確認する
+    refresh_fiscal_years = get_due_refresh_fiscal_years(data_dir)
+    if current_year - csv_latest_year > 1 or force_update or refresh_fiscal_years:
         print("Update csv files ...")
-        update(data_dir)
+        try:
+            update(data_dir, refresh_fiscal_years)
+        except (RuntimeError, requests.RequestException) as e:
+            # IR Bankにつながらなくても保存済みのデータがあれば使う (次回また更新する)
+            if not os.path.exists(csv_filepath):
+                raise
+            print(f"Failed to update IR Bank data. Use the saved data. ({e})")
     else:
         print("IR Bank data is the latest status. (OK)")
     df = CompanyPerformanceDataFrame.from_csv(csv_filepath)
@@ -1,3 +1,4 @@
+import io
 import os
 
 import pandas as pd
@@ -25,7 +26,8 @@ def download() -> MarketDataFrame:
     # 市場データのExcelにアクセス
     excel_url = get_download_link()
     try:
-        df = pd.read_excel(excel_url, sheet_name="Sheet1")
+        response = utils.access_url(excel_url)
+        df = pd.read_excel(io.BytesIO(response.content), sheet_name="Sheet1")
     except Exception as e:
         print(f"Error occurred in progress of reading Market Execl ({excel_url}).")
         raise ValueError(e)
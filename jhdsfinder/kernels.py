@@ -0,0 +1,122 @@
+from typing import List, Tuple
+
+import numpy as np
+
+# 修正Zスコアによる外れ値除去のパラメータ
+MAD_THRESH = 3.5
+MEDIAN_AD_SCALE = 1.486
+MEAN_AD_SCALE = 1.253314
+
+
+def pad_series(series_list: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    長さの異なる系列のリストを (系列数, 最大長) の配列とmaskに変換する
+    """
+    n_series = len(series_list)
+    max_length = max([len(x) for x in series_list], default=0)
+    x = np.full((n_series, max_length), np.nan)
+    mask = np.zeros((n_series, max_length), dtype=bool)
+    for i, series in enumerate(series_list):
+        x[i, : len(series)] = series
+        mask[i, : len(series)] = True
+    return x, mask
+
+
+def masked_median(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """行ごとにmaskがTrueの要素の中央値を計算する (要素がない行はNaN)"""
+    n = mask.sum(axis=1)
+    x_sorted = np.sort(np.where(mask, x, np.inf), axis=1)
+    lo = np.clip((n - 1) // 2, 0, None)
+    hi = n // 2
+    rows = np.arange(len(x))
+    with np.errstate(invalid="ignore"):
+        median = (x_sorted[rows, lo] + x_sorted[rows, hi]) / 2
+    return np.where(n > 0, median, np.nan)
+
+
+def remove_outliers_mad(
+    x: np.ndarray, mask: np.ndarray, thresh: float = MAD_THRESH
+) -> np.ndarray:
+    """
+    data.remove_outliers_mad を行ごとに一括で適用し, 残す要素のmaskを返す
+    """
+    mask = mask & ~np.isnan(x)
+    n = mask.sum(axis=1)
+    median = masked_median(x, mask)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        absolute_deviation = np.abs(x - median)
+        median_ad = masked_median(absolute_deviation, mask)[:, None]
+        mean_ad = np.where(mask, absolute_deviation, 0.0).sum(axis=1) / n
+        mean_ad = mean_ad[:, None]
+        modified_z_score = np.where(
+            median_ad == 0.0,
+            (x - median) / (MEAN_AD_SCALE * mean_ad + 1e-8),
+            (x - median) / (MEDIAN_AD_SCALE * median_ad),
+        )
+        bool_array = np.abs(modified_z_score) < thresh
+    return np.where((n < 3)[:, None], mask, mask & bool_array)
+
+
+def get_gradients(x: np.ndarray, y: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """行ごとの最小二乗法の傾き (data.get_gradient と同じ値)"""
+    n = mask.sum(axis=1)
+    x = np.where(mask, x, 0.0)
+    y = np.where(mask, y, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = (x.sum(axis=1) / n)[:, None]
+        y_mean = (y.sum(axis=1) / n)[:, None]
+        dx = np.where(mask, x - x_mean, 0.0)
+        dy = np.where(mask, y - y_mean, 0.0)
+        sxx = (dx * dx).sum(axis=1)
+        sxy = (dx * dy).sum(axis=1)
+        gradient = np.where(sxx > 0.0, sxy / sxx, 0.0)
+    return np.where(n > 0, gradient, np.nan)
+
+
+def get_averages(x: np.ndarray, mask: np.ndarray, calc_years: int) -> np.ndarray:
+    """行ごとに直近calc_years個の要素の平均値 (data.get_average と同じ値)"""
+    if calc_years != -1:
+        # 末尾から数えた要素の順番
+        order_from_last = np.cumsum(mask[:, ::-1], axis=1)[:, ::-1]
+        mask = mask & (order_from_last <= calc_years)
+    n = mask.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = np.where(mask, x, 0.0).sum(axis=1) / n
+    return np.where(n > 0, average, np.nan)
+
+
+def get_last_values(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """行ごとにmaskがTrueの最後の要素 (要素がない行はNaN)"""
+    if x.shape[1] == 0:
+        return np.full(len(x), np.nan)
+    last_idx = x.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    last_values = x[np.arange(len(x)), last_idx]
+    return np.where(mask.any(axis=1), last_values, np.nan)
+
+
+def is_non_decreasing(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """行ごとにmaskがTrueの要素が単調非減少かどうか (要素がない行はFalse)"""
+    positions = np.where(mask, np.arange(x.shape[1]), -1)
+    last_positions = np.maximum.accumulate(positions, axis=1)
+    # 各要素の直前に残っている要素の位置
+    prev_positions = np.full_like(last_positions, -1)
+    prev_positions[:, 1:] = last_positions[:, :-1]
+    prev_values = np.take_along_axis(x, np.clip(prev_positions, 0, None), axis=1)
+    decrease = mask & (prev_positions >= 0) & (prev_values > x)
+    return mask.any(axis=1) & ~decrease.any(axis=1)
+
+
+def get_mad_filtered_gradients(
+    years: np.ndarray, x: np.ndarray, mask: np.ndarray, thresh: float = MAD_THRESH
+) -> np.ndarray:
+    """外れ値除去後の傾きを系列ごとに一括で計算する"""
+    mask = remove_outliers_mad(x, mask, thresh)
+    return get_gradients(years, x, mask)
+
+
+def get_mad_filtered_averages(
+    x: np.ndarray, mask: np.ndarray, calc_years: int, thresh: float = MAD_THRESH
+) -> np.ndarray:
+    """外れ値除去後の直近calc_years個の平均値を系列ごとに一括で計算する"""
+    mask = remove_outliers_mad(x, mask, thresh)
+    return get_averages(x, mask, calc_years)
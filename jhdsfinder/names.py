@@ -140,6 +140,11 @@ FY_CASH_FLOW_STATEMENT_CSV_FILENAME = "fy-cash-flow-statement.csv"
 FY_PROFIT_AND_LOSS_CSV_FILENAME = "fy-profit-and-loss.csv"
 FY_STOCK_DIVIDEND_CSV_FILENAME = "fy-stock-dividend.csv"
 FY_ALL_CSV_FILENAME = "fy-data-all.csv"
+# fy-data-allの更新で行が変わった銘柄コード
+DIRTY_COMPANY_CODES_CSV_FILENAME = "dirty-company-codes.csv"
+# IR Bankからダウンロードしたファイルの記録
+IRBANK_JOURNAL_FILENAME = "irbank-download-journal.json"
+IRBANK_MERGE_CACHE_DIRNAME = "irbank-merge-cache"
 
 FY_CSV_FILENAMES = [
     FY_BALANCE_SHEET_CSV_FILENAME,
@@ -202,12 +207,25 @@ ROA_AVG = "ROAの平均値"
 PER = "PER"
 PSR = "PSR"
 PBR = "PBR"
+# 複数の指標を重み付けした総合スコア
+SCORE = "スコア"
+# 33業種区分内でのパーセンタイル (0から100) のカラム名に付ける接尾辞
+INDUSTRY_PERCENTILE = "の業種内パーセンタイル"
 
-PERFORMANCE_CSV_FILENAME = "performance.csv"
+# 株価を使う指標の計算に使う直近の実績
+LATEST_DIVIDEND_PER_SHARE = "直近の一株配当"
+LATEST_EPS = "直近のEPS"
+LATEST_BPS = "直近のBPS"
+
+# 事前に計算する平均値の期間 (-1は全期間)
+CALC_YEARS_LIST = [1, 3, 5, -1]
+
+FUNDAMENTALS_CSV_FILENAME = "fundamentals.csv"
 STOCK_PRICE = "株価"
 
 
 # フォルダ名とファイル名
 DATA_DIRNAME = "data"
+HTTP_CACHE_DIRNAME = "http-cache"
 
 ENCODING = "utf-8"
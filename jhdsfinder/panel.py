@@ -0,0 +1,364 @@
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from jhdsfinder.names import *
+from jhdsfinder.dataframe import *
+from jhdsfinder.kernels import *
+
+# CompanyData.get_long_term_performance と同じ順番の業績のカラム
+PERFORMANCE_COLUMNS = [
+    COMPANY_CODE,
+    DIVIDEND_YIELD,
+    DIVIDEND_INCREASE_CONTINUOUS,
+    REVENUE_GRAD,
+    EPS_GRAD,
+    BPS_GRAD,
+    DIVIDEND_PER_SHARE_GRAD,
+    OPERATING_CASH_FLOW_GRAD,
+    CASH_EQUIVALENTS_GRAD,
+    OPERATING_CASH_FLOW_SURPLUS_EVERY_YEAR,
+    OPERATING_PROFIT_MARGIN_AVG,
+    EQUITY_RATIO_AVG,
+    CURRENT_RATIO_AVG,
+    DIVIDEND_PAYOUT_RATIO_AVG,
+    ROE_AVG,
+    ROA_AVG,
+    PER,
+    PBR,
+    INDUSTRY_CATEGORY_33,
+    SCALE_CATEGORY,
+]
+# 真偽値の指標 (パーセンタイルは意味がない)
+BOOLEAN_COLUMNS = [DIVIDEND_INCREASE_CONTINUOUS, OPERATING_CASH_FLOW_SURPLUS_EVERY_YEAR]
+# 33業種区分内のパーセンタイルを計算する指標 (例: 業種内で上位20%は80以上)
+PERCENTILE_COLUMNS = [
+    column
+    for column in PERFORMANCE_COLUMNS
+    if column not in [COMPANY_CODE, INDUSTRY_CATEGORY_33, SCALE_CATEGORY]
+    and column not in BOOLEAN_COLUMNS
+]
+INDUSTRY_PERCENTILE_COLUMNS = [
+    column + INDUSTRY_PERCENTILE for column in PERCENTILE_COLUMNS
+]
+
+
+class FinancePanel:
+    """
+    縦持ちのfy-data-allを (銘柄, 年度, カラム) の3次元配列として保持する
+    同じ銘柄と年度の行が重複する場合は後の行の値を使う
+    """
+
+    def __init__(
+        self,
+        fy_all_df: DataFrame,
+        company_codes: List[str],
+        columns: List[str] = None,
+        dtype=np.float64,
+    ) -> None:
+        if columns is None:
+            columns = [
+                column
+                for column in fy_all_df.columns
+                if column not in [COMPANY_CODE, FISCAL_YEAR]
+            ]
+        company_codes = list(company_codes)
+        codes = fy_all_df[COMPANY_CODE].values.astype(str)
+        company_idx = pd.Index(company_codes).get_indexer(codes)
+        valid = company_idx >= 0
+        years = fy_all_df[FISCAL_YEAR].values.astype(float)[valid].astype(int)
+        fiscal_years = np.unique(years)
+        year_idx = np.searchsorted(fiscal_years, years)
+        shape = (len(company_codes), len(fiscal_years))
+        values = np.full(shape + (len(columns),), np.nan, dtype=dtype)
+        values[company_idx[valid], year_idx] = (
+            fy_all_df.loc[:, columns].astype(float).values[valid]
+        )
+        # 銘柄と年度の行がfy-data-allに存在するか
+        exists = np.zeros(shape, dtype=bool)
+        exists[company_idx[valid], year_idx] = True
+        self.set_arrays(values, exists, company_codes, fiscal_years, columns)
+
+    def set_arrays(
+        self,
+        values: np.ndarray,
+        exists: np.ndarray,
+        company_codes: List[str],
+        fiscal_years: np.ndarray,
+        columns: List[str],
+    ):
+        self.values = values
+        self.exists = exists
+        self.company_codes = list(company_codes)
+        self.fiscal_years = np.asarray(fiscal_years)
+        self.columns = list(columns)
+        # 銘柄コード, 年度, カラムから配列の位置を引くための辞書
+        self.code_index = {code: i for i, code in enumerate(self.company_codes)}
+        self.year_index = {year: i for i, year in enumerate(self.fiscal_years)}
+        self.column_index = {column: i for i, column in enumerate(self.columns)}
+
+    @classmethod
+    def from_arrays(
+        cls,
+        values: np.ndarray,
+        exists: np.ndarray,
+        company_codes: List[str],
+        fiscal_years: np.ndarray,
+        columns: List[str],
+    ):
+        finance_panel = cls.__new__(cls)
+        finance_panel.set_arrays(values, exists, company_codes, fiscal_years, columns)
+        return finance_panel
+
+    def take(self, company_codes: List[str]):
+        """指定した銘柄だけのFinancePanelを返す"""
+        idx = [self.code_index[code] for code in company_codes]
+        return FinancePanel.from_arrays(
+            self.values[idx],
+            self.exists[idx],
+            company_codes,
+            self.fiscal_years,
+            self.columns,
+        )
+
+    def to_shared_memory(self) -> Tuple[shared_memory.SharedMemory, dict]:
+        """
+        値の配列を共有メモリに書き出し, 別プロセスから復元するための情報を返す
+        共有メモリは呼び出し側でclose()とunlink()をする
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(self.values.nbytes, 1))
+        shared_values = np.ndarray(
+            self.values.shape, dtype=self.values.dtype, buffer=shm.buf
+        )
+        shared_values[:] = self.values
+        spec = {
+            "name": shm.name,
+            "shape": self.values.shape,
+            "dtype": self.values.dtype.str,
+            "exists": self.exists,
+            "company_codes": self.company_codes,
+            "fiscal_years": self.fiscal_years,
+            "columns": self.columns,
+        }
+        return shm, spec
+
+    @classmethod
+    def from_shared_memory(cls, spec: dict):
+        """
+        to_shared_memory の情報から共有メモリを参照するFinancePanelを作る
+        共有メモリは FinancePanel を使い終わってからclose()する
+        """
+        shm = shared_memory.SharedMemory(name=spec["name"])
+        values = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=shm.buf)
+        finance_panel = cls.from_arrays(
+            values,
+            spec["exists"],
+            spec["company_codes"],
+            spec["fiscal_years"],
+            spec["columns"],
+        )
+        return finance_panel, shm
+
+    def get_company_values(self, company_code: str) -> np.ndarray:
+        """(年度, カラム) の配列のビューを返す"""
+        return self.values[self.code_index[company_code]]
+
+    def get_values(
+        self, company_code: str, column: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """年度と値の配列のビューを返す (データがない年度はNaN)"""
+        i = self.code_index[company_code]
+        j = self.column_index[column]
+        return self.fiscal_years, self.values[i, :, j]
+
+    def get_column_values(self, column: str) -> np.ndarray:
+        """(銘柄, 年度) の配列のビューを返す"""
+        return self.values[:, :, self.column_index[column]]
+
+    def get_latest_year(self, company_code: str) -> int:
+        """fy-data-allに行がある最新の年度"""
+        exists = self.exists[self.code_index[company_code]]
+        return self.fiscal_years[np.nonzero(exists)[0][-1]]
+
+    def get_years(self) -> np.ndarray:
+        """(銘柄, 年度) の形に揃えた年度の配列を返す"""
+        shape = (len(self.company_codes), len(self.fiscal_years))
+        return np.broadcast_to(self.fiscal_years.astype(float), shape)
+
+
+def get_latest_ratio(
+    numerator: np.ndarray, denominator: np.ndarray, scale: float = 1.0
+) -> np.ndarray:
+    """株価を使う指標の計算 (分子か分母の値がない場合はNaN)"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = numerator / denominator * scale
+    return ratio
+
+
+def make_company_fundamentals_dataframe(
+    finance_panel: FinancePanel,
+    market_df: DataFrame,
+    calc_years: int = 3,
+) -> CompanyFundamentalsDataFrame:
+    """
+    CompanyData.get_long_term_performance のうち株価を使わない指標を全銘柄に対して一括で計算する
+    株価を使う指標の計算用に, 外れ値除去後の直近の1株配当, EPS, BPSも含める
+    """
+    fundamentals_dfs = make_company_fundamentals_dataframes(
+        finance_panel, market_df, [calc_years]
+    )
+    return fundamentals_dfs[calc_years]
+
+
+def make_company_fundamentals_dataframes(
+    finance_panel: FinancePanel,
+    market_df: DataFrame,
+    calc_years_list: List[int] = [3],
+) -> Dict[int, CompanyFundamentalsDataFrame]:
+    """
+    平均値を計算する期間ごとの株価を使わない指標を返す
+    外れ値除去などの期間によらない計算は一度だけ行う
+    """
+    company_codes = finance_panel.company_codes
+    years = finance_panel.get_years()
+
+    def get_values(column: str) -> Tuple[np.ndarray, np.ndarray]:
+        x = finance_panel.get_column_values(column).astype(float)
+        mask = remove_outliers_mad(x, ~np.isnan(x))
+        return x, mask
+
+    # 直近の1株配当, EPS, BPS
+    dividend_per_share, dividend_per_share_mask = get_values(DIVIDEND_PER_SHARE)
+    latest_dividend = get_last_values(dividend_per_share, dividend_per_share_mask)
+    eps, eps_mask = get_values(EPS)
+    latest_eps = get_last_values(eps, eps_mask)
+    bps, bps_mask = get_values(BPS)
+    latest_bps = get_last_values(bps, bps_mask)
+    # 連続増配
+    dividend_increase_continuous = is_non_decreasing(
+        dividend_per_share, dividend_per_share_mask
+    )
+    # 上昇傾向のトレンド
+    gradients = {}
+    for grad_column, column in [
+        (REVENUE_GRAD, REVENUE),
+        (EPS_GRAD, EPS),
+        (BPS_GRAD, BPS),
+        (DIVIDEND_PER_SHARE_GRAD, DIVIDEND_PER_SHARE),
+        (OPERATING_CASH_FLOW_GRAD, OPERATING_CASH_FLOW),
+        (CASH_EQUIVALENTS_GRAD, CASH_EQUIVALENTS),
+    ]:
+        x, mask = get_values(column)
+        gradients[grad_column] = get_gradients(years, x, mask)
+    # 営業CFが毎年黒字
+    operating_cash_flows, mask = get_values(OPERATING_CASH_FLOW)
+    operating_cash_flows_surplus = ~(mask & (operating_cash_flows < 0.0)).any(axis=1)
+    # 中長期の平均業績 (外れ値を除いた値と期間ごとの平均値)
+    average_values = {}
+    for avg_column, column in [
+        (OPERATING_PROFIT_MARGIN_AVG, OPERATING_PROFIT_MARGIN),
+        (EQUITY_RATIO_AVG, EQUITY_RATIO),
+        (DIVIDEND_PAYOUT_RATIO_AVG, DIVIDEND_PAYOUT_RATIO),
+        (ROE_AVG, ROE),
+        (ROA_AVG, ROA),
+    ]:
+        average_values[avg_column] = get_values(column)
+    ## 流動比率 (現金等/短期借入金*100)
+    short_term_debt = finance_panel.get_column_values(SHORT_TERM_DEBT).astype(float)
+    cash_equivalents = finance_panel.get_column_values(CASH_EQUIVALENTS).astype(float)
+    current_ratio = cash_equivalents / (short_term_debt + 1e-8) * 100
+    mask = remove_outliers_mad(current_ratio, ~np.isnan(current_ratio))
+    average_values[CURRENT_RATIO_AVG] = (current_ratio, mask)
+    # 業種と規模
+    market = market_df.set_index(COMPANY_CODE).reindex(company_codes)
+
+    fundamentals_dfs = {}
+    for calc_years in calc_years_list:
+        averages = {
+            avg_column: get_averages(x, mask, calc_years)
+            for avg_column, (x, mask) in average_values.items()
+        }
+        data = {
+            COMPANY_CODE: company_codes,
+            DIVIDEND_INCREASE_CONTINUOUS: dividend_increase_continuous,
+            REVENUE_GRAD: gradients[REVENUE_GRAD],
+            EPS_GRAD: gradients[EPS_GRAD],
+            BPS_GRAD: gradients[BPS_GRAD],
+            DIVIDEND_PER_SHARE_GRAD: gradients[DIVIDEND_PER_SHARE_GRAD],
+            OPERATING_CASH_FLOW_GRAD: gradients[OPERATING_CASH_FLOW_GRAD],
+            CASH_EQUIVALENTS_GRAD: gradients[CASH_EQUIVALENTS_GRAD],
+            OPERATING_CASH_FLOW_SURPLUS_EVERY_YEAR: operating_cash_flows_surplus,
+            OPERATING_PROFIT_MARGIN_AVG: averages[OPERATING_PROFIT_MARGIN_AVG],
+            EQUITY_RATIO_AVG: averages[EQUITY_RATIO_AVG],
+            CURRENT_RATIO_AVG: averages[CURRENT_RATIO_AVG],
+            DIVIDEND_PAYOUT_RATIO_AVG: averages[DIVIDEND_PAYOUT_RATIO_AVG],
+            ROE_AVG: averages[ROE_AVG],
+            ROA_AVG: averages[ROA_AVG],
+            INDUSTRY_CATEGORY_33: market[INDUSTRY_CATEGORY_33].values,
+            SCALE_CATEGORY: market[SCALE_CATEGORY].values,
+            LATEST_DIVIDEND_PER_SHARE: latest_dividend,
+            LATEST_EPS: latest_eps,
+            LATEST_BPS: latest_bps,
+        }
+        df = pd.DataFrame(data)
+        fundamentals_dfs[calc_years] = CompanyFundamentalsDataFrame(df)
+    return fundamentals_dfs
+
+
+def join_stock_price(
+    fundamentals_df: CompanyFundamentalsDataFrame, stock_price_df: DataFrame
+) -> CompanyPerformanceDataFrame:
+    """
+    株価を使う指標 (配当利回り, PER, PBR) を計算し, 株価を使わない指標と結合する
+    """
+    company_codes = fundamentals_df[COMPANY_CODE].values.astype(str)
+    stock_price = (
+        stock_price_df.drop_duplicates(subset=COMPANY_CODE)
+        .set_index(COMPANY_CODE)[CLOSE_PRICE]
+        .reindex(company_codes)
+        .values.astype(float)
+    )
+    stock_price = np.where(stock_price == 0.0, np.nan, stock_price)
+    latest_dividend = fundamentals_df[LATEST_DIVIDEND_PER_SHARE].values.astype(float)
+    latest_eps = fundamentals_df[LATEST_EPS].values.astype(float)
+    latest_bps = fundamentals_df[LATEST_BPS].values.astype(float)
+    df = pd.DataFrame(fundamentals_df, copy=True)
+    df[COMPANY_CODE] = company_codes
+    df[DIVIDEND_YIELD] = get_latest_ratio(latest_dividend, stock_price, 100)
+    df[PER] = get_latest_ratio(stock_price, latest_eps)
+    df[PBR] = get_latest_ratio(stock_price, latest_bps)
+    df = df.loc[:, PERFORMANCE_COLUMNS]
+    df.reset_index(drop=True, inplace=True)
+    return CompanyPerformanceDataFrame(df)
+
+
+def add_industry_percentile_columns(
+    performance_df: CompanyPerformanceDataFrame,
+) -> CompanyPerformanceDataFrame:
+    """
+    各指標の33業種区分内でのパーセンタイル (0から100) のカラムを追加する
+    全ての指標を業種ごとに一度にまとめて順位付けする (値がない銘柄はNaN)
+    """
+    values = performance_df[PERCENTILE_COLUMNS].astype(float)
+    industries = performance_df[INDUSTRY_CATEGORY_33].values.astype(str)
+    percentiles = values.groupby(industries).rank(pct=True) * 100
+    percentiles.columns = INDUSTRY_PERCENTILE_COLUMNS
+    df = pd.concat([performance_df, percentiles], axis=1)
+    return CompanyPerformanceDataFrame(df)
+
+
+def make_company_performance_dataframe(
+    finance_panel: FinancePanel,
+    market_df: DataFrame,
+    stock_price_df: DataFrame,
+    calc_years: int = 3,
+) -> CompanyPerformanceDataFrame:
+    """
+    CompanyData.get_long_term_performance を全銘柄に対して一括で計算する
+    """
+    fundamentals_df = make_company_fundamentals_dataframe(
+        finance_panel, market_df, calc_years
+    )
+    return join_stock_price(fundamentals_df, stock_price_df)
@@ -0,0 +1,212 @@
+"""
+スクリーニング条件の式を解析する
+
+例: 配当利回り >= 4 and PER < 12 and 33業種区分 in [銀行業, 保険業]
+
+    式   := 項 ("or" 項)*
+    項   := 因子 ("and" 因子)*
+    因子 := "not" 因子 | "(" 式 ")" | 比較
+    比較 := カラム 比較演算子 数値
+          | カラム "between" 数値 "and" 数値
+          | カラム ["not"] "in" "[" カテゴリ, ... "]"
+
+and, or, not, between, in の前後は空白か括弧で区切る (比較演算子の前後は省略できる)
+33業種区分のように数字で始まるカラム名があるので, 「4andPER」は区切らずにエラーにする
+数値のカラムとカテゴリのカラムを指定した場合は, 比較とinに使えるカラムを確かめる
+
+解析した結果 (プラン) はタプルの木で, 葉は次のどちらかになる
+    ("range", カラム, vmin, vmax)  vmin <= 値 <= vmax (Noneは制限なし)
+    ("in", カラム, (カテゴリ, ...))
+否定 (not, !=) しても, 参照するカラムに値がない銘柄は含めない
+"""
+
+import re
+import functools
+from typing import Iterator, List, Tuple
+import numpy as np
+
+AND = "and"
+OR = "or"
+NOT = "not"
+BETWEEN = "between"
+IN = "in"
+RANGE = "range"
+KEYWORDS = [AND, OR, NOT, BETWEEN, IN]
+
+# 区切り文字 (カラム名には使えない)
+DELIMITERS = r"\s()\[\]<>=!"
+TOKEN_PATTERN = re.compile(
+    rf"""
+    (?P<space>\s+)
+    |(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(?=[{DELIMITERS}]|$))
+    |(?P<operator>>=|<=|==|!=|>|<|=)
+    |(?P<paren>[()])
+    |(?P<list>\[[^\]]*\])
+    |(?P<name>[^{DELIMITERS}]+)
+    """,
+    re.VERBOSE,
+)
+# 区切らずにキーワードを続けた数値 (例: 4andPER)
+NUMBER_PREFIX_PATTERN = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:and|or)", re.IGNORECASE)
+# カテゴリを囲む引用符
+QUOTES = "\"'「」"
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def tokenize(query: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if match is None:
+            raise QuerySyntaxError(f"解析できない文字があります: {query[position:]}")
+        kind = match.lastgroup
+        value = match.group()
+        if kind == "name" and value.lower() in KEYWORDS:
+            kind = "keyword"
+            value = value.lower()
+        if kind != "space":
+            tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class QueryParser:
+    def __init__(
+        self,
+        query: str,
+        numerical_columns: Tuple[str, ...] = None,
+        categorical_columns: Tuple[str, ...] = None,
+    ) -> None:
+        self.tokens = tokenize(query)
+        self.position = 0
+        self.numerical_columns = numerical_columns
+        self.categorical_columns = categorical_columns
+
+    def parse(self) -> tuple:
+        if len(self.tokens) == 0:
+            raise QuerySyntaxError("条件がありません")
+        plan = self.parse_or()
+        if self.position < len(self.tokens):
+            raise QuerySyntaxError(f"余分な記述があります: {self.peek()[1]}")
+        return plan
+
+    def peek(self) -> Tuple[str, str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self, kind: str = None, value: str = None) -> str:
+        token_kind, token_value = self.peek()
+        if token_kind is None:
+            raise QuerySyntaxError("式が途中で終わっています")
+        if (kind is not None and token_kind != kind) or (
+            value is not None and token_value != value
+        ):
+            raise QuerySyntaxError(f"{value or kind} が必要です: {token_value}")
+        self.position += 1
+        return token_value
+
+    def accept_keyword(self, keyword: str) -> bool:
+        if self.peek() == ("keyword", keyword):
+            self.position += 1
+            return True
+        return False
+
+    def parse_or(self) -> tuple:
+        plans = [self.parse_and()]
+        while self.accept_keyword(OR):
+            plans.append(self.parse_and())
+        return plans[0] if len(plans) == 1 else (OR, *plans)
+
+    def parse_and(self) -> tuple:
+        plans = [self.parse_not()]
+        while self.accept_keyword(AND):
+            plans.append(self.parse_not())
+        return plans[0] if len(plans) == 1 else (AND, *plans)
+
+    def parse_not(self) -> tuple:
+        if self.accept_keyword(NOT):
+            return (NOT, self.parse_not())
+        if self.peek() == ("paren", "("):
+            self.next()
+            plan = self.parse_or()
+            self.next("paren", ")")
+            return plan
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> tuple:
+        column = self.next("name")
+        kind, value = self.peek()
+        if kind == "operator":
+            self.check_column(column, self.numerical_columns, "数値")
+            self.next()
+            return make_comparison(column, value, self.parse_number())
+        elif (kind, value) == ("keyword", BETWEEN):
+            self.check_column(column, self.numerical_columns, "数値")
+            self.next()
+            vmin = self.parse_number()
+            self.next("keyword", AND)
+            vmax = self.parse_number()
+            return (RANGE, column, vmin, vmax)
+        elif (kind, value) in [("keyword", IN), ("keyword", NOT)]:
+            self.check_column(column, self.categorical_columns, "カテゴリ")
+            negative = self.accept_keyword(NOT)
+            self.next("keyword", IN)
+            plan = (IN, column, self.parse_list())
+            return (NOT, plan) if negative else plan
+        raise QuerySyntaxError(f"{column} の後に比較がありません")
+
+    def check_column(self, column: str, columns: Tuple[str, ...], name: str):
+        if columns is not None and column not in columns:
+            raise QuerySyntaxError(f"{name}のカラムではありません: {column}")
+
+    def parse_number(self) -> float:
+        kind, value = self.peek()
+        if kind == "name" and NUMBER_PREFIX_PATTERN.match(value):
+            raise QuerySyntaxError(
+                f"数値の後のキーワードは空白で区切ってください: {value}"
+            )
+        return float(self.next("number"))
+
+    def parse_list(self) -> Tuple[str, ...]:
+        text = self.next("list")[1:-1]
+        categories = [c.strip().strip(QUOTES) for c in text.split(",")]
+        return tuple(c for c in categories if c != "")
+
+
+def make_comparison(column: str, operator: str, value: float) -> tuple:
+    # 境界を含まない比較は隣の浮動小数点数を境界にする
+    if operator == ">=":
+        return (RANGE, column, value, None)
+    elif operator == ">":
+        return (RANGE, column, float(np.nextafter(value, np.inf)), None)
+    elif operator == "<=":
+        return (RANGE, column, None, value)
+    elif operator == "<":
+        return (RANGE, column, None, float(np.nextafter(value, -np.inf)))
+    elif operator in ["==", "="]:
+        return (RANGE, column, value, value)
+    else:
+        return (NOT, (RANGE, column, value, value))
+
+
+@functools.lru_cache(maxsize=256)
+def parse_query(
+    query: str,
+    numerical_columns: Tuple[str, ...] = None,
+    categorical_columns: Tuple[str, ...] = None,
+) -> tuple:
+    """式を解析したプランを返す (同じ式は解析し直さない)"""
+    return QueryParser(query, numerical_columns, categorical_columns).parse()
+
+
+def iter_leaves(plan: tuple) -> Iterator[tuple]:
+    if plan[0] in [AND, OR, NOT]:
+        for child in plan[1:]:
+            yield from iter_leaves(child)
+    else:
+        yield plan
@@ -1,8 +1,15 @@
-from typing import List
+import os
+import itertools
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
 import numpy as np
+import pandas as pd
 
 from jhdsfinder.names import *
 from jhdsfinder.dataframe import CompanyPerformanceDataFrame
+from jhdsfinder import query
+from jhdsfinder.panel import INDUSTRY_PERCENTILE_COLUMNS
 
 CATEGORICAL_COLUMNS = [INDUSTRY_CATEGORY_33, SCALE_CATEGORY]
 NUMERICAL_COLUMNS = [
@@ -27,6 +34,109 @@ NUMERICAL_COLUMNS = [
     # CONTINUOUS_DIVIDEND_YEARS_AVG,
     # TOTAL_ASSETS_CASH_RATIO_AVG,
 ]
+# 33業種区分内でのパーセンタイル
+NUMERICAL_COLUMNS = NUMERICAL_COLUMNS + INDUSTRY_PERCENTILE_COLUMNS
+
+
+# 総合スコアの既定の重み (配当性向は低い方を良いとする)
+SCORE_WEIGHTS = {
+    DIVIDEND_YIELD: 1.0,
+    EPS_GRAD: 1.0,
+    EQUITY_RATIO_AVG: 1.0,
+    DIVIDEND_PAYOUT_RATIO_AVG: -1.0,
+}
+# 指標の正規化の方法
+ZSCORE = "zscore"
+RANK = "rank"
+
+# explainの結果のカラム
+FUNNEL_CONDITION = "条件"
+FUNNEL_SURVIVORS = "残った企業数"
+FUNNEL_ONLY_FAILED = "この条件のみで除外された企業数"
+
+# まとめて指定できるカテゴリ
+CATEGORY_DICTS = {
+    INDUSTRY_CATEGORY_33: INDUSTRY_CATEGORY_DICT,
+    SCALE_CATEGORY: SCALE_CATEGORY_DICT,
+}
+# 0から255の値の立っているビットの数
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1
+)
+
+
+class CategoryBitmapIndex:
+    """
+    カテゴリの値ごとに該当する銘柄をビット集合で保持する
+    category_dictでまとめたカテゴリはまとめた値のビット集合の和にする
+    値と同じ名前のまとめは値として扱う (isinと同じ結果にする)
+    """
+
+    def __init__(self, values: np.ndarray, category_dict: dict = {}) -> None:
+        values = np.asarray(values).astype(str)
+        self.n_values = len(values)
+        self.empty_bitset = np.packbits(np.zeros(self.n_values, dtype=bool))
+        self.bitsets = {}
+        for value in np.unique(values):
+            self.bitsets[value] = np.packbits(values == value)
+        self.group_bitsets = {}
+        for category, category_list in category_dict.items():
+            if not isinstance(category_list, list):
+                # 全てのカテゴリ
+                self.group_bitsets[category] = np.packbits(
+                    np.ones(self.n_values, dtype=bool)
+                )
+            elif category not in category_list:
+                self.group_bitsets[category] = self.get_bitset(category_list)
+
+    def get_category_bitset(self, category: str) -> np.ndarray:
+        if category in self.bitsets:
+            return self.bitsets[category]
+        return self.group_bitsets.get(category, self.empty_bitset)
+
+    def get_bitset(self, category_list: list) -> np.ndarray:
+        bitsets = [self.get_category_bitset(c) for c in category_list]
+        if len(bitsets) == 0:
+            return self.empty_bitset
+        return np.bitwise_or.reduce(bitsets)
+
+    def get_mask(self, category_list: list) -> np.ndarray:
+        bitset = self.get_bitset(category_list)
+        return np.unpackbits(bitset, count=self.n_values).view(bool)
+
+    def count(self, category_list: list) -> int:
+        bitset = self.get_bitset(category_list)
+        return int(POPCOUNT_TABLE[bitset].sum())
+
+
+class SortedColumnIndex:
+    """
+    数値のカラムの並び替えた値と元の位置を保持し, 範囲に入る銘柄を二分探索で求める
+    NaNの銘柄は含めない
+    """
+
+    def __init__(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=float)
+        order = np.argsort(values, kind="stable")
+        n_valid = np.count_nonzero(~np.isnan(values))
+        self.order = order[:n_valid]
+        self.sorted_values = values[self.order]
+
+    def get_range(self, vmin: float = None, vmax: float = None) -> Tuple[int, int]:
+        """並び替えた値のうち vmin <= 値 <= vmax となる範囲を返す"""
+        start = 0 if vmin is None else np.searchsorted(self.sorted_values, vmin, "left")
+        stop = len(self.sorted_values)
+        if vmax is not None:
+            stop = np.searchsorted(self.sorted_values, vmax, "right")
+        return int(start), int(max(start, stop))
+
+    def count(self, vmin: float = None, vmax: float = None) -> int:
+        start, stop = self.get_range(vmin, vmax)
+        return stop - start
+
+    def get_indices(self, vmin: float = None, vmax: float = None) -> np.ndarray:
+        start, stop = self.get_range(vmin, vmax)
+        return self.order[start:stop]
 
 
 class Condition:
@@ -49,6 +159,10 @@ class CategoricalCondition(Condition):
         text = f"column: {self.column}\ncategories: {self.category_list}\n"
         return text
 
+    def to_text(self) -> str:
+        categories = ", ".join(self.category_list or [])
+        return f"{self.column} in [{categories}]"
+
 
 class NumericalCondition(Condition):
     def __init__(self, column: str, vmin: float = None, vmax: float = None) -> None:
@@ -58,7 +172,8 @@ class NumericalCondition(Condition):
             assert isinstance(vmin, int) or isinstance(vmin, float)
         if vmax is not None:
             assert isinstance(vmax, int) or isinstance(vmax, float)
-        self.screen_flag = (vmin is not None) and (vmax is not None)
+        # 上限も下限もない場合はスクリーニングしない
+        self.screen_flag = (vmin is None) and (vmax is None)
         self.vmin = vmin
         self.vmax = vmax
 
@@ -66,6 +181,42 @@ class NumericalCondition(Condition):
         text = f"column: {self.column}\nvmin: {self.vmin}\nvmax: {self.vmax}\n"
         return text
 
+    def to_text(self) -> str:
+        if self.vmin is not None and self.vmax is not None:
+            return f"{self.vmin:g} <= {self.column} <= {self.vmax:g}"
+        elif self.vmin is not None:
+            return f"{self.column} >= {self.vmin:g}"
+        elif self.vmax is not None:
+            return f"{self.column} <= {self.vmax:g}"
+        else:
+            return self.column
+
+
+class QueryCondition(Condition):
+    """式で指定した条件 (式の書き方はjhdsfinder.queryを参照)"""
+
+    def __init__(self, text: str) -> None:
+        super().__init__(text.strip())
+        self.plan = query.parse_query(
+            self.column, tuple(NUMERICAL_COLUMNS), tuple(CATEGORICAL_COLUMNS)
+        )
+
+    def __str__(self) -> str:
+        return f"query: {self.column}\n"
+
+    def to_text(self) -> str:
+        return self.column
+
+
+def make_condition(column: str, values) -> Condition:
+    """カテゴリのリストか (vmin, vmax) から条件を作る"""
+    if values is None or isinstance(values, list):
+        category_list = values
+        return CategoricalCondition(column, category_list)
+    else:
+        vmin, vmax = values
+        return NumericalCondition(column, vmin, vmax)
+
 
 class Conditions:
     def __init__(self, data: List[Condition]) -> None:
@@ -78,16 +229,12 @@ class Conditions:
         # for column, (vmin, vmax) in dictionay.items():
         for column, values in dictionay.items():
             print(column, values)
-            if values is None or isinstance(values, list):
-                category_list = values
-                data.append(CategoricalCondition(column, category_list))
-            else:
-                vmin, vmax = values
-                data.append(NumericalCondition(column, vmin, vmax))
+            data.append(make_condition(column, values))
         return Conditions(data)
 
     def __iter__(self):
-        return self
+        # 何度でも繰り返せるようにする
+        return iter(self.data)
 
     def __next__(self):
         if self.index < len(self.data):
@@ -105,47 +252,615 @@ class Conditions:
         return Conditions(data)
 
 
+def count_passing_companies(
+    membership: np.ndarray, fail_masks: np.ndarray
+) -> np.ndarray:
+    """
+    membership (条件の組, 条件) と fail_masks (条件, 銘柄) から
+    条件の組ごとに全ての条件を満たす銘柄数を返す
+    """
+    fail_counts = membership.astype(np.float32) @ fail_masks.astype(np.float32)
+    return np.count_nonzero(fail_counts == 0, axis=1)
+
+
+def count_grid_companies(base_mask: np.ndarray, axis_masks: List[np.ndarray]):
+    """
+    共通の条件のマスクと軸ごとの条件のマスク (候補, 銘柄) をブロードキャストして
+    グリッドの点ごとに全ての条件を満たす銘柄数を返す
+    """
+    n_axes = len(axis_masks)
+    mask = base_mask
+    for i, masks in enumerate(axis_masks):
+        shape = [1] * n_axes + [masks.shape[-1]]
+        shape[i] = len(masks)
+        mask = mask & masks.reshape(shape)
+    return np.count_nonzero(mask, axis=-1)
+
+
+def normalize_values(
+    values: np.ndarray, method: str = ZSCORE, groups: np.ndarray = None
+) -> np.ndarray:
+    """
+    値を正規化する (groupsを指定した場合はグループごとに正規化する)
+    zscoreは平均0, 標準偏差1に, rankは0から1の順位の割合にする. NaNはNaNのまま
+    """
+    if groups is None:
+        groups = np.zeros(len(values), dtype=np.intp)
+    if method == ZSCORE:
+        valid = ~np.isnan(values)
+        counts = np.maximum(np.bincount(groups, weights=valid), 1)
+        means = np.bincount(groups, weights=np.where(valid, values, 0.0)) / counts
+        deviations = np.where(valid, values - means[groups], 0.0)
+        stds = np.sqrt(np.bincount(groups, weights=deviations**2) / counts)[groups]
+        normalized = np.divide(
+            deviations, stds, out=np.zeros(len(values)), where=stds > 0
+        )
+        return np.where(valid, normalized, np.nan)
+    elif method == RANK:
+        return pd.Series(values).groupby(groups).rank(pct=True).values
+    else:
+        raise ValueError(method)
+
+
+class BatchScreeningResult:
+    """
+    run_batchの結果
+    countsは条件の組ごとの該当企業数 (グリッドの場合はグリッドの形)
+    """
+
+    def __init__(
+        self,
+        company_codes: np.ndarray,
+        counts: np.ndarray,
+        get_mask: Callable[[tuple], np.ndarray],
+    ) -> None:
+        self.company_codes = company_codes
+        self.counts = counts
+        self.get_mask = get_mask
+
+    def get_company_codes(self, index) -> np.ndarray:
+        """指定した条件の組の銘柄コードを返す (必要なときだけ計算する)"""
+        return self.company_codes[self.get_mask(index)]
+
+
+class ScreeningDelta:
+    """
+    update_rowsの結果
+    判定し直した銘柄と, そのうち該当するようになった銘柄, 該当しなくなった銘柄
+    """
+
+    def __init__(
+        self,
+        company_codes: np.ndarray,
+        added_company_codes: np.ndarray,
+        removed_company_codes: np.ndarray,
+    ) -> None:
+        self.company_codes = company_codes
+        self.added_company_codes = added_company_codes
+        self.removed_company_codes = removed_company_codes
+
+    def __len__(self) -> int:
+        return len(self.added_company_codes) + len(self.removed_company_codes)
+
+
 class CompanyScreener:
+    # 保持する条件ごとのマスクの最大数
+    mask_cache_size = 1024
+
     def __init__(self, df: CompanyPerformanceDataFrame):
         self.df = df
+        self.company_codes = df[COMPANY_CODE].values
+        # スクリーニングに使うカラムは配列として取り出しておく
+        self.numerical_values = {
+            column: df[column].values.astype(float)
+            for column in NUMERICAL_COLUMNS
+            if column in df.columns
+        }
+        # 範囲に入る銘柄数を数えるための並び替えた索引
+        self.sorted_indexes = {
+            column: SortedColumnIndex(values)
+            for column, values in self.numerical_values.items()
+        }
+        # カテゴリのカラムはビット集合の索引にしておく
+        self.category_values = {
+            column: df[column].values.astype(str)
+            for column in CATEGORICAL_COLUMNS
+            if column in df.columns
+        }
+        self.category_indexes = {
+            column: CategoryBitmapIndex(values, CATEGORY_DICTS[column])
+            for column, values in self.category_values.items()
+        }
+        self.clear_mask_cache()
+        self.normalized_values = {}
+
+    def clear_mask_cache(self):
+        self.mask_cache = OrderedDict()
+        self.mask_cache_hits = 0
+        self.mask_cache_misses = 0
+        # 直前に組み合わせた条件と, 銘柄ごとの満たしていない条件の数
+        self.active_masks = {}
+        self.active_conditions = {}
+        self.active_keys = Counter()
+        self.fail_counts = np.zeros(len(self.company_codes), dtype=np.int32)
+        self.combined_mask = self.fail_counts == 0
+        self.n_incremental_updates = 0
+        self.n_full_updates = 0
+
+    def get_mask_cache_info(self) -> dict:
+        return {
+            "hits": self.mask_cache_hits,
+            "misses": self.mask_cache_misses,
+            "size": len(self.mask_cache),
+            "max_size": self.mask_cache_size,
+            "incremental_updates": self.n_incremental_updates,
+            "full_updates": self.n_full_updates,
+        }
 
     def run(self, conditions: Conditions) -> np.ndarray:
-        new_df = self.df.copy()
-        for condition in conditions:
-            new_df = self._screen(new_df, condition)
-        company_codes = new_df[COMPANY_CODE].values
+        mask = self.get_mask(conditions)
+        company_codes = self.company_codes[mask]
         return company_codes
 
-    def _screen(self, df: CompanyPerformanceDataFrame, condition: Condition):
+    def get_mask(self, conditions: Conditions) -> np.ndarray:
+        """
+        全ての条件を満たす銘柄のマスクを返す
+        直前の条件から変わった条件のマスクだけを満たしていない条件の数に足し引きする
+        """
+        keyed_masks = self.get_keyed_masks(conditions)
+        keys = Counter(key for key, _ in keyed_masks)
+        self.active_conditions = {
+            self.get_condition_key(c): c for c in conditions if not c.screen_flag
+        }
+        removed_keys = self.active_keys - keys
+        added_keys = keys - self.active_keys
+        n_changes = sum(removed_keys.values()) + sum(added_keys.values())
+        if n_changes == 0:
+            return self.combined_mask
+        masks = dict(keyed_masks)
+        if n_changes <= len(keyed_masks):
+            self.n_incremental_updates += 1
+            for key, n in removed_keys.items():
+                self.fail_counts -= n * ~self.active_masks[key]
+            for key, n in added_keys.items():
+                self.fail_counts += n * ~masks[key]
+        else:
+            self.n_full_updates += 1
+            self.fail_counts = np.zeros(len(self.company_codes), dtype=np.int32)
+            for _, mask in keyed_masks:
+                self.fail_counts += ~mask
+        self.active_masks = masks
+        self.active_keys = keys
+        self.combined_mask = self.fail_counts == 0
+        self.combined_mask.setflags(write=False)
+        return self.combined_mask
+
+    def get_normalized_values(
+        self, column: str, method: str = ZSCORE, by_industry: bool = False
+    ) -> np.ndarray:
+        """正規化した指標を返す (by_industryの場合は業種ごとに正規化する)"""
+        key = (column, method, by_industry)
+        if key not in self.normalized_values:
+            groups = None
+            if by_industry:
+                industries = self.category_values[INDUSTRY_CATEGORY_33]
+                groups = np.unique(industries, return_inverse=True)[1]
+            self.normalized_values[key] = normalize_values(
+                self.numerical_values[column], method, groups
+            )
+        return self.normalized_values[key]
+
+    def score(
+        self,
+        weights: Dict[str, float] = None,
+        method: str = ZSCORE,
+        by_industry: bool = False,
+    ) -> np.ndarray:
+        """
+        正規化した指標を重み付けして平均した総合スコアを返す
+        値のない指標は平均的な値 (zscoreは0, rankは0.5) として扱う
+        """
+        weights = SCORE_WEIGHTS if weights is None else weights
+        neutral = 0.0 if method == ZSCORE else 0.5
+        scores = np.zeros(len(self.company_codes))
+        for column, weight in weights.items():
+            values = self.get_normalized_values(column, method, by_industry)
+            scores += weight * np.where(np.isnan(values), neutral, values)
+        return scores / sum(abs(weight) for weight in weights.values())
+
+    def top_k(
+        self,
+        k: int,
+        conditions: Conditions = None,
+        weights: Dict[str, float] = None,
+        method: str = ZSCORE,
+        by_industry: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        総合スコアの上位k社の銘柄コードとスコアを高い順に返す
+        conditionsを指定した場合は該当企業から選ぶ. 全体は並び替えずに上位k社だけを並び替える
+        直前に組み合わせた条件 (表示中のスクリーニング結果) は変えない
+        """
+        scores = self.score(weights, method, by_industry)
+        masks = [] if conditions is None else self.get_masks(conditions)
+        if len(masks) == 0:
+            candidates = np.arange(len(self.company_codes))
+        else:
+            candidates = np.flatnonzero(np.logical_and.reduce(masks))
+        k = min(k, len(candidates))
+        if k <= 0:
+            return self.company_codes[:0], scores[:0]
+        candidate_scores = scores[candidates]
+        top = np.argpartition(-candidate_scores, k - 1)[:k]
+        top = top[np.argsort(-candidate_scores[top], kind="stable")]
+        indices = candidates[top]
+        return self.company_codes[indices], scores[indices]
+
+    def update_rows(
+        self, df: CompanyPerformanceDataFrame, company_codes: list = None
+    ) -> ScreeningDelta:
+        """
+        company_codesの銘柄の値をdfの値に置き換え, 直前に組み合わせた条件で
+        その銘柄だけを判定し直して, 該当する銘柄の差分を返す
+        company_codesを指定しない場合は値が変わった銘柄を判定し直す
+        """
+        df_rows = pd.Index(df[COMPANY_CODE].values).get_indexer(self.company_codes)
+        assert np.all(df_rows >= 0)
+        new_numerical_values = {
+            column: df[column].values.astype(float)[df_rows]
+            for column in self.numerical_values
+        }
+        new_category_values = {
+            column: df[column].values.astype(str)[df_rows]
+            for column in self.category_values
+        }
+        if company_codes is None:
+            changed = np.zeros(len(self.company_codes), dtype=bool)
+            for column, values in new_numerical_values.items():
+                old_values = self.numerical_values[column]
+                changed |= ~(
+                    (values == old_values) | (np.isnan(values) & np.isnan(old_values))
+                )
+            for column, values in new_category_values.items():
+                changed |= values != self.category_values[column]
+            rows = np.flatnonzero(changed)
+        else:
+            rows = np.flatnonzero(np.isin(self.company_codes, company_codes))
+        self.df = df
+        self.normalized_values = {}
+        # 値を置き換え, 変わったカラムの索引だけを作り直す
+        for column, values in new_numerical_values.items():
+            old_values = self.numerical_values[column]
+            if np.array_equal(old_values[rows], values[rows], equal_nan=True):
+                continue
+            old_values[rows] = values[rows]
+            self.sorted_indexes[column] = SortedColumnIndex(old_values)
+        for column, values in new_category_values.items():
+            old_values = self.category_values[column]
+            if np.array_equal(old_values[rows], values[rows]):
+                continue
+            old_values[rows] = values[rows]
+            self.category_indexes[column] = CategoryBitmapIndex(
+                old_values, CATEGORY_DICTS[column]
+            )
+        # 直前の条件のマスクは判定し直した行だけを書き換え, 他のマスクは捨てる
+        was_screened = self.combined_mask[rows]
+        fail_counts = np.zeros(len(rows), dtype=np.int32)
+        masks = {}
+        for key, mask in self.active_masks.items():
+            mask = mask.copy()
+            mask[rows] = self._screen(self.active_conditions[key], rows)
+            mask.setflags(write=False)
+            masks[key] = mask
+            fail_counts += self.active_keys[key] * ~mask[rows]
+        self.mask_cache = OrderedDict(masks)
+        self.active_masks = masks
+        self.fail_counts[rows] = fail_counts
+        self.combined_mask = self.fail_counts == 0
+        self.combined_mask.setflags(write=False)
+        is_screened = self.combined_mask[rows]
+        return ScreeningDelta(
+            self.company_codes[rows],
+            self.company_codes[rows[is_screened & ~was_screened]],
+            self.company_codes[rows[was_screened & ~is_screened]],
+        )
+
+    def count_range(self, column: str, vmin: float = None, vmax: float = None) -> int:
+        """1つのカラムの範囲に入る銘柄数を返す"""
+        return self.sorted_indexes[column].count(vmin, vmax)
+
+    def count_with_range(
+        self,
+        conditions: Conditions,
+        condition: NumericalCondition,
+        vmin: float = None,
+        vmax: float = None,
+    ) -> int:
+        """
+        conditionの範囲をvminとvmaxに変えたときの該当企業数を返す
+        他の条件のマスクはキャッシュを使い, conditionの範囲は二分探索で求める
+        """
+        others = Conditions([c for c in conditions if c is not condition])
+        if vmin is None and vmax is None:
+            # 範囲を指定しない場合はスクリーニングしない
+            indices = np.arange(len(self.company_codes))
+        else:
+            indices = self.sorted_indexes[condition.column].get_indices(vmin, vmax)
+        masks = self.get_masks(others)
+        if len(masks) == 0:
+            return len(indices)
+        mask = np.logical_and.reduce(masks)
+        return int(np.count_nonzero(mask[indices]))
+
+    def explain(self, conditions: Conditions) -> pd.DataFrame:
+        """
+        条件ごとに, 順番に条件を適用したときに残った企業数と,
+        その条件だけを満たさずに除外された企業数を返す (スクリーニングしない条件は除く)
+        条件のマスクを重ねた配列から一度に計算する
+        """
+        screened = [c for c in conditions if not c.screen_flag]
+        masks = np.zeros((len(screened), len(self.company_codes)), dtype=bool)
+        for i, mask in enumerate(self.get_masks(screened)):
+            masks[i] = mask
+        survivors = np.count_nonzero(np.logical_and.accumulate(masks, axis=0), axis=1)
+        fails = ~masks
+        only_failed = np.count_nonzero(fails & (fails.sum(axis=0) == 1), axis=1)
+        df = pd.DataFrame(
+            {
+                FUNNEL_CONDITION: [c.to_text() for c in screened],
+                FUNNEL_SURVIVORS: survivors,
+                FUNNEL_ONLY_FAILED: only_failed,
+            }
+        )
+        return df
+
+    def solve_threshold(
+        self, conditions: Conditions, condition: NumericalCondition, n_companies: int
+    ) -> Tuple[float, int]:
+        """
+        他の条件と合わせた該当企業数がn_companies以下になる最も緩いconditionの閾値と,
+        その閾値での該当企業数を返す
+        閾値はvminが設定されていればvmin (vmaxはそのまま適用する), そうでなければvmaxとして求める
+        並び替えた値に沿った累積の該当企業数を二分探索するので, 閾値ごとにスクリーニングしない
+        """
+        sorted_index = self.sorted_indexes[condition.column]
+        values = sorted_index.sorted_values
+        if len(values) == 0:
+            return None, 0
+        others = Conditions([c for c in conditions if c is not condition])
+        masks = self.get_masks(others)
+        passing = np.ones(len(self.company_codes), dtype=bool)
+        if len(masks) > 0:
+            passing = np.logical_and.reduce(masks)
+        passing = passing[sorted_index.order]
+        if condition.vmin is not None or condition.vmax is None:
+            if condition.vmax is not None:
+                # vmaxはそのまま適用してからvminを求める
+                passing = passing & (values <= condition.vmax)
+            # counts[i]: values[i]以上の該当企業数 (単調減少)
+            counts = np.cumsum(passing[::-1].astype(int))[::-1]
+            i = np.searchsorted(-counts, -n_companies, "left")
+            if i < len(values) and values[i - 1] == values[i] and i > 0:
+                # 同じ値の途中では閾値にできないので次の値にする
+                i = np.searchsorted(values, values[i], "right")
+            if i >= len(values):
+                return float(np.nextafter(values[-1], np.inf)), 0
+            return float(values[i]), int(counts[i])
+        else:
+            # counts[i]: values[i]以下の該当企業数 (単調増加)
+            counts = np.cumsum(passing.astype(int))
+            i = np.searchsorted(counts, n_companies, "right") - 1
+            if 0 <= i < len(values) - 1 and values[i + 1] == values[i]:
+                # 同じ値の途中では閾値にできないので前の値にする
+                i = np.searchsorted(values, values[i], "left") - 1
+            if i < 0:
+                return float(np.nextafter(values[0], -np.inf)), 0
+            return float(values[i]), int(counts[i])
+
+    def run_batch(
+        self,
+        conditions_list: List[Conditions] = None,
+        grid: Dict[str, list] = None,
+        conditions: Conditions = None,
+        n_workers: int = 1,
+    ) -> BatchScreeningResult:
+        """
+        複数の条件の組の該当企業数をまとめて計算する
+        conditions_list: 条件の組のリスト
+        grid: カラムごとの (vmin, vmax) かカテゴリのリストの候補 (全ての組み合わせを計算する)
+        conditions: gridの全ての組み合わせに共通の条件
+        n_workers>1の場合は最初の軸 (または条件の組) を分割してプロセスで並列に計算する
+        """
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if grid is not None:
+            return self._run_grid(grid, conditions, n_workers)
+        # 全ての組で使う条件のマスクを一度だけ作る
+        key_index = {}
+        fail_masks = []
+        rows = []
+        for _conditions in conditions_list:
+            row = []
+            for key, mask in self.get_keyed_masks(_conditions):
+                if key not in key_index:
+                    key_index[key] = len(key_index)
+                    fail_masks.append(~mask)
+                row.append(key_index[key])
+            rows.append(row)
+        membership = np.zeros((len(rows), len(key_index)), dtype=bool)
+        for i, row in enumerate(rows):
+            membership[i, row] = True
+        fail_masks = np.array(fail_masks, dtype=bool).reshape(
+            len(key_index), len(self.company_codes)
+        )
+        if n_workers > 1:
+            chunks = np.array_split(membership, n_workers)
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [
+                    executor.submit(count_passing_companies, chunk, fail_masks)
+                    for chunk in chunks
+                ]
+                counts = np.concatenate([future.result() for future in futures])
+        else:
+            counts = count_passing_companies(membership, fail_masks)
+
+        def get_mask(index) -> np.ndarray:
+            return ~fail_masks[membership[index]].any(axis=0)
+
+        return BatchScreeningResult(self.company_codes, counts, get_mask)
+
+    def _run_grid(
+        self, grid: Dict[str, list], conditions: Conditions, n_workers: int = 1
+    ) -> BatchScreeningResult:
+        if conditions is None:
+            conditions = Conditions([])
+        base_mask = np.ones(len(self.company_codes), dtype=bool)
+        masks = self.get_masks(conditions)
+        if len(masks) > 0:
+            base_mask = np.logical_and.reduce(masks)
+        axis_masks = []
+        for column, values_list in grid.items():
+            masks = []
+            for values in values_list:
+                condition = make_condition(column, values)
+                mask = self.get_masks(Conditions([condition]))
+                if len(mask) == 0:
+                    # 範囲を指定しない候補はスクリーニングしない
+                    mask = [np.ones(len(self.company_codes), dtype=bool)]
+                masks.append(mask[0])
+            axis_masks.append(np.stack(masks))
+        if n_workers > 1 and len(axis_masks[0]) > 1:
+            chunks = np.array_split(axis_masks[0], min(n_workers, len(axis_masks[0])))
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [
+                    executor.submit(
+                        count_grid_companies, base_mask, [chunk] + axis_masks[1:]
+                    )
+                    for chunk in chunks
+                ]
+                counts = np.concatenate([future.result() for future in futures])
+        else:
+            counts = count_grid_companies(base_mask, axis_masks)
+
+        def get_mask(index) -> np.ndarray:
+            mask = base_mask.copy()
+            for i, masks in zip(index, axis_masks):
+                mask &= masks[i]
+            return mask
+
+        return BatchScreeningResult(self.company_codes, counts, get_mask)
+
+    def get_masks(self, conditions: Conditions) -> List[np.ndarray]:
+        """条件ごとのマスクを返す (スクリーニングしない条件は除く)"""
+        return [mask for _, mask in self.get_keyed_masks(conditions)]
+
+    def get_keyed_masks(self, conditions: Conditions) -> List[Tuple[tuple, np.ndarray]]:
+        masks = []
+        for condition in conditions:
+            if condition.screen_flag:
+                continue
+            key = self.get_condition_key(condition)
+            masks.append((key, self.get_condition_mask(key, condition)))
+        return masks
+
+    def get_condition_key(self, condition: Condition) -> tuple:
+        if isinstance(condition, NumericalCondition):
+            return (condition.column, condition.vmin, condition.vmax)
+        elif isinstance(condition, CategoricalCondition):
+            return (condition.column, frozenset(condition.category_list))
+        elif isinstance(condition, QueryCondition):
+            return ("query", condition.plan)
+        else:
+            raise ValueError(condition.column)
+
+    def get_condition_mask(self, key: tuple, condition: Condition) -> np.ndarray:
+        # 同じ条件のマスクはキャッシュから返す
+        if key in self.mask_cache:
+            self.mask_cache_hits += 1
+            self.mask_cache.move_to_end(key)
+            return self.mask_cache[key]
+        self.mask_cache_misses += 1
+        mask = self._screen(condition)
+        mask.setflags(write=False)
+        self.mask_cache[key] = mask
+        if len(self.mask_cache) > self.mask_cache_size:
+            self.mask_cache.popitem(last=False)
+        return mask
+
+    def _screen(self, condition: Condition, rows: np.ndarray = None) -> np.ndarray:
+        """条件のマスクを返す (rowsを指定した場合はその行だけを判定する)"""
         if condition.screen_flag:
-            pass
+            mask = None
         elif isinstance(condition, NumericalCondition):
-            df = self._screen_numerical_category(df, condition)
+            mask = self._screen_numerical_category(condition, rows)
         elif isinstance(condition, CategoricalCondition):
-            df = self._screen_categorical_category(df, condition)
+            mask = self._screen_categorical_category(condition, rows)
+        elif isinstance(condition, QueryCondition):
+            mask = self._screen_query(condition.plan, rows)
         else:
             raise ValueError(condition.column)
-        return df
+        return mask
 
     def _screen_numerical_category(
-        self, df: CompanyPerformanceDataFrame, condition: NumericalCondition
-    ):
-        column = condition.column
+        self, condition: NumericalCondition, rows: np.ndarray = None
+    ) -> np.ndarray:
+        values = self.numerical_values[condition.column]
+        if rows is not None:
+            values = values[rows]
         vmin = condition.vmin
         vmax = condition.vmax
-        if vmin is not None:
-            df = df[df[column] >= vmin]
-        if vmax is not None:
-            df = df[df[column] <= vmax]
-        return df
+        # NaNはどちらの比較でもFalseになる
+        if vmin is not None and vmax is not None:
+            mask = (values >= vmin) & (values <= vmax)
+        elif vmin is not None:
+            mask = values >= vmin
+        else:
+            mask = values <= vmax
+        return mask
 
     def _screen_categorical_category(
-        self, df: CompanyPerformanceDataFrame, condition: CategoricalCondition
-    ):
-        column = condition.column
-        category_list = condition.category_list
-        df = df[df[column].isin(category_list)]
-        return df
+        self, condition: CategoricalCondition, rows: np.ndarray = None
+    ) -> np.ndarray:
+        category_index = self.category_indexes[condition.column]
+        mask = category_index.get_mask(condition.category_list)
+        if rows is not None:
+            mask = mask[rows]
+        return mask
+
+    def _screen_query(self, plan: tuple, rows: np.ndarray = None) -> np.ndarray:
+        # 葉の条件のマスクはキャッシュを使い, and/or/notでまとめる
+        kind = plan[0]
+        if kind == query.AND:
+            masks = [self._screen_query(p, rows) for p in plan[1:]]
+            return np.logical_and.reduce(masks)
+        elif kind == query.OR:
+            masks = [self._screen_query(p, rows) for p in plan[1:]]
+            return np.logical_or.reduce(masks)
+        elif kind == query.NOT:
+            # 否定しても値がない銘柄は含めない
+            return ~self._screen_query(plan[1], rows) & self._get_valid_mask(
+                plan[1], rows
+            )
+        elif kind == query.RANGE:
+            condition = NumericalCondition(*plan[1:])
+        else:
+            condition = CategoricalCondition(plan[1], list(plan[2]))
+        if rows is not None:
+            return self._screen(condition, rows)
+        return self.get_condition_mask(self.get_condition_key(condition), condition)
+
+    def _get_valid_mask(self, plan: tuple, rows: np.ndarray = None) -> np.ndarray:
+        """プランが参照する全てのカラムに値がある銘柄のマスクを返す"""
+        n_rows = len(self.company_codes) if rows is None else len(rows)
+        mask = np.ones(n_rows, dtype=bool)
+        for leaf in query.iter_leaves(plan):
+            column = leaf[1]
+            if column in self.numerical_values:
+                valid = ~np.isnan(self.numerical_values[column])
+            else:
+                valid = self.category_values[column] != "nan"
+            mask &= valid if rows is None else valid[rows]
+        return mask
 
 
 def get_default_coditions() -> Conditions:
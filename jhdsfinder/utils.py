@@ -1,18 +1,344 @@
 import os
 import io
+import gzip
+import json
 import time
+import hashlib
+import threading
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
 
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 import requests
+import requests.adapters
+import requests.structures
 
+from jhdsfinder.names import *
 
-def access_url(url: str) -> requests.Response:
-    response = requests.get(url)
+
+class TokenBucket:
+    """
+    rate [回/秒] の速さでトークンが貯まり (最大capacity個), アクセスごとに1つ使う
+    トークンがない場合は貯まるまで待つ (複数のスレッドから使える)
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated_at
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+            # 足りない分が貯まる時刻まで待つ (待っている間に他のスレッドは次の分を予約する)
+            self.tokens -= 1
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+# ホストごとのアクセス頻度の制限
+token_buckets = {}
+
+# 接続と読み込みのタイムアウト [秒]
+HTTP_TIMEOUT = (10.0, 60.0)
+# 429と5xxの場合にやり直す回数と待ち時間 (BACKOFF_SECONDS * 2^n秒, Retry-Afterがあればそれに従う)
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# ホストごとの同時接続数
+MAX_CONNECTIONS_PER_HOST = 4
+
+# ホストごとの同時接続数の制限
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+# 全てのアクセスで共有するセッション (ホストごとに接続を使い回す)
+session = None
+session_lock = threading.Lock()
+
+
+def set_rate_limit(host: str, rate: float, capacity: int = 1):
+    token_buckets[host] = TokenBucket(rate, capacity)
+
+
+def get_token_bucket(url: str) -> TokenBucket:
+    return token_buckets.get(urlparse(url).netloc)
+
+
+def set_connection_limit(host: str, max_connections: int):
+    with host_semaphores_lock:
+        host_semaphores[host] = threading.BoundedSemaphore(max_connections)
+
+
+def get_host_semaphore(url: str) -> threading.BoundedSemaphore:
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return host_semaphores[host]
+
+
+def get_session() -> requests.Session:
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            # 接続の数はホストごとのセマフォで制限するのでプールはその数だけ持つ
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=16, pool_maxsize=MAX_CONNECTIONS_PER_HOST
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+
+def get_retry_seconds(response: requests.Response, n_retries: int) -> float:
+    retry_after = None if response is None else response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), MAX_BACKOFF_SECONDS)
+        except ValueError:
+            # 日時で指定されている場合
+            retry_at = parsedate_to_datetime(retry_after)
+            seconds = (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()
+            return min(max(seconds, 0.0), MAX_BACKOFF_SECONDS)
+    return min(BACKOFF_SECONDS * 2**n_retries, MAX_BACKOFF_SECONDS)
+
+
+def request(
+    url: str, headers: dict = None, method: str = "GET", timeout=None
+) -> requests.Response:
+    """
+    共有セッションでアクセスする
+    429と5xx, 接続エラーの場合は待ってからMAX_RETRIES回までやり直す
+    接続できなかったアクセスはアクセス頻度の制限に数えない (オフラインでも長く待たない)
+    """
+    timeout = HTTP_TIMEOUT if timeout is None else timeout
+    token_bucket = get_token_bucket(url)
+    n_retries = 0
+    connected = True
+    while True:
+        if token_bucket is not None and connected:
+            token_bucket.acquire()
+        response = None
+        try:
+            with get_host_semaphore(url):
+                response = get_session().request(
+                    method, url, headers=headers, timeout=timeout
+                )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if n_retries >= MAX_RETRIES:
+                raise e
+            # 読み込みのタイムアウトはサーバーに届いている
+            connected = isinstance(e, requests.ReadTimeout)
+        else:
+            connected = True
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or n_retries >= MAX_RETRIES
+            ):
+                return response
+        seconds = get_retry_seconds(response, n_retries)
+        print(f"Retry after {seconds:.1f} seconds. ({url})")
+        time.sleep(seconds)
+        n_retries += 1
+
+
+# HTTPキャッシュのモード
+## 有効期限内のキャッシュがあれば使い, なければアクセスして記録する
+RECORD = "record"
+## キャッシュだけを使う (ネットワークにアクセスしない)
+REPLAY = "replay"
+## 常にアクセスしてキャッシュを更新する
+REFRESH = "refresh"
+HTTP_CACHE_MODES = [RECORD, REPLAY, REFRESH]
+# キャッシュの有効期限 [秒]
+HTTP_CACHE_TTL_SECONDS = 7 * 24 * 3600
+# キャッシュする応答のステータスコード
+HTTP_CACHE_STATUS_CODES = [200, 404]
+# モードを指定する環境変数 (例: JHDSFINDER_HTTP_CACHE=replay)
+HTTP_CACHE_ENV = "JHDSFINDER_HTTP_CACHE"
+# 条件付きリクエストのヘッダと, 比べる応答のヘッダ
+CONDITIONAL_HEADERS = {"If-None-Match": "ETag", "If-Modified-Since": "Last-Modified"}
+
+
+class HTTPCache:
+    """
+    応答をディスクに保存するキャッシュ
+    本文は内容のsha256を名前にしてgzipで圧縮して保存し (同じ内容は1つだけ),
+    URLごとの索引にステータスコードとヘッダと本文のsha256を記録する
+    """
+
+    def __init__(
+        self,
+        mode: str = RECORD,
+        cache_dir: str = os.path.join(DATA_DIRNAME, HTTP_CACHE_DIRNAME),
+        ttl_seconds: float = HTTP_CACHE_TTL_SECONDS,
+    ) -> None:
+        assert mode in HTTP_CACHE_MODES
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+
+    def get_key(self, method: str, url: str) -> str:
+        # 条件付きリクエストのヘッダは含めない (記録した内容と比べて判断させる)
+        return hashlib.sha256(f"{method} {url}".encode()).hexdigest()
+
+    def get_index_filepath(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "index", f"{key}.json")
+
+    def get_object_filepath(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, "objects", sha256[:2], f"{sha256}.gz")
+
+    def is_expired(self, entry: dict) -> bool:
+        return time.time() - entry["recorded_at"] > self.ttl_seconds
+
+    def load(self, method: str, url: str, headers: dict = None) -> requests.Response:
+        """
+        キャッシュがないか, 期限切れの場合 (REPLAYでは期限を見ない) はNoneを返す
+        条件付きリクエストはREPLAY以外ではサーバーに確認させるためにNoneを返し,
+        REPLAYでは記録した応答のETagかLast-Modifiedが一致すれば304を返す
+        """
+        conditions = {
+            k: v for k, v in (headers or {}).items() if k in CONDITIONAL_HEADERS
+        }
+        if self.mode == REFRESH or (self.mode == RECORD and conditions):
+            return None
+        index_filepath = self.get_index_filepath(self.get_key(method, url))
+        if not os.path.exists(index_filepath):
+            return None
+        with open(index_filepath, "r", encoding=ENCODING) as f:
+            entry = json.load(f)
+        object_filepath = self.get_object_filepath(entry["sha256"])
+        if not os.path.exists(object_filepath):
+            return None
+        if self.mode == RECORD and self.is_expired(entry):
+            return None
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response.url = url
+        if is_not_modified(response, conditions):
+            response.status_code = 304
+            response._content = b""
+            return response
+        with gzip.open(object_filepath, "rb") as f:
+            response._content = f.read()
+        return response
+
+    def save(self, method: str, url: str, response: requests.Response):
+        if response.status_code not in HTTP_CACHE_STATUS_CODES:
+            return
+        sha256 = hashlib.sha256(response.content).hexdigest()
+        object_filepath = self.get_object_filepath(sha256)
+        if not os.path.exists(object_filepath):
+            tmp_filepath = make_tmp_filepath(object_filepath)
+            with open(tmp_filepath, "wb") as f:
+                f.write(gzip.compress(response.content))
+            os.replace(tmp_filepath, object_filepath)
+        # 本文は展開して保存するので圧縮と長さのヘッダは除く
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k.lower()
+            not in ["content-encoding", "content-length", "transfer-encoding"]
+        }
+        entry = {
+            "method": method,
+            "url": url,
+            "status_code": response.status_code,
+            "headers": headers,
+            "sha256": sha256,
+            "recorded_at": time.time(),
+        }
+        index_filepath = self.get_index_filepath(self.get_key(method, url))
+        tmp_filepath = make_tmp_filepath(index_filepath)
+        with open(tmp_filepath, "w", encoding=ENCODING) as f:
+            json.dump(entry, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_filepath, index_filepath)
+
+    def evict(self):
+        """期限切れの索引と, どの索引からも使われていない本文を削除する"""
+        index_dir = os.path.join(self.cache_dir, "index")
+        objects_dir = os.path.join(self.cache_dir, "objects")
+        used_sha256s = set()
+        for filename in os.listdir(index_dir) if os.path.isdir(index_dir) else []:
+            index_filepath = os.path.join(index_dir, filename)
+            with open(index_filepath, "r", encoding=ENCODING) as f:
+                entry = json.load(f)
+            if self.is_expired(entry):
+                os.remove(index_filepath)
+            else:
+                used_sha256s.add(entry["sha256"])
+        for dirpath, _, filenames in os.walk(objects_dir):
+            for filename in filenames:
+                if filename.split(".")[0] not in used_sha256s:
+                    os.remove(os.path.join(dirpath, filename))
+
+
+def is_not_modified(response: requests.Response, conditions: dict) -> bool:
+    for header, value in conditions.items():
+        validator = response.headers.get(CONDITIONAL_HEADERS[header])
+        if validator is not None and validator == value:
+            return True
+    return False
+
+
+def make_tmp_filepath(filepath: str) -> str:
+    # 複数のスレッドから同じファイルに書いても壊れないようにスレッドごとに分ける
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return f"{filepath}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+http_cache = None
+
+
+def init_http_cache() -> HTTPCache:
+    """環境変数HTTP_CACHE_ENVでモードが指定されていればHTTPキャッシュを使う"""
+    mode = os.environ.get(HTTP_CACHE_ENV)
+    if not mode:
+        return None
+    return set_http_cache(mode)
+
+
+def set_http_cache(mode: str = None, **kwargs) -> HTTPCache:
+    """
+    HTTPキャッシュのモードを設定する (Noneの場合はキャッシュを使わない)
+    RECORDとREFRESHでは期限切れのキャッシュを削除する
+    """
+    global http_cache
+    http_cache = None if mode is None else HTTPCache(mode, **kwargs)
+    if http_cache is not None and http_cache.mode != REPLAY:
+        http_cache.evict()
+    return http_cache
+
+
+def access_url(
+    url: str, headers: dict = None, method: str = "GET", timeout=None
+) -> requests.Response:
+    cache = http_cache
+    response = None if cache is None else cache.load(method, url, headers)
+    if response is None:
+        if cache is not None and cache.mode == REPLAY:
+            raise RuntimeError(f"The response is not cached. ({method} {url})")
+        # 304は記録しない (本文が変わった場合の200だけを記録する)
+        response = request(url, headers, method, timeout)
+        if cache is not None:
+            cache.save(method, url, response)
     if response.status_code == 200:
         pass
+    elif response.status_code == 304:
+        # 条件付きリクエストで変更がない
+        pass
     elif response.status_code == 404:
         print(f"StatuCode={response.status_code}: Not Found. ({url})")
     else:
@@ -52,3 +378,14 @@ def get_update_flag(filepath: str, update_frequency_days: int = 1) -> bool:
             # 更新期間を過ぎた古いファイルならアップデート
             update = True
     return update
+
+
+def is_older_file(filepath: str, src_filepath: str) -> bool:
+    """
+    filepathが存在しないか, 元のファイルsrc_filepathより古い場合にTrueを返す
+    """
+    if not os.path.exists(filepath):
+        return True
+    if not os.path.exists(src_filepath):
+        return False
+    return os.path.getmtime(filepath) < os.path.getmtime(src_filepath)
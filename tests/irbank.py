@@ -0,0 +1,333 @@
+import unittest
+from unittest.mock import patch
+
+import os
+import sys
+import time
+import tempfile
+import datetime
+import threading
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.getcwd())
+
+import pandas as pd
+import requests
+
+from jhdsfinder.names import *
+from jhdsfinder import irbank, utils
+
+TEST_FISCAL_YEARS = [2020, 2021]
+
+
+def make_irbank_files(server_dir: str):
+    """IR Bankと同じ配置のcsvファイルを作る (1行目はタイトル)"""
+    for fiscal_year in TEST_FISCAL_YEARS:
+        year_dir = os.path.join(server_dir, f"00{str(fiscal_year)[-2:]}")
+        os.makedirs(year_dir)
+        for csv_filename in FY_CSV_FILENAMES:
+            column = csv_filename.split(".")[0]
+            with open(os.path.join(year_dir, csv_filename), "w", encoding="utf-8") as f:
+                f.write(f"{column}\n{COMPANY_CODE},{FISCAL_YEAR},{column}\n")
+                f.write(f"1301,{fiscal_year}/03,1.0\n2914,{fiscal_year}/12,2.0\n")
+
+
+class IRBankRequestHandler(SimpleHTTPRequestHandler):
+    # 失敗させるパスと残りの回数
+    failing_paths = {}
+    requested_paths = []
+
+    def do_HEAD(self):
+        self.requested_paths.append(f"HEAD {self.path}")
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.requested_paths.append(self.path)
+        if self.failing_paths.get(self.path, 0) > 0:
+            self.failing_paths[self.path] -= 1
+            self.send_error(500)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalIRBankServer:
+    def __init__(self, server_dir: str) -> None:
+        handler = functools.partial(IRBankRequestHandler, directory=server_dir)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_fy_all_rows():
+    return pd.DataFrame(
+        {
+            COMPANY_CODE: ["1301", "1301", "1332", "130A", "2914"],
+            FISCAL_YEAR: ["2022", "2023", "2023", "2023", "2023"],
+            EPS: ["100.0", "110.0", "", "5.5", "200.0"],
+        }
+    )
+
+
+class TestChangedCompanyCodes(unittest.TestCase):
+    def test_get_changed_company_codes(self):
+        old_df = make_fy_all_rows()
+        new_df = make_fy_all_rows()
+        self.assertEqual(irbank.get_changed_company_codes(old_df, new_df), [])
+        # 値の変更, 行の削除, 行の追加
+        new_df.loc[1, EPS] = "120.0"
+        new_df = new_df.drop(index=2)
+        new_df.loc[len(new_df) + 1] = ["9999", "2023", "1.0"]
+        self.assertEqual(
+            irbank.get_changed_company_codes(old_df, new_df),
+            ["1301", "1332", "9999"],
+        )
+
+    def test_dirty_company_codes(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            self.assertIsNone(irbank.load_dirty_company_codes(data_dir))
+            irbank.save_dirty_company_codes(["2914", "130A"], data_dir)
+            irbank.save_dirty_company_codes(["1301"], data_dir)
+            self.assertEqual(
+                irbank.load_dirty_company_codes(data_dir), ["1301", "130A", "2914"]
+            )
+            irbank.clear_dirty_company_codes(data_dir)
+            self.assertIsNone(irbank.load_dirty_company_codes(data_dir))
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(utils, "BACKOFF_SECONDS", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        token_bucket = utils.TokenBucket(rate=50.0, capacity=2)
+        start = time.monotonic()
+        for _ in range(7):
+            token_bucket.acquire()
+        # 最初の2回以降は1/50秒ごと
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_irbank_rate_limit(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server_dir = os.path.join(tmp_dir, "server")
+            data_dir = os.path.join(tmp_dir, "data")
+            make_irbank_files(server_dir)
+            IRBankRequestHandler.failing_paths = {}
+            with patch.dict(utils.token_buckets, clear=True):
+                with LocalIRBankServer(server_dir) as server:
+                    irbank.download(TEST_FISCAL_YEARS, data_dir, server.url)
+                    # 制限するのはIR Bankだけ
+                    self.assertIsNone(utils.get_token_bucket(server.url))
+                token_bucket = utils.get_token_bucket(irbank.IRBANK_URL)
+                self.assertIsNotNone(token_bucket)
+                # 設定済みの制限は作り直さない
+                irbank.set_irbank_rate_limit()
+                self.assertIs(utils.get_token_bucket(irbank.IRBANK_URL), token_bucket)
+
+    def test_download_and_resume(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server_dir = os.path.join(tmp_dir, "server")
+            data_dir = os.path.join(tmp_dir, "data")
+            make_irbank_files(server_dir)
+            failing_path = f"/0021/{FY_PROFIT_AND_LOSS_CSV_FILENAME}"
+            # やり直しても失敗させる
+            IRBankRequestHandler.failing_paths = {failing_path: utils.MAX_RETRIES + 1}
+            IRBankRequestHandler.requested_paths = []
+            with LocalIRBankServer(server_dir) as server:
+                with self.assertRaises(RuntimeError):
+                    irbank.download(TEST_FISCAL_YEARS, data_dir, server.url)
+                n_files = len(TEST_FISCAL_YEARS) * len(FY_CSV_FILENAMES)
+                self.assertEqual(
+                    len(IRBankRequestHandler.requested_paths),
+                    n_files + utils.MAX_RETRIES,
+                )
+                journal = irbank.DownloadJournal(data_dir)
+                self.assertEqual(len(journal.entries), n_files - 1)
+                # 続きからダウンロードする
+                IRBankRequestHandler.requested_paths = []
+                year_dfs = irbank.download(TEST_FISCAL_YEARS, data_dir, server.url)
+                self.assertEqual(IRBankRequestHandler.requested_paths, [failing_path])
+            # ファイルが揃っていた2020年度はmerge_csvで読み込む
+            self.assertEqual(list(year_dfs.keys()), [2021])
+            df = year_dfs[2021]
+            self.assertEqual(df[COMPANY_CODE].tolist(), ["1301", "2914"])
+            self.assertEqual(len(df.columns), len(FY_CSV_FILENAMES) + 2)
+            self.assertFalse(glob_part_files(data_dir))
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server_dir = os.path.join(tmp_dir, "server")
+            data_dir = os.path.join(tmp_dir, "data")
+            make_irbank_files(server_dir)
+            IRBankRequestHandler.failing_paths = {}
+            with LocalIRBankServer(server_dir) as server:
+                year_dfs = irbank.download(TEST_FISCAL_YEARS, data_dir, server.url)
+                self.assertEqual(list(year_dfs.keys()), TEST_FISCAL_YEARS)
+                csv_filepath = irbank.get_fy_csv_filepath(
+                    2021, FY_PROFIT_AND_LOSS_CSV_FILENAME, data_dir
+                )
+                mtime = os.path.getmtime(csv_filepath)
+                # 変更がない場合は条件付きリクエストだけで書き換えない
+                IRBankRequestHandler.requested_paths = []
+                year_dfs = irbank.download(
+                    TEST_FISCAL_YEARS, data_dir, server.url, refresh_fiscal_years=[2021]
+                )
+                self.assertEqual(year_dfs, {})
+                self.assertEqual(
+                    sorted(IRBankRequestHandler.requested_paths),
+                    sorted(f"/0021/{f}" for f in FY_CSV_FILENAMES),
+                )
+                self.assertEqual(os.path.getmtime(csv_filepath), mtime)
+                # 記録がない場合はContent-Lengthで確認する
+                os.remove(os.path.join(data_dir, IRBANK_JOURNAL_FILENAME))
+                IRBankRequestHandler.requested_paths = []
+                year_dfs = irbank.download(
+                    TEST_FISCAL_YEARS, data_dir, server.url, refresh_fiscal_years=[2021]
+                )
+                self.assertEqual(year_dfs, {})
+                self.assertTrue(
+                    all(
+                        p.startswith("HEAD")
+                        for p in IRBankRequestHandler.requested_paths
+                    )
+                )
+                # 変更された年度だけをまとめ直す
+                server_filepath = os.path.join(
+                    server_dir, "0021", FY_PROFIT_AND_LOSS_CSV_FILENAME
+                )
+                with open(server_filepath, "a", encoding="utf-8") as f:
+                    f.write("8306,2021/03,3.0\n")
+                os.utime(server_filepath, (time.time() + 10, time.time() + 10))
+                year_dfs = irbank.download(
+                    TEST_FISCAL_YEARS, data_dir, server.url, refresh_fiscal_years=[2021]
+                )
+            self.assertEqual(list(year_dfs.keys()), [2021])
+            self.assertIn("8306", year_dfs[2021][COMPANY_CODE].tolist())
+
+    def test_due_refresh_fiscal_years(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server_dir = os.path.join(tmp_dir, "server")
+            data_dir = os.path.join(tmp_dir, "data")
+            make_irbank_files(server_dir)
+            IRBankRequestHandler.failing_paths = {}
+            now = datetime.datetime(2022, 6, 1)
+            self.assertEqual(
+                irbank.get_due_refresh_fiscal_years(data_dir, now), [2021, 2022]
+            )
+            # 進行中の2022年度のファイルはまだないが, 確認した日時は記録する
+            with LocalIRBankServer(server_dir) as server:
+                year_dfs = irbank.download(
+                    TEST_FISCAL_YEARS + [2022],
+                    data_dir,
+                    server.url,
+                    refresh_fiscal_years=[2021, 2022],
+                )
+            self.assertEqual(list(year_dfs.keys()), TEST_FISCAL_YEARS)
+            journal = irbank.DownloadJournal(data_dir)
+            csv_filepath = irbank.get_fy_csv_filepath(
+                2022, FY_PROFIT_AND_LOSS_CSV_FILENAME, data_dir
+            )
+            self.assertFalse(journal.is_done(csv_filepath))
+            self.assertIsNotNone(journal.get_checked_at(csv_filepath))
+            # 2022/6/1に確認したことにする
+            for entry in journal.entries.values():
+                entry["checked_at"] = now.isoformat()
+            journal.save()
+            for days, expected in [(0, []), (2, [2022]), (8, [2021, 2022])]:
+                now = datetime.datetime(2022, 6, 1) + datetime.timedelta(days=days)
+                self.assertEqual(
+                    irbank.get_due_refresh_fiscal_years(data_dir, now), expected
+                )
+
+    def test_merge_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server_dir = os.path.join(tmp_dir, "server")
+            data_dir = os.path.join(tmp_dir, "data")
+            make_irbank_files(server_dir)
+            IRBankRequestHandler.failing_paths = {}
+            with LocalIRBankServer(server_dir) as server:
+                year_dfs = irbank.download(TEST_FISCAL_YEARS, data_dir, server.url)
+            cache_dir = os.path.join(data_dir, IRBANK_MERGE_CACHE_DIRNAME)
+            self.assertEqual(len(os.listdir(cache_dir)), len(TEST_FISCAL_YEARS))
+            # 変わっていない年度はまとめ直さない
+            with patch.object(
+                irbank, "merge_csv_by_year", wraps=irbank.merge_csv_by_year
+            ) as merge_csv_by_year:
+                for fiscal_year in TEST_FISCAL_YEARS:
+                    pd.testing.assert_frame_equal(
+                        irbank.load_merged_csv_by_year(fiscal_year, data_dir),
+                        year_dfs[fiscal_year],
+                    )
+                self.assertEqual(merge_csv_by_year.call_count, 0)
+                csv_filepath = irbank.get_fy_csv_filepath(
+                    2021, FY_PROFIT_AND_LOSS_CSV_FILENAME, data_dir
+                )
+                with open(csv_filepath, "a", encoding="utf-8") as f:
+                    f.write("8306,2021/03,3.0\n")
+                df = irbank.load_merged_csv_by_year(2021, data_dir)
+                merge_csv_by_year.assert_called_once_with(2021, data_dir)
+            self.assertIn("8306", df[COMPANY_CODE].tolist())
+            # 古いキャッシュは置き換える
+            self.assertEqual(len(os.listdir(cache_dir)), len(TEST_FISCAL_YEARS))
+
+    def test_csv_fiscal_years(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server_dir = os.path.join(tmp_dir, "server")
+            data_dir = os.path.join(tmp_dir, "data")
+            make_irbank_files(server_dir)
+            IRBankRequestHandler.failing_paths = {}
+            with LocalIRBankServer(server_dir) as server:
+                irbank.download(TEST_FISCAL_YEARS, data_dir, server.url)
+            # 2022年度は貸借対照表だけが公開されている
+            src = irbank.get_fy_csv_filepath(
+                2021, FY_BALANCE_SHEET_CSV_FILENAME, data_dir
+            )
+            dst = irbank.get_fy_csv_filepath(
+                2022, FY_BALANCE_SHEET_CSV_FILENAME, data_dir
+            )
+            with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+                f_dst.write(f_src.read())
+            self.assertEqual(irbank.get_csv_fiscal_years(data_dir), TEST_FISCAL_YEARS)
+            # 揃っている年度だけをまとめる
+            for fiscal_year in irbank.get_csv_fiscal_years(data_dir):
+                irbank.load_merged_csv_by_year(fiscal_year, data_dir)
+
+    def test_load_saved_data_if_update_fails(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with patch.object(
+                irbank, "update", side_effect=requests.ConnectionError("offline")
+            ):
+                # 保存済みのデータがない場合は失敗する
+                with self.assertRaises(requests.ConnectionError):
+                    irbank.load_fy_all_dataframe(data_dir=data_dir)
+                make_fy_all_rows().to_csv(irbank.get_fy_all_csv_filepath(data_dir))
+                df = irbank.load_fy_all_dataframe(data_dir=data_dir)
+            self.assertEqual(
+                df[COMPANY_CODE].tolist(), make_fy_all_rows()[COMPANY_CODE].tolist()
+            )
+
+
+def glob_part_files(data_dir: str) -> list:
+    return [
+        filename
+        for _, _, filenames in os.walk(data_dir)
+        for filename in filenames
+        if filename.endswith(".part")
+    ]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import numpy as np
+
+from jhdsfinder.data import get_average, get_gradient, remove_outliers_mad
+from jhdsfinder import kernels
+
+
+class TestKernels(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.years_list = []
+        self.series_list = []
+        for length in [0, 1, 2, 3, 5, 8, 14, 14]:
+            years = np.arange(2010, 2010 + length).astype(float)
+            series = rng.normal(10.0, 3.0, length)
+            if length > 4:
+                series[2] = 500.0  # 外れ値
+            self.years_list.append(years)
+            self.series_list.append(series)
+        # 中央絶対偏差が0になる系列
+        self.years_list.append(np.arange(2010, 2016).astype(float))
+        self.series_list.append(np.array([1.0, 1.0, 1.0, 1.0, 1.0, 9.0]))
+
+    def test_pad_series(self):
+        x, mask = kernels.pad_series(self.series_list)
+        self.assertEqual(x.shape, (len(self.series_list), 14))
+        self.assertEqual(mask.sum(), sum(len(s) for s in self.series_list))
+
+    def test_mad_filtered_gradients_and_averages(self):
+        years, mask = kernels.pad_series(self.years_list)
+        x, _ = kernels.pad_series(self.series_list)
+        gradients = kernels.get_mad_filtered_gradients(years, x, mask)
+        averages = kernels.get_mad_filtered_averages(x, mask, calc_years=3)
+        for i in range(len(self.series_list)):
+            _years, values = remove_outliers_mad(
+                self.years_list[i], self.series_list[i]
+            )
+            np.testing.assert_allclose(
+                gradients[i], get_gradient(_years, values), rtol=1e-9, atol=1e-12
+            )
+            np.testing.assert_allclose(averages[i], get_average(values, 3), rtol=1e-12)
+
+    def test_batch_kernel_switch(self):
+        for years, series in zip(self.years_list, self.series_list):
+            expected = remove_outliers_mad(years, series)
+            actual = remove_outliers_mad(years, series, batch_kernel=True)
+            np.testing.assert_array_equal(expected[1], actual[1])
+            np.testing.assert_allclose(
+                get_gradient(*actual, batch_kernel=True),
+                get_gradient(*expected),
+                rtol=1e-9,
+                atol=1e-12,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,325 @@
+import unittest
+
+import os
+import sys
+import tempfile
+from unittest.mock import patch
+
+sys.path.append(os.getcwd())
+
+import numpy as np
+import pandas as pd
+
+from jhdsfinder.names import *
+from jhdsfinder.data import CompanyData, make_company_performance_shard
+from jhdsfinder import data, panel
+
+TEST_COLUMNS = [
+    REVENUE,
+    EPS,
+    BPS,
+    DIVIDEND_PER_SHARE,
+    OPERATING_CASH_FLOW,
+    CASH_EQUIVALENTS,
+    OPERATING_PROFIT_MARGIN,
+    EQUITY_RATIO,
+    SHORT_TERM_DEBT,
+    DIVIDEND_PAYOUT_RATIO,
+    ROE,
+    ROA,
+]
+
+TEST_CODES = ["1301", "1332", "130A", "2914", "9999"]
+TEST_PRICES = [3600.0, 800.0, 0.0, 4200.0, 1500.0]
+
+
+def make_test_dataframes(seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i, code in enumerate(TEST_CODES):
+        n_years = [14, 9, 1, 14, 2][i]
+        for year in range(2023 - n_years + 1, 2024):
+            row = {COMPANY_CODE: code, FISCAL_YEAR: float(year)}
+            for column in TEST_COLUMNS:
+                value = rng.normal(100.0, 30.0)
+                if rng.random() < 0.15:
+                    value = np.nan
+                elif rng.random() < 0.05:
+                    value *= 50  # 外れ値
+                row[column] = value
+            rows.append(row)
+    fy_all_df = pd.DataFrame(rows)
+    market_df = pd.DataFrame(
+        {
+            COMPANY_CODE: TEST_CODES,
+            COMPANY_NAME: TEST_CODES,
+            MARKET_CATEGORY: "プライム（内国株式）",
+            INDUSTRY_CODE_33: "50",
+            INDUSTRY_CATEGORY_33: FISHERY_FORESTRY_AGRICULTURE,
+            INDUSTRY_CODE_17: "1",
+            INDUSTRY_CATEGORY_17: "食品",
+            SCALE_CODE: "7",
+            SCALE_CATEGORY: TOPIX_SMALL2,
+        }
+    )
+    stock_price_df = pd.DataFrame({COMPANY_CODE: TEST_CODES, CLOSE_PRICE: TEST_PRICES})
+    return fy_all_df, market_df, stock_price_df
+
+
+class TestMakeCompanyPerformanceDataFrame(unittest.TestCase):
+
+    def assert_same_performance(self, calc_years):
+        fy_all_df, market_df, stock_price_df = make_test_dataframes()
+        finance_panel = panel.FinancePanel(fy_all_df, TEST_CODES)
+        result = panel.make_company_performance_dataframe(
+            finance_panel, market_df, stock_price_df, calc_years
+        )
+        for i, code in enumerate(TEST_CODES):
+            company_data = CompanyData(
+                *market_df.iloc[i].tolist(),
+                TEST_PRICES[i],
+                fy_all_df[fy_all_df[COMPANY_CODE] == code],
+            )
+            expected = company_data.get_long_term_performance(calc_years)
+            actual = result.iloc[i]
+            self.assertEqual(list(expected.index), list(result.columns))
+            for column in expected.index:
+                if isinstance(expected[column], str):
+                    self.assertEqual(expected[column], actual[column])
+                else:
+                    np.testing.assert_allclose(
+                        float(actual[column]),
+                        float(expected[column]),
+                        rtol=1e-9,
+                        err_msg=f"{code}: {column}",
+                    )
+
+    def test_calc_years(self):
+        for calc_years in [1, 3, -1]:
+            self.assert_same_performance(calc_years)
+
+    def test_vectorized_callback(self):
+        finance_data = make_finance_data(TEST_CODES)
+        progress = []
+        finance_data.make_company_pefomance_dataframe(
+            callback=lambda n_done, n_total: progress.append((n_done, n_total))
+        )
+        n_total = len(TEST_CODES)
+        self.assertEqual(progress, [(0, n_total), (n_total, n_total)])
+
+    def test_multiple_calc_years(self):
+        fy_all_df, market_df, _ = make_test_dataframes()
+        finance_panel = panel.FinancePanel(fy_all_df, TEST_CODES)
+        fundamentals_dfs = panel.make_company_fundamentals_dataframes(
+            finance_panel, market_df, CALC_YEARS_LIST
+        )
+        self.assertEqual(list(fundamentals_dfs.keys()), CALC_YEARS_LIST)
+        for calc_years in CALC_YEARS_LIST:
+            expected = panel.make_company_fundamentals_dataframe(
+                finance_panel, market_df, calc_years
+            )
+            pd.testing.assert_frame_equal(fundamentals_dfs[calc_years], expected)
+
+    def test_join_stock_price(self):
+        fy_all_df, market_df, stock_price_df = make_test_dataframes()
+        finance_panel = panel.FinancePanel(fy_all_df, TEST_CODES)
+        fundamentals_df = panel.make_company_fundamentals_dataframe(
+            finance_panel, market_df
+        )
+        df = panel.join_stock_price(fundamentals_df, stock_price_df)
+        self.assertEqual(df.columns.tolist(), panel.PERFORMANCE_COLUMNS)
+        # 株価が2倍になると配当利回りは半分, PERとPBRは2倍になる
+        stock_price_df[CLOSE_PRICE] *= 2
+        refreshed_df = panel.join_stock_price(fundamentals_df, stock_price_df)
+        np.testing.assert_allclose(
+            refreshed_df[DIVIDEND_YIELD].values * 2, df[DIVIDEND_YIELD].values
+        )
+        for column in [PER, PBR]:
+            np.testing.assert_allclose(
+                refreshed_df[column].values, df[column].values * 2
+            )
+        self.assertTrue(refreshed_df[ROE_AVG].equals(df[ROE_AVG]))
+
+    def test_industry_percentile_columns(self):
+        fy_all_df, market_df, stock_price_df = make_test_dataframes()
+        market_df[INDUSTRY_CATEGORY_33] = [BANKING, BANKING, INSURANCE, BANKING, np.nan]
+        finance_panel = panel.FinancePanel(fy_all_df, TEST_CODES)
+        df = panel.make_company_performance_dataframe(
+            finance_panel, market_df, stock_price_df
+        )
+        df = panel.add_industry_percentile_columns(df)
+        self.assertEqual(
+            df.columns.tolist(),
+            panel.PERFORMANCE_COLUMNS + panel.INDUSTRY_PERCENTILE_COLUMNS,
+        )
+        for column in panel.PERCENTILE_COLUMNS:
+            expected = (
+                df[column]
+                .astype(float)
+                .groupby(df[INDUSTRY_CATEGORY_33].fillna(""))
+                .rank(pct=True)
+                * 100
+            )
+            np.testing.assert_allclose(
+                df[column + INDUSTRY_PERCENTILE].values, expected.values
+            )
+        for column in panel.BOOLEAN_COLUMNS:
+            self.assertNotIn(column + INDUSTRY_PERCENTILE, df.columns)
+        # 株価が0の130Aは配当利回りがないのでパーセンタイルもない
+        self.assertTrue(np.isnan(df[DIVIDEND_YIELD + INDUSTRY_PERCENTILE][2]))
+
+
+def make_finance_data(company_codes) -> data.FinanceData:
+    """ファイルを読み込まずにFinanceDataを作る"""
+    fy_all_df, market_df, stock_price_df = make_test_dataframes()
+    finance_data = data.FinanceData.__new__(data.FinanceData)
+    finance_data.company_codes = company_codes
+    finance_data.market_df = market_df[market_df[COMPANY_CODE].isin(company_codes)]
+    finance_data.stock_price_df = stock_price_df[
+        stock_price_df[COMPANY_CODE].isin(company_codes)
+    ]
+    finance_data.fy_all_df = fy_all_df[
+        fy_all_df[COMPANY_CODE].isin(company_codes)
+    ].sort_values(by=COMPANY_CODE, kind="stable")
+    finance_data.make_company_index()
+    finance_data.finance_panel = panel.FinancePanel(
+        finance_data.fy_all_df, company_codes
+    )
+    return finance_data
+
+
+class TestFundamentalsCache(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        fy_all_csv_filepath = os.path.join(tmp_dir.name, FY_ALL_CSV_FILENAME)
+        open(fy_all_csv_filepath, "w").close()
+        os.utime(fy_all_csv_filepath, (100, 100))
+        for patcher in [
+            patch.object(data, "DATA_DIRNAME", tmp_dir.name),
+            patch.object(data, "get_fy_all_csv_filepath", lambda: fy_all_csv_filepath),
+            patch.object(data, "load_dirty_company_codes", lambda: None),
+            patch.object(data, "clear_dirty_company_codes", lambda: None),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reindex_cached_fundamentals(self):
+        expected = make_finance_data(TEST_CODES).load_company_fundamentals_dataframes(
+            [3]
+        )[3]
+        # キャッシュから2914の行を消し, 株価から1332がなくなった場合
+        csv_path = data.FinanceData.get_fundamentals_csv_path(None, 3)
+        df = pd.read_csv(csv_path, index_col=0, dtype={COMPANY_CODE: str})
+        df[df[COMPANY_CODE] != "2914"].to_csv(csv_path)
+        company_codes = [code for code in TEST_CODES if code != "1332"]
+        finance_data = make_finance_data(company_codes)
+        actual = finance_data.load_company_fundamentals_dataframes([3])[3]
+        self.assertEqual(actual[COMPANY_CODE].tolist(), company_codes)
+        expected = expected.set_index(COMPANY_CODE).loc[company_codes]
+        for column in expected.columns:
+            if expected[column].dtype == float:
+                np.testing.assert_allclose(
+                    actual[column].values.astype(float),
+                    expected[column].values,
+                    rtol=1e-9,
+                    err_msg=column,
+                )
+        # 業績は位置ではなく銘柄コードで引く
+        finance_data.fundamentals_dfs = {3: actual}
+        finance_data.performance_dfs = {3: finance_data.join_stock_price(actual)}
+        finance_data.performance_df = finance_data.performance_dfs[3]
+        for code in company_codes:
+            series = finance_data.get_company_performance(code)
+            self.assertEqual(series[COMPANY_CODE], code)
+        with self.assertRaises(KeyError):
+            finance_data.get_company_performance("1332")
+        df = finance_data.make_screened_company_dataframe()
+        self.assertEqual(df[COMPANY_CODE].tolist(), company_codes)
+
+    def test_clear_dirty_company_codes(self):
+        # CALC_YEARS_LISTにない期間の古いファイルは見ない
+        leftover_csv_path = data.FinanceData.get_fundamentals_csv_path(None, 99)
+        open(leftover_csv_path, "w").close()
+        os.utime(leftover_csv_path, (0, 0))
+        with patch.object(data, "clear_dirty_company_codes") as clear:
+            make_finance_data(TEST_CODES).load_company_fundamentals_dataframes(
+                CALC_YEARS_LIST
+            )
+        clear.assert_called_once_with()
+
+
+class TestFinancePanel(unittest.TestCase):
+    def setUp(self):
+        self.fy_all_df, self.market_df, _ = make_test_dataframes()
+        self.finance_panel = panel.FinancePanel(self.fy_all_df, TEST_CODES)
+
+    def test_shape(self):
+        n_columns = len(self.fy_all_df.columns) - 2
+        self.assertEqual(
+            self.finance_panel.values.shape, (len(TEST_CODES), 14, n_columns)
+        )
+
+    def test_get_values_is_view(self):
+        years, values = self.finance_panel.get_values("1301", EPS)
+        self.assertTrue(np.shares_memory(values, self.finance_panel.values))
+        self.assertEqual(len(years), len(values))
+
+    def test_company_data_get_values(self):
+        for i, code in enumerate(TEST_CODES):
+            args = self.market_df.iloc[i].tolist()
+            df = self.fy_all_df[self.fy_all_df[COMPANY_CODE] == code]
+            company_data = CompanyData(*args, TEST_PRICES[i], df)
+            panel_company_data = CompanyData(
+                *args, TEST_PRICES[i], df, self.finance_panel
+            )
+            for column in TEST_COLUMNS:
+                expected = company_data.get_values(column)
+                actual = panel_company_data.get_values(column)
+                np.testing.assert_array_equal(expected[0], actual[0])
+                np.testing.assert_array_equal(expected[1], actual[1])
+            np.testing.assert_array_equal(
+                company_data.get_current_ratio()[1],
+                panel_company_data.get_current_ratio()[1],
+            )
+
+    def test_company_data_cache(self):
+        df = self.fy_all_df[self.fy_all_df[COMPANY_CODE] == "1301"]
+        args = self.market_df.iloc[0].tolist()
+        company_data = CompanyData(*args, TEST_PRICES[0], df, self.finance_panel)
+        years, values = company_data.get_EPS()
+        self.assertIs(company_data.get_EPS()[1], values)
+        self.assertFalse(values.flags.writeable)
+        series = company_data.get_long_term_performance(calc_years=1)
+        self.assertIs(company_data.get_long_term_performance(calc_years=1), series)
+
+    def test_shared_memory(self):
+        shm, spec = self.finance_panel.to_shared_memory()
+        try:
+            shared_panel, shared_shm = panel.FinancePanel.from_shared_memory(spec)
+            np.testing.assert_array_equal(
+                shared_panel.values, self.finance_panel.values
+            )
+            del shared_panel
+            shared_shm.close()
+            records = self.market_df.iloc[:, 1:].values
+            df = make_company_performance_shard(
+                spec, TEST_CODES, records, np.array(TEST_PRICES)
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+        self.assertEqual(df[COMPANY_CODE].tolist(), TEST_CODES)
+        for i, code in enumerate(TEST_CODES):
+            args = self.market_df.iloc[i].tolist()
+            company_df = self.fy_all_df[self.fy_all_df[COMPANY_CODE] == code]
+            company_data = CompanyData(*args, TEST_PRICES[i], company_df)
+            expected = company_data.get_long_term_performance()
+            self.assertEqual(
+                pd.Series(expected.values).astype(str).tolist(),
+                pd.Series(df.iloc[i].values).astype(str).tolist(),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+import pandas as pd
+from PyQt6.QtCore import QPersistentModelIndex
+from PyQt6.QtWidgets import QApplication
+
+from jhdsfinder.names import *
+from jhdsfinder.screener import *
+from jhdsfinder.gui.abstract import Mediator
+from jhdsfinder.gui.screened_result import ScreenedCompanyTableModel
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+COLUMNS = [COMPANY_CODE, DIVIDEND_YIELD, PER]
+
+
+def make_performance_dataframe(n_companies=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            COMPANY_CODE: [str(1000 + i) for i in range(n_companies)],
+            DIVIDEND_YIELD: rng.uniform(0.0, 6.0, n_companies),
+            PER: rng.uniform(5.0, 30.0, n_companies),
+        }
+    )
+
+
+class TestApplyDelta(unittest.TestCase):
+    def setUp(self):
+        self.conditions = Conditions(
+            [
+                NumericalCondition(DIVIDEND_YIELD, 3.0, None),
+                NumericalCondition(PER, None, 15.0),
+            ]
+        )
+        self.df = make_performance_dataframe()
+        self.screener = CompanyScreener(self.df)
+        company_codes = self.screener.run(self.conditions)
+        screened_df = self.df[self.df[COMPANY_CODE].isin(company_codes)]
+        screened_df = screened_df.sort_values(by=DIVIDEND_YIELD, ascending=False)
+        self.model = ScreenedCompanyTableModel(screened_df[COLUMNS], Mediator())
+        self.resets = []
+        self.model.modelReset.connect(lambda: self.resets.append(1))
+
+    def test_update_rows_and_apply_delta(self):
+        # 株価が変わったように配当利回りとPERを変える
+        rng = np.random.default_rng(1)
+        df = self.df.copy()
+        changed = rng.choice(len(df), 20, replace=False)
+        df.loc[changed, DIVIDEND_YIELD] *= rng.uniform(0.5, 1.5, len(changed))
+        df.loc[changed, PER] *= rng.uniform(0.5, 1.5, len(changed))
+        delta = self.screener.update_rows(df)
+        self.assertGreater(
+            len(delta.added_company_codes) + len(delta.removed_company_codes), 0
+        )
+        # 残る行を選択しておく
+        kept = ~self.model._dataframe[COMPANY_CODE].isin(delta.removed_company_codes)
+        row = int(np.flatnonzero(kept.values)[-1])
+        selected_company_code = self.model._dataframe[COMPANY_CODE].iloc[row]
+        selected_index = QPersistentModelIndex(self.model.index(row, 0))
+        self.model.apply_delta(df[COLUMNS], delta)
+        # 全体をスクリーニングし直した結果と同じ銘柄になる
+        expected = CompanyScreener(df).run(self.conditions)
+        actual = self.model._dataframe
+        self.assertEqual(sorted(actual[COMPANY_CODE]), sorted(expected))
+        pd.testing.assert_frame_equal(actual, df[COLUMNS].loc[actual.index])
+        # 値が変わった行も含めて並び順に並び, モデルはリセットしない
+        self.assertTrue((np.diff(actual[DIVIDEND_YIELD].values) <= 0).all())
+        self.assertEqual(self.resets, [])
+        # 選択中の行は並べ直した後も同じ銘柄を指す
+        self.assertEqual(
+            actual[COMPANY_CODE].iloc[selected_index.row()], selected_company_code
+        )
+
+    def test_insert_rows_in_order(self):
+        # 表示していない銘柄だけが条件を満たすようになった場合は並び順の位置に挿入する
+        df = self.df.copy()
+        hidden = ~df[COMPANY_CODE].isin(self.model._dataframe[COMPANY_CODE])
+        df.loc[hidden, PER] = 10.0
+        delta = self.screener.update_rows(df)
+        self.assertEqual(delta.removed_company_codes.tolist(), [])
+        self.assertGreater(len(delta.added_company_codes), 0)
+        self.model.apply_delta(df[COLUMNS], delta)
+        actual = self.model._dataframe
+        self.assertEqual(
+            sorted(actual[COMPANY_CODE]),
+            sorted(CompanyScreener(df).run(self.conditions)),
+        )
+        self.assertTrue((np.diff(actual[DIVIDEND_YIELD].values) <= 0).all())
+        self.assertEqual(self.resets, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
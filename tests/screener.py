@@ -0,0 +1,371 @@
+import unittest
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import numpy as np
+import pandas as pd
+
+from jhdsfinder.names import *
+from jhdsfinder.screener import *
+from jhdsfinder import query
+
+
+def make_performance_dataframe():
+    return pd.DataFrame(
+        {
+            COMPANY_CODE: ["1301", "1332", "130A", "2914", "8306", "9999"],
+            DIVIDEND_YIELD: [3.5, 1.2, np.nan, 4.3, 3.9, 5.0],
+            DIVIDEND_INCREASE_CONTINUOUS: [True, False, False, True, True, False],
+            PER: [10.0, 25.0, 8.0, 14.0, np.nan, 30.0],
+            INDUSTRY_CATEGORY_33: [
+                FISHERY_FORESTRY_AGRICULTURE,
+                FISHERY_FORESTRY_AGRICULTURE,
+                OTHER,
+                FOOD_PRODUCTS,
+                BANKING,
+                np.nan,
+            ],
+            SCALE_CATEGORY: [
+                TOPIX_SMALL1,
+                TOPIX_SMALL1,
+                OTHER,
+                TOPIX_LARGE70,
+                TOPIX_CORE30,
+                OTHER,
+            ],
+        }
+    )
+
+
+class TestCompanyScreener(unittest.TestCase):
+    def setUp(self):
+        self.df = make_performance_dataframe()
+        self.screener = CompanyScreener(self.df)
+
+    def test_run(self):
+        conditions = Conditions(
+            [
+                NumericalCondition(DIVIDEND_YIELD, 3.0, None),
+                NumericalCondition(PER, None, 15.0),
+                NumericalCondition(DIVIDEND_INCREASE_CONTINUOUS, 0.5, None),
+            ]
+        )
+        self.assertEqual(self.screener.run(conditions).tolist(), ["1301", "2914"])
+
+    def test_range_and_category(self):
+        conditions = Conditions(
+            [
+                NumericalCondition(DIVIDEND_YIELD, 3.6, 5.0),
+                CategoricalCondition(INDUSTRY_CATEGORY_33, [FOOD_PRODUCTS, BANKING]),
+            ]
+        )
+        self.assertEqual(self.screener.run(conditions).tolist(), ["2914", "8306"])
+
+    def test_mask_cache(self):
+        conditions = [
+            NumericalCondition(DIVIDEND_YIELD, 3.0, None),
+            NumericalCondition(PER, None, 15.0),
+        ]
+        self.assertEqual(
+            self.screener.run(Conditions(conditions)).tolist(), ["1301", "2914"]
+        )
+        # 1つの条件だけを変更する
+        conditions[1].vmax = 20.0
+        self.assertEqual(
+            self.screener.run(Conditions(conditions)).tolist(), ["1301", "2914"]
+        )
+        conditions[0].vmin = 4.0
+        self.assertEqual(self.screener.run(Conditions(conditions)).tolist(), ["2914"])
+        conditions[0].vmin = 3.0
+        self.assertEqual(
+            self.screener.run(Conditions(conditions)).tolist(), ["1301", "2914"]
+        )
+        info = self.screener.get_mask_cache_info()
+        self.assertEqual(info["hits"], 4)
+        self.assertEqual(info["misses"], 4)
+        self.assertEqual(info["full_updates"], 0)
+
+    def test_category_bitmap_index(self):
+        category_index = CategoryBitmapIndex(
+            self.df[SCALE_CATEGORY].values, SCALE_CATEGORY_DICT
+        )
+        np.testing.assert_array_equal(
+            category_index.get_mask([LEARGE_SCALE_CATEGORY]),
+            [False, False, False, True, True, False],
+        )
+        self.assertEqual(category_index.count([TOPIX_SMALL1, OTHER]), 4)
+        self.assertEqual(category_index.count([ALL_SCALE_CATEGORY]), len(self.df))
+        self.assertEqual(category_index.count([TOPIX_MID400]), 0)
+        # 値と同じ名前のまとめた業種はisinと同じく値だけを選ぶ
+        for category_list in [[OTHER_PRODUCTS], [OTHER_PRODUCTS, OTHER]]:
+            conditions = Conditions(
+                [CategoricalCondition(INDUSTRY_CATEGORY_33, category_list)]
+            )
+            df = self.df[self.df[INDUSTRY_CATEGORY_33].isin(category_list)]
+            self.assertEqual(
+                self.screener.run(conditions).tolist(),
+                df[COMPANY_CODE].tolist(),
+            )
+
+    def test_sorted_column_index(self):
+        sorted_index = SortedColumnIndex(self.df[DIVIDEND_YIELD].values)
+        self.assertEqual(sorted_index.count(3.5, None), 4)
+        self.assertEqual(sorted_index.count(None, 3.9), 3)
+        self.assertEqual(sorted_index.count(3.6, 4.3), 2)
+        self.assertEqual(sorted_index.count(4.5, 4.0), 0)
+        self.assertEqual(sorted(sorted_index.get_indices(4.0, None)), [3, 5])
+
+    def test_count_with_range(self):
+        condition = NumericalCondition(DIVIDEND_YIELD, 3.0, None)
+        conditions = Conditions([condition, NumericalCondition(PER, None, 15.0)])
+        for vmin in [0.0, 3.0, 3.6, 4.0, 6.0]:
+            expected = Conditions(
+                [
+                    NumericalCondition(DIVIDEND_YIELD, vmin, None),
+                    NumericalCondition(PER, None, 15.0),
+                ]
+            )
+            self.assertEqual(
+                self.screener.count_with_range(conditions, condition, vmin, None),
+                len(self.screener.run(expected)),
+            )
+
+    def test_run_batch(self):
+        grid = {
+            DIVIDEND_YIELD: [(3.0, None), (4.0, None), (None, None)],
+            PER: [(None, 15.0), (None, 100.0)],
+        }
+        result = self.screener.run_batch(grid=grid)
+        self.assertEqual(result.counts.tolist(), [[2, 3], [1, 2], [3, 5]])
+        self.assertEqual(result.get_company_codes((1, 1)).tolist(), ["2914", "9999"])
+        conditions_list = [
+            Conditions([make_condition(DIVIDEND_YIELD, dividend_yield)])
+            for dividend_yield in grid[DIVIDEND_YIELD]
+        ]
+        result = self.screener.run_batch(conditions_list)
+        self.assertEqual(result.counts.tolist(), [4, 2, 6])
+        self.assertEqual(
+            result.get_company_codes(2).tolist(), self.df[COMPANY_CODE].tolist()
+        )
+
+    def test_solve_threshold(self):
+        condition = NumericalCondition(DIVIDEND_YIELD, 3.0, None)
+        conditions = Conditions([condition, NumericalCondition(PER, None, 100.0)])
+        # PERの条件を満たす銘柄の配当利回り: 1.2, 3.5, 4.3, 5.0
+        self.assertEqual(
+            self.screener.solve_threshold(conditions, condition, 2), (3.9, 2)
+        )
+        self.assertEqual(
+            self.screener.solve_threshold(conditions, condition, 10), (1.2, 4)
+        )
+        threshold, count = self.screener.solve_threshold(conditions, condition, 0)
+        self.assertGreater(threshold, 5.0)
+        self.assertEqual(count, 0)
+        condition = NumericalCondition(PER, None, 15.0)
+        self.assertEqual(
+            self.screener.solve_threshold([condition], condition, 2), (10.0, 2)
+        )
+
+    def test_solve_threshold_with_both_bounds(self):
+        # vmaxの4.5を超える5.0は数えない
+        condition = NumericalCondition(DIVIDEND_YIELD, 3.0, 4.5)
+        conditions = Conditions([condition, NumericalCondition(PER, None, 100.0)])
+        threshold, count = self.screener.solve_threshold(conditions, condition, 1)
+        self.assertEqual((threshold, count), (3.9, 1))
+        self.assertEqual(
+            self.screener.count_with_range(conditions, condition, threshold, 4.5),
+            count,
+        )
+
+    def test_explain(self):
+        conditions = Conditions(
+            [
+                NumericalCondition(DIVIDEND_YIELD, 3.0, None),
+                NumericalCondition(PER, None, 15.0),
+                NumericalCondition(DIVIDEND_INCREASE_CONTINUOUS, 0.5, None),
+                CategoricalCondition(SCALE_CATEGORY, None),
+            ]
+        )
+        df = self.screener.explain(conditions)
+        self.assertEqual(
+            df[FUNNEL_CONDITION].tolist(),
+            [
+                f"{DIVIDEND_YIELD} >= 3",
+                f"{PER} <= 15",
+                f"{DIVIDEND_INCREASE_CONTINUOUS} >= 0.5",
+            ],
+        )
+        self.assertEqual(df[FUNNEL_SURVIVORS].tolist(), [4, 2, 2])
+        # 8306だけがPERの条件のみを満たさない
+        self.assertEqual(df[FUNNEL_ONLY_FAILED].tolist(), [0, 1, 0])
+        self.assertEqual(
+            df[FUNNEL_SURVIVORS].iloc[-1], len(self.screener.run(conditions))
+        )
+        self.assertEqual(len(self.screener.explain(Conditions([]))), 0)
+
+    def test_query_condition(self):
+        text = f"{DIVIDEND_YIELD} >= 3.9 and {INDUSTRY_CATEGORY_33} in [{FOOD_PRODUCTS}, {BANKING}]"
+        self.assertEqual(
+            self.screener.run(Conditions([QueryCondition(text)])).tolist(),
+            ["2914", "8306"],
+        )
+        queries = {
+            f"{PER} < 10 or {DIVIDEND_YIELD} > 4.3": ["130A", "9999"],
+            # PERがない8306は否定しても含めない
+            f"not {PER} between 10 and 25": ["130A", "9999"],
+            f"{PER} != 10": ["1332", "130A", "2914", "9999"],
+            f"{INDUSTRY_CATEGORY_33} not in [{BANKING}]": [
+                "1301",
+                "1332",
+                "130A",
+                "2914",
+            ],
+            f"({PER} <= 10 or {PER} == 30) and not {SCALE_CATEGORY} in [{OTHER}]": [
+                "1301"
+            ],
+            f"{SCALE_CATEGORY} not in [{SMALL_SCALE_CATEGORY}, {OTHER}]": [
+                "2914",
+                "8306",
+            ],
+        }
+        for text, company_codes in queries.items():
+            conditions = Conditions([QueryCondition(text)])
+            self.assertEqual(self.screener.run(conditions).tolist(), company_codes)
+        # 同じ式は解析し直さない
+        self.assertIs(QueryCondition(text).plan, QueryCondition(f" {text} ").plan)
+        # 比較演算子の前後の空白は省略できる
+        self.assertEqual(
+            QueryCondition(f"{DIVIDEND_YIELD}>=4 and {PER}<3").plan,
+            QueryCondition(f"{DIVIDEND_YIELD} >= 4 and {PER} < 3").plan,
+        )
+        for text in [
+            f"{PER} <",
+            f"{PER} >= 1 2",
+            f"{INDUSTRY_CATEGORY_33} > 1",
+            f"{PER} in [{BANKING}]",
+            f"{PER} not in [{BANKING}]",
+            f"{DIVIDEND_YIELD}>=4and{PER}<3",
+            "",
+        ]:
+            with self.assertRaises(query.QuerySyntaxError):
+                QueryCondition(text)
+
+    def test_update_rows(self):
+        conditions = Conditions(
+            [
+                NumericalCondition(DIVIDEND_YIELD, 3.0, None),
+                NumericalCondition(PER, None, 15.0),
+            ]
+        )
+        self.assertEqual(self.screener.run(conditions).tolist(), ["1301", "2914"])
+        df = self.df.copy()
+        df[DIVIDEND_YIELD] = [2.0, 1.2, 3.1, 4.3, 3.9, 5.0]
+        df[PER] = [10.0, 25.0, 8.0, 14.0, 12.0, 30.0]
+        delta = self.screener.update_rows(df, ["1301", "130A"])
+        self.assertEqual(delta.company_codes.tolist(), ["1301", "130A"])
+        self.assertEqual(delta.added_company_codes.tolist(), ["130A"])
+        self.assertEqual(delta.removed_company_codes.tolist(), ["1301"])
+        self.assertEqual(self.screener.run(conditions).tolist(), ["130A", "2914"])
+        # 指定しない場合は値が変わった銘柄を判定し直す
+        delta = self.screener.update_rows(df)
+        self.assertEqual(delta.company_codes.tolist(), ["8306"])
+        self.assertEqual(delta.added_company_codes.tolist(), ["8306"])
+        self.assertEqual(
+            self.screener.run(conditions).tolist(),
+            CompanyScreener(df).run(conditions).tolist(),
+        )
+        self.assertEqual(self.screener.count_range(PER, None, 12.0), 3)
+
+    def test_normalize_values(self):
+        values = np.array([1.0, 3.0, np.nan, 10.0, 20.0, 5.0])
+        np.testing.assert_allclose(
+            normalize_values(values), (values - 7.8) / np.nanstd(values)
+        )
+        groups = np.array([0, 0, 0, 1, 1, 2])
+        np.testing.assert_allclose(
+            normalize_values(values, ZSCORE, groups), [-1, 1, np.nan, -1, 1, 0]
+        )
+        np.testing.assert_allclose(
+            normalize_values(values, RANK, groups), [0.5, 1, np.nan, 0.5, 1, 1]
+        )
+
+    def test_top_k(self):
+        weights = {DIVIDEND_YIELD: 1.0, PER: -1.0}
+        scores = self.screener.score(weights)
+        order = np.argsort(-scores, kind="stable")
+        company_codes, top_scores = self.screener.top_k(3, weights=weights)
+        self.assertEqual(
+            company_codes.tolist(), self.df[COMPANY_CODE][order[:3]].tolist()
+        )
+        np.testing.assert_allclose(top_scores, scores[order[:3]])
+        conditions = Conditions([NumericalCondition(PER, None, 20.0)])
+        company_codes, _ = self.screener.top_k(10, conditions, weights, RANK, True)
+        self.assertEqual(sorted(company_codes), ["1301", "130A", "2914"])
+        self.assertEqual(len(self.screener.top_k(0, weights=weights)[0]), 0)
+
+    def test_top_k_keeps_screening(self):
+        conditions = Conditions(
+            [
+                NumericalCondition(DIVIDEND_YIELD, 3.0, None),
+                NumericalCondition(PER, None, 15.0),
+            ]
+        )
+        mask = self.screener.get_mask(conditions).copy()
+        active_keys = self.screener.active_keys.copy()
+        fail_counts = self.screener.fail_counts.copy()
+        # 別の条件で上位を選んでも表示中のスクリーニング結果は変わらない
+        self.screener.top_k(
+            3, Conditions([NumericalCondition(PER, 20.0, None)]), {PER: 1.0}
+        )
+        np.testing.assert_array_equal(self.screener.combined_mask, mask)
+        self.assertEqual(self.screener.active_keys, active_keys)
+        np.testing.assert_array_equal(self.screener.fail_counts, fail_counts)
+        df = self.df.copy()
+        df[DIVIDEND_YIELD] = [2.0, 1.2, 3.1, 4.3, 3.9, 5.0]
+        df[PER] = [10.0, 25.0, 8.0, 14.0, 12.0, 30.0]
+        delta = self.screener.update_rows(df)
+        # 元の条件で判定し直した差分になる
+        before = set(self.screener.company_codes[mask])
+        after = set(CompanyScreener(df).run(conditions))
+        self.assertEqual(delta.added_company_codes.tolist(), sorted(after - before))
+        self.assertEqual(delta.removed_company_codes.tolist(), sorted(before - after))
+        self.assertEqual(
+            sorted(self.screener.company_codes[self.screener.combined_mask]),
+            sorted(after),
+        )
+
+    def test_industry_percentile_condition(self):
+        df = self.df.copy()
+        df[INDUSTRY_CATEGORY_33] = [BANKING, BANKING, BANKING, BANKING, BANKING, OTHER]
+        df[DIVIDEND_YIELD + INDUSTRY_PERCENTILE] = (
+            df[DIVIDEND_YIELD].groupby(df[INDUSTRY_CATEGORY_33]).rank(pct=True) * 100
+        )
+        screener = CompanyScreener(df)
+        # 業種内で配当利回りが上位50%
+        condition = NumericalCondition(DIVIDEND_YIELD + INDUSTRY_PERCENTILE, 50.0, None)
+        self.assertEqual(
+            screener.run(Conditions([condition])).tolist(),
+            ["1301", "2914", "8306", "9999"],
+        )
+        condition = QueryCondition(f"{DIVIDEND_YIELD}{INDUSTRY_PERCENTILE} >= 80")
+        self.assertEqual(
+            screener.run(Conditions([condition])).tolist(), ["2914", "9999"]
+        )
+
+    def test_no_screening(self):
+        conditions = Conditions(
+            [
+                NumericalCondition(PER, None, None),
+                CategoricalCondition(SCALE_CATEGORY, None),
+            ]
+        )
+        self.assertEqual(
+            self.screener.run(conditions).tolist(), self.df[COMPANY_CODE].tolist()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,20 +3,27 @@ from unittest.mock import patch, MagicMock
 
 import os
 import sys
+import time
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 sys.path.append(os.getcwd())
 
+from jhdsfinder import utils
 from jhdsfinder.utils import *
 
 
 class TestAccessURL(unittest.TestCase):
 
-    @patch("jhds.utils.requests.get")
-    def test_access_url_success(self, mock_get):
+    @patch("jhdsfinder.utils.get_session")
+    def test_access_url_success(self, mock_get_session):
         # モックの設定
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_get.return_value = mock_response
+        mock_session = mock_get_session.return_value
+        mock_session.request.return_value = mock_response
 
         # テスト対象の関数を呼び出す
         url = "dummy_url"
@@ -24,7 +31,186 @@ class TestAccessURL(unittest.TestCase):
 
         # アサーション
         self.assertEqual(response, mock_response)
-        mock_get.assert_called_once_with(url)
+        mock_session.request.assert_called_once_with(
+            "GET", url, headers=None, timeout=HTTP_TIMEOUT
+        )
+
+
+class RetryRequestHandler(BaseHTTPRequestHandler):
+    ETAG = '"v1"'
+    # 503を返す残りの回数
+    n_failures = 0
+    n_requests = 0
+    n_active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.n_requests += 1
+            cls.n_active += 1
+            cls.max_active = max(cls.max_active, cls.n_active)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.n_active -= 1
+            failing = cls.n_failures > 0
+            cls.n_failures -= int(failing)
+        if failing:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == self.ETAG:
+            self.send_response(304)
+            self.send_header("ETag", self.ETAG)
+            self.end_headers()
+            return
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("ETag", self.ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RetryRequestHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        RetryRequestHandler.n_requests = 0
+        RetryRequestHandler.max_active = 0
+        # ホストごとの制限はモジュールの状態なのでテストの後に戻す
+        self.token_buckets = dict(utils.token_buckets)
+        self.host_semaphores = dict(utils.host_semaphores)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        utils.token_buckets.clear()
+        utils.token_buckets.update(self.token_buckets)
+        utils.host_semaphores.clear()
+        utils.host_semaphores.update(self.host_semaphores)
+
+
+class TestRequest(LocalServerTestCase):
+
+    def test_retry(self):
+        RetryRequestHandler.n_failures = 2
+        response = access_url(self.url)
+        self.assertEqual(response.text, "ok")
+        self.assertEqual(RetryRequestHandler.n_requests, 3)
+        # やり直しの回数を超えるとエラーになる
+        RetryRequestHandler.n_failures = MAX_RETRIES + 1
+        with self.assertRaises(RuntimeError):
+            access_url(self.url)
+
+    def test_connection_limit(self):
+        set_connection_limit(urlparse(self.url).netloc, 2)
+        RetryRequestHandler.n_failures = 0
+        threads = [
+            threading.Thread(target=access_url, args=(self.url,)) for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(RetryRequestHandler.n_requests, 6)
+        self.assertLessEqual(RetryRequestHandler.max_active, 2)
+
+    def test_retry_connection_error(self):
+        # 接続できない場合はトークンを待たずにやり直して失敗する
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            url = f"http://127.0.0.1:{sock.getsockname()[1]}/"
+        set_rate_limit(urlparse(url).netloc, rate=0.01, capacity=1)
+        start = time.monotonic()
+        with patch.object(utils, "BACKOFF_SECONDS", 0.01):
+            with self.assertRaises(requests.ConnectionError):
+                request(url)
+        self.assertLess(time.monotonic() - start, 5.0)
+
+    def test_retry_seconds(self):
+        self.assertEqual(get_retry_seconds(None, 2), BACKOFF_SECONDS * 4)
+        self.assertEqual(get_retry_seconds(None, 100), MAX_BACKOFF_SECONDS)
+
+
+class TestHTTPCache(LocalServerTestCase):
+    def tearDown(self):
+        set_http_cache(None)
+        super().tearDown()
+
+    def test_record_and_replay(self):
+        RetryRequestHandler.n_failures = 0
+        with tempfile.TemporaryDirectory() as cache_dir:
+            set_http_cache(RECORD, cache_dir=cache_dir)
+            for _ in range(2):
+                self.assertEqual(access_url(self.url).text, "ok")
+            self.assertEqual(RetryRequestHandler.n_requests, 1)
+            # 同じ内容は1つだけ圧縮して保存する
+            set_http_cache(RECORD, cache_dir=cache_dir)
+            access_url(self.url + "?same=content")
+            object_filepaths = [
+                os.path.join(dirpath, filename)
+                for dirpath, _, filenames in os.walk(os.path.join(cache_dir, "objects"))
+                for filename in filenames
+            ]
+            self.assertEqual(len(object_filepaths), 1)
+            self.assertTrue(object_filepaths[0].endswith(".gz"))
+            # キャッシュだけを使ってアクセスしない
+            n_requests = RetryRequestHandler.n_requests
+            set_http_cache(REPLAY, cache_dir=cache_dir)
+            self.assertEqual(access_url(self.url).text, "ok")
+            with self.assertRaises(RuntimeError):
+                access_url(self.url + "?not=cached")
+            self.assertEqual(RetryRequestHandler.n_requests, n_requests)
+
+    def test_conditional_request(self):
+        RetryRequestHandler.n_failures = 0
+        etag = RetryRequestHandler.ETAG
+        with tempfile.TemporaryDirectory() as cache_dir:
+            set_http_cache(RECORD, cache_dir=cache_dir)
+            access_url(self.url)
+            # 条件付きリクエストはキャッシュを使わずにサーバーで確認する
+            response = access_url(self.url, {"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(RetryRequestHandler.n_requests, 2)
+            # REPLAYでは記録したETagと比べる
+            set_http_cache(REPLAY, cache_dir=cache_dir)
+            response = access_url(self.url, {"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            response = access_url(self.url, {"If-None-Match": '"v0"'})
+            self.assertEqual(response.text, "ok")
+            self.assertEqual(RetryRequestHandler.n_requests, 2)
+
+    def test_init_http_cache(self):
+        with patch.dict(os.environ, {HTTP_CACHE_ENV: ""}):
+            self.assertIsNone(init_http_cache())
+        with patch.dict(os.environ, {HTTP_CACHE_ENV: REPLAY}):
+            self.assertEqual(init_http_cache().mode, REPLAY)
+
+    def test_refresh_and_evict(self):
+        RetryRequestHandler.n_failures = 0
+        with tempfile.TemporaryDirectory() as cache_dir:
+            set_http_cache(RECORD, cache_dir=cache_dir)
+            access_url(self.url)
+            set_http_cache(REFRESH, cache_dir=cache_dir)
+            access_url(self.url)
+            self.assertEqual(RetryRequestHandler.n_requests, 2)
+            # 期限切れのキャッシュは削除する
+            set_http_cache(RECORD, cache_dir=cache_dir, ttl_seconds=-1)
+            for dirname in ["index", "objects"]:
+                filenames = [
+                    filename
+                    for _, _, filenames in os.walk(os.path.join(cache_dir, dirname))
+                    for filename in filenames
+                ]
+                self.assertEqual(filenames, [])
 
 
 if __name__ == "__main__":